@@ -3,80 +3,832 @@ import threading
 import os
 import time
 import sys
+import json
+import hashlib
+import struct
+import collections
+import bisect
+import itertools
+import argparse
+import heapq
+import zlib
+import math
 
 FORMAT = "utf-8"
 DOWNLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "downloads")
+POOL_SIZE = 8  # số kết nối rảnh tối đa được giữ lại để dùng cho các phần / file sau
+PIPELINE_DEPTH = 4  # số yêu cầu DOWNLOAD gửi trước trên một kết nối mà chưa cần chờ trả lời
+PIPELINE_BLOCK = 1024 * 1024  # mỗi phần được tải bằng nhiều yêu cầu DOWNLOAD nhỏ cỡ này
+RECV_SIZE = 64 * 1024
+MAX_RETRIES = 3  # số lần mở lại kết nối khi một phần bị đứt giữa chừng
+SEGMENT_SIZE = 8 * 1024 * 1024  # file được chia thành nhiều đoạn cỡ này thay vì đúng 4 phần
+MIN_SPLIT_SIZE = 2 * PIPELINE_BLOCK  # đoạn còn lại nhỏ hơn mức này thì không chia đôi cho worker rảnh nữa
+WORKERS_PER_FILE = 4  # số luồng tải tối đa cho một file
+MAX_WORKERS = 8  # số luồng tải tối đa trên tất cả các file cùng lúc, mỗi luồng dùng một kết nối nên đây cũng là số kết nối tối đa
+MAX_FILES = 4  # số file được tải cùng lúc
+MAX_BANDWIDTH = 0  # tổng tốc độ tải tối đa của mọi file (byte mỗi giây), 0 là không giới hạn
+COMPRESS_LEVEL = 0  # mức nén zlib xin server (1 nhanh nhất - 9 nhỏ nhất), 0 là không nén; có ích trên đường truyền chậm
+COMPRESS_MODES = {"off": 0, "fast": 1, "zlib": 6}
+DELTA_SYNC = True  # file đã có bản cũ trong thư mục tải về: chỉ tải những đoạn đã đổi, phần còn lại chép từ bản cũ
+DELTA_MIN_BLOCK = 2 * 1024  # cỡ khối của chữ ký, khoảng căn bậc hai kích thước file như rsync
+DELTA_MAX_BLOCKS = 128 * 1024  # để chữ ký (20 byte mỗi khối) vừa giới hạn payload DELTA của server
+JOURNAL_INTERVAL = 1  # ghi nhật ký tiến độ xuống đĩa nhiều nhất mỗi giây một lần
+REFRESH_RATE = 10  # số lần vẽ lại tiến độ mỗi giây
+RATE_WINDOW = 2  # tốc độ tải được tính trên các mẫu trong RATE_WINDOW giây gần nhất
+METRICS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "metrics.json")  # ghi lại sau mỗi file
+INPUT_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "input.txt")  # getInput.py ghi vào đây khi client chưa chạy
+CONTROL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "control.sock")  # Unix socket nhận lệnh tải từ getInput.py
+CONTROL_PORT = 9442  # hệ điều hành không có Unix socket thì nhận lệnh trên cổng TCP này của 127.0.0.1
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+THROUGHPUT_BUCKETS = (1e5, 1e6, 1e7, 1e8, 1e9)  # byte mỗi giây
+METRIC_DEFINITIONS = [
+    ("tcp_client_downloads_total", "counter", "Finished downloads, by result"),
+    ("tcp_client_active_downloads", "gauge", "Downloads in progress"),
+    ("tcp_client_bytes_received_total", "counter", "File bytes received, refetched blocks included"),
+    ("tcp_client_wire_bytes_received_total", "counter", "Bytes of DOWNLOAD replies on the wire, less than the file bytes when compressed"),
+    ("tcp_client_blocks_total", "counter", "DOWNLOAD blocks received and checked"),
+    ("tcp_client_corrupt_blocks_total", "counter", "Blocks that did not match the server's hash"),
+    ("tcp_client_retries_total", "counter", "Segments resumed on a new connection, by reason"),
+    ("tcp_client_request_seconds", "histogram", "Round-trip time of STAT, HASHES and CATALOG requests", SECONDS_BUCKETS),
+    ("tcp_client_block_seconds", "histogram", "Time from sending a DOWNLOAD request to having its whole block", SECONDS_BUCKETS),
+    ("tcp_client_download_throughput_bytes_per_second", "histogram", "Average throughput of each finished download", THROUGHPUT_BUCKETS),
+    ("tcp_client_socket_recv_seconds_total", "counter", "Time spent reading from sockets, waiting included"),
+    ("tcp_client_disk_write_seconds_total", "counter", "Time spent writing received data"),
+    ("tcp_client_delta_reused_bytes_total", "counter", "File bytes copied from the old local copy instead of downloaded"),
+]
+
+# giao thức đóng khung, giống với server: FRAME_MAGIC ngay sau khi kết nối, sau đó mỗi yêu cầu và mỗi
+# câu trả lời có header (opcode, request id, độ dài payload, trạng thái) rồi tới payload
+FRAME_MAGIC = b"\x00MMT1"
+FRAME_FORMAT = "!B I I B"
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+OP_LIST = 1
+OP_CATALOG = 2
+OP_DOWNLOAD = 3
+OP_STAT = 4
+OP_HASHES = 5
+OP_ZDOWNLOAD = 6
+OP_DELTA = 7
+CHUNK_FORMAT = "!B I I"  # khúc của câu trả lời ZDOWNLOAD: codec, số byte gốc, số byte trên đường truyền
+CHUNK_HEADER_SIZE = struct.calcsize(CHUNK_FORMAT)
+CODEC_RAW = 0
+CODEC_DEFLATE = 1
+DELTA_SIGNATURE = "!I 16s"  # adler32 và 16 byte BLAKE2b của một khối bản cũ
+DELTA_RUN = "!Q I I"  # vị trí trong file mới, khối đầu tiên trong bản cũ, số khối liền nhau
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
 process_display = {}
+worker_slots = threading.BoundedSemaphore(MAX_WORKERS)
+
+# giới hạn tổng tốc độ tải bằng token bucket dùng chung cho mọi worker, rate 0 là không giới hạn.
+# Worker lấy trước phần dữ liệu vừa nhận rồi ngủ cho tới khi trả hết phần thiếu; khi worker ngủ
+# thì không đọc socket, cửa sổ TCP đầy và server tự gửi chậm lại
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate  # số byte còn được nhận ngay, tối đa bằng lượng của một giây
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, length):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.allowance + (now - self.updated_at) * self.rate, self.rate) - length
+            self.updated_at = now
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+bandwidth = RateLimiter(MAX_BANDWIDTH)
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.1f} {unit}"
+        size /= 1024
+
+def format_eta(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes:02}:{seconds:02}"
+
+# tiến độ của một file. Mỗi worker chỉ cộng vào ô received của chính nó nên luồng nhận không cần khóa;
+# segments[i] là đoạn worker i đang tải. Luồng vẽ chỉ đọc các giá trị này
+class Progress:
+    def __init__(self, size, done, workers):
+        self.size = size
+        self.done = done  # số byte đã tải từ lần chạy trước
+        self.received = [0] * workers
+        self.segments = [None] * workers
+        self.samples = collections.deque()
 
-display_process_lock = threading.Lock()
+    def completed(self):
+        return min(self.done + sum(self.received), self.size)
 
-def display_process(num_parts):
-    sys.stdout.write('\r')
+    # số byte mỗi giây trong RATE_WINDOW giây gần nhất
+    def rate(self, now):
+        total = sum(self.received)
+        self.samples.append((now, total))
+        while now - self.samples[0][0] > RATE_WINDOW:
+            self.samples.popleft()
+        first_time, first_total = self.samples[0]
+        return (total - first_total) / (now - first_time) if now > first_time else 0.0
 
-    for file_name in process_display:
+# luồng vẽ tiến độ: lấy mẫu các bộ đếm REFRESH_RATE lần mỗi giây rồi vẽ lại cả bảng một lần,
+# các luồng nhận dữ liệu không bao giờ phải chờ khóa hay stdout
+class ProgressRenderer:
+    def __init__(self, files):
+        self.files = files
+        self.lock = threading.Lock()  # chỉ dùng giữa luồng vẽ và add / remove
+        self.lines = 0  # số dòng đã vẽ lần trước, lần sau vẽ đè lên
+        self.thread = None
 
-        sys.stdout.write(f"-------------| {file_name} |-------------\n")
+    def add(self, file_name, progress):
+        with self.lock:
+            self.files[file_name] = progress
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True)
+                self.thread.start()
 
-        for i in range(num_parts):
-            part = (f"Part {i + 1} ")
-            val = int(process_display[file_name][i] // 5)
-            sys.stdout.write(f"{part} [{val * "="}{(20 - val) * " "}] {int(process_display[file_name][i])}%\n") 
-        
+    # vẽ lần cuối rồi bỏ file khỏi bảng; những gì in ra sau đó nằm dưới bảng
+    def remove(self, file_name):
+        with self.lock:
+            self.render(time.monotonic())
+            del self.files[file_name]
+            self.lines = 0
+
+    def run(self):
+        while True:
+            time.sleep(1 / REFRESH_RATE)
+            with self.lock:
+                if self.files:
+                    self.render(time.monotonic())
+
+    def render(self, now):
+        rows = []
+        for file_name, progress in self.files.items():
+            done = progress.completed()
+            rate = progress.rate(now)
+            eta = format_eta((progress.size - done) / rate) if rate > 0 else "--:--"
+            percent = done / max(progress.size, 1) * 100
+            rows.append(f"-------------| {file_name} |-------------")
+            rows.append(f"{percent:5.1f}%  {format_size(done)} / {format_size(progress.size)}  {format_size(rate)}/s  ETA {eta}")
+
+            for i, segment in enumerate(progress.segments):
+                # tiến độ của worker trên đoạn hiện tại, end có thể bị lùi nếu đoạn bị chia
+                process = 0
+                if segment is not None:
+                    process = min((segment.received - segment.start) / max(segment.end - segment.start, 1) * 100, 100)
+                val = int(process // 5)
+                rows.append(f"Worker {i + 1}  [{'=' * val}{' ' * (20 - val)}] {int(process)}%")
+
+        sys.stdout.write("\033[F" * self.lines + "".join(f"{row}\033[K\n" for row in rows))
         sys.stdout.flush()
-        sys.stdout.write("\033[F" * (num_parts + 1))
-
-    sys.stdout.write(" ")
-
-
-def download_chunk(file_name, offset, chunk_size, server_ip, server_port, part):
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-            client.connect((server_ip, server_port))
-            request = f"DOWNLOAD {file_name} {offset} {chunk_size}"
-            client.send(request.encode(FORMAT))
-
-            file_part_path = os.path.join(DOWNLOAD_FOLDER, f"{file_name}.part{part}")
-            with open(file_part_path, "wb") as f:
-                total_len = 0
-                while total_len < chunk_size:
-                    data = client.recv(1024)
-                    if not data:
-                        continue
-                    total_len += len(data)
-                    f.write(data)
-
-                    process = total_len / chunk_size * 100
-                    process_display[file_name][part - 1] = round(process, 2)
-
-                    # luồng hiện tại chỉ đựoc gọi display_process khi tiến độ nó của tăng tới ngưỡng bội số nguyên của 3
-                    if process % 2 == 0:
-                        with display_process_lock:
-                            display_process(4)
-            
-            process_display[file_name][part - 1] = 100
-            client.close()
-
-def merge_files(filename, num_parts):
-    # Ghép các file con thành file hoàn chỉnh
-    with open(os.path.join(DOWNLOAD_FOLDER, filename), "wb") as f_out:
-        for i in range(num_parts):
-            part_file_path = os.path.join(DOWNLOAD_FOLDER, f"{filename}.part{i + 1}")
-            with open(part_file_path, "rb") as f_in:
-                f_out.write(f_in.read())
-            os.remove(part_file_path)  # Xóa file con sau khi hoàn tất gép file
-    print(f"Merged {filename} completely.")
-
-def download_file(file_name, file_size, server_ip, server_port):
+        self.lines = len(rows)
+
+renderer = ProgressRenderer(process_display)
+
+
+# các counter, gauge và histogram của client, ghi ra METRICS_FILE dạng JSON. Mỗi metric được khai báo trước trong
+# METRIC_DEFINITIONS; mỗi chuỗi số liệu được chọn bằng chuỗi nhãn, ví dụ 'result="done"'. Luồng nhận cộng dồn
+# số liệu của mình rồi mới cập nhật một lần cho mỗi khối, không phải cho mỗi lần recv
+class Metrics:
+    def __init__(self, definitions):
+        self.lock = threading.Lock()
+        self.definitions = {definition[0]: definition for definition in definitions}
+        self.values = {name: {} for name in self.definitions}  # tên -> nhãn -> giá trị
+        self.dump_lock = threading.Lock()  # các file tải song song cùng ghi một file dump
+
+    def inc(self, name, value=1, labels=""):
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels=""):
+        with self.lock:
+            self.values[name][labels] = value
+
+    # thêm một loạt mẫu vào histogram
+    def observe(self, name, samples, labels=""):
+        buckets = self.definitions[name][3]
+        with self.lock:
+            counts = self.values[name].setdefault(labels, [[0] * (len(buckets) + 1), 0.0, 0])
+            for sample in samples:
+                counts[0][bisect.bisect_left(buckets, sample)] += 1
+                counts[1] += sample
+                counts[2] += 1
+
+    # tên -> nhãn -> giá trị; histogram thành số mẫu cộng dồn theo từng ngưỡng, tổng và số mẫu
+    def snapshot(self):
+        with self.lock:
+            snapshot = {}
+            for name, series in self.values.items():
+                definition = self.definitions[name]
+                snapshot[name] = {}
+                for labels, value in series.items():
+                    if definition[1] == "histogram":
+                        bounds = [str(bound) for bound in definition[3]] + ["+Inf"]
+                        value = {"buckets": dict(zip(bounds, itertools.accumulate(value[0]))), "sum": value[1], "count": value[2]}
+                    snapshot[name][labels] = value
+            return snapshot
+
+    # ghi snapshot ra file JSON, thay file cũ trong một bước
+    def dump(self, path):
+        temp_path = path + ".tmp"
+        with self.dump_lock:
+            with open(temp_path, "w") as f:
+                json.dump({"time": time.time(), "metrics": self.snapshot()}, f, indent=2)
+            os.replace(temp_path, path)
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+# server trả lời một yêu cầu bằng trạng thái lỗi; payload của câu trả lời là thông báo lỗi
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+# một kết nối TCP dùng giao thức đóng khung tới server, kèm buffer đọc để nhận lần lượt các câu trả lời được pipeline
+class Connection:
+    def __init__(self, server_ip, server_port):
+        self.sock = socket.create_connection((server_ip, server_port))
+        self.reader = self.sock.makefile("rb")
+        self.next_id = 0
+        self.sock.sendall(FRAME_MAGIC)
+
+    # gửi một yêu cầu, trả về request id để đối chiếu với câu trả lời
+    def send(self, opcode, payload=b""):
+        self.next_id = (self.next_id + 1) & 0xFFFFFFFF
+        self.sock.sendall(struct.pack(FRAME_FORMAT, opcode, self.next_id, len(payload), 0) + payload)
+        return self.next_id
+
+    def read_exact(self, length):
+        data = self.reader.read(length)
+        if len(data) < length:
+            raise ConnectionError("server closed the connection")
+        return data
+
+    # đọc header câu trả lời cho yêu cầu request_id và trả về độ dài payload; trạng thái lỗi thành RequestError
+    def receive(self, opcode, request_id):
+        reply_opcode, reply_id, length, status = struct.unpack(FRAME_FORMAT, self.read_exact(FRAME_SIZE))
+        if reply_opcode != opcode or reply_id != request_id:
+            raise ConnectionError(f"expected the reply to request {request_id}, got {reply_id}")
+        if status != STATUS_OK:
+            raise RequestError(status, self.read_exact(length).decode(FORMAT, "replace"))
+        return length
+
+    # đọc `length` byte, mỗi lần được bao nhiêu trả về bấy nhiêu
+    def read_stream(self, length):
+        while length > 0:
+            data = self.reader.read1(min(RECV_SIZE, length))
+            if not data:
+                raise ConnectionError("server closed the connection")
+            length -= len(data)
+            yield data
+
+    # đọc câu trả lời ZDOWNLOAD dài `length` byte và trả về dữ liệu gốc: khúc nén được giải nén cả khúc,
+    # khúc nguyên (file không nén được) thì đọc thẳng như DOWNLOAD
+    def read_chunks(self, length):
+        while length > 0:
+            codec, raw_len, wire_len = struct.unpack(CHUNK_FORMAT, self.read_exact(CHUNK_HEADER_SIZE))
+            length -= CHUNK_HEADER_SIZE + wire_len
+            if codec == CODEC_RAW:
+                yield from self.read_stream(wire_len)
+                continue
+            try:
+                data = zlib.decompressobj(-15).decompress(self.read_exact(wire_len), raw_len + 1)
+            except zlib.error as e:
+                raise ConnectionError(f"bad compressed chunk: {e}")
+            if codec != CODEC_DEFLATE or len(data) != raw_len:
+                raise ConnectionError("bad compressed chunk")
+            yield data
+
+    # gửi một yêu cầu và đọc cả câu trả lời
+    def request(self, opcode, payload=b""):
+        request_id = self.send(opcode, payload)
+        return self.read_exact(self.receive(opcode, request_id))
+
+    def close(self):
+        self.reader.close()
+        self.sock.close()
+
+# giữ lại các kết nối đã mở để dùng tiếp cho LIST, các phần và các file sau,
+# thay vì mở (và để lại TIME_WAIT) một kết nối mới cho mỗi phần
+class ConnectionPool:
+    def __init__(self, server_ip, server_port, size=POOL_SIZE):
+        self.address = (server_ip, server_port)
+        self.size = size
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        return Connection(*self.address)
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for conn in idle:
+            conn.close()
+
+# một đoạn [start, end) của file. received là số byte đã ghi liên tục từ start, requested là nơi yêu cầu
+# DOWNLOAD cuối cùng kết thúc; end có thể bị lùi lại khi worker khác lấy bớt nửa sau của đoạn
+class Segment:
+    def __init__(self, start, end):
+        self.start = start
+        self.end = end
+        self.received = start
+        self.requested = start
+        self.started_at = time.monotonic()
+
+    def remaining(self):
+        return self.end - self.received
+
+    # thời gian ước tính để tải xong phần còn lại với tốc độ hiện tại của đoạn
+    def eta(self, now):
+        rate = (self.received - self.start) / max(now - self.started_at, 1e-6)
+        return self.remaining() / rate if rate > 0 else float("inf")
+
+# một khối không khớp với bảng băm của server
+class CorruptBlock(Exception):
+    def __init__(self, offset):
+        super().__init__(f"block at byte {offset} does not match its hash")
+        self.offset = offset
+
+# phân đoạn cho các worker của một file: worker lấy đoạn chưa ai tải, hết thì chia đôi
+# phần chưa yêu cầu của đoạn chậm nhất để một kết nối chậm không giữ chân cả file.
+# Các khối được yêu cầu luôn trùng với các khối trong bảng băm của server (nếu có) để kiểm tra được từng khối
+class Scheduler:
+    def __init__(self, ranges, block_size=PIPELINE_BLOCK, hashes=None, segment_size=SEGMENT_SIZE, size=None):
+        self.block_size = block_size
+        self.hashes = hashes  # SHA-256 của từng khối, None nếu server không có bảng băm
+        self.size = size  # kích thước file, để biết một khối được tải trọn hay chỉ một phần
+        segment_size = max(block_size, segment_size // block_size * block_size)
+        self.pending = [Segment(start, min(start + segment_size, end)) for first, end in ranges for start in range(first, end, segment_size)]
+        self.pending.reverse()
+        self.active = []
+        self.lock = threading.Lock()
+
+    def next_segment(self):
+        with self.lock:
+            if self.pending:
+                segment = self.pending.pop()
+                segment.started_at = time.monotonic()
+                self.active.append(segment)
+                return segment
+
+            now = time.monotonic()
+            candidates = [seg for seg in self.active if seg.end - seg.requested >= MIN_SPLIT_SIZE]
+            if not candidates:
+                return None
+            victim = max(candidates, key=lambda seg: seg.eta(now))
+
+            # chỉ lấy phần chưa được yêu cầu, làm tròn theo khối
+            middle = max(victim.requested, victim.received + victim.remaining() // 2)
+            middle += -middle % self.block_size
+            if victim.end - middle < self.block_size:
+                return None
+            segment = Segment(middle, victim.end)
+            victim.end = middle
+            self.active.append(segment)
+            return segment
+
+    # khối tiếp theo cần yêu cầu trong đoạn, None khi đã yêu cầu hết (đoạn có thể vừa bị chia)
+    def next_block(self, segment):
+        with self.lock:
+            if segment.requested >= segment.end:
+                return None
+            block = (segment.requested, min(self.block_size - segment.requested % self.block_size, segment.end - segment.requested))
+            segment.requested += block[1]
+            return block
+
+    def add_received(self, segment, length):
+        with self.lock:
+            segment.received += length
+
+    # kết nối bị đứt: các yêu cầu đã gửi nhưng chưa nhận sẽ được gửi lại trên kết nối mới.
+    # Khối hỏng: tải lại từ đầu khối đó
+    def rewind(self, segment, offset=None):
+        with self.lock:
+            if offset is not None:
+                segment.received = offset
+            segment.requested = segment.received
+
+    # khối [offset, offset + length) có khớp với bảng băm không. Phần đầu của một khối (phần sau đã được
+    # chép từ bản cũ) không kiểm tra được ở đây, cả file sẽ được kiểm tra bằng SHA-256
+    def verify(self, offset, length, block_hash):
+        if self.hashes is None or offset % self.block_size:
+            return True
+        if self.size is not None and length < min(self.block_size, self.size - offset):
+            return True
+        index = offset // self.block_size
+        return index < len(self.hashes) and block_hash.digest() == self.hashes[index]
+
+    def finish(self, segment):
+        with self.lock:
+            self.active.remove(segment)
+
+# tải một đoạn trên một kết nối: luôn để sẵn PIPELINE_DEPTH yêu cầu PIPELINE_BLOCK byte trên đường
+# truyền, server trả lời đúng theo thứ tự đã gửi và mỗi câu trả lời mang request id của yêu cầu. Mỗi khối chỉ được gửi yêu cầu khi cần nên
+# phần sau của đoạn vẫn có thể được chia cho worker khác
+def fetch_segment(conn, writer, file_name, segment, scheduler, journal, on_data):
+    outstanding = []
+
+    def request_more():
+        while len(outstanding) < PIPELINE_DEPTH:
+            block = scheduler.next_block(segment)
+            if block is None:
+                return
+            if COMPRESS_LEVEL:
+                request_id = conn.send(OP_ZDOWNLOAD, struct.pack("!Q Q B", *block, COMPRESS_LEVEL) + file_name.encode(FORMAT))
+            else:
+                request_id = conn.send(OP_DOWNLOAD, struct.pack("!Q Q", *block) + file_name.encode(FORMAT))
+            outstanding.append((request_id, *block, time.perf_counter()))
+
+    request_more()
+    while outstanding:
+        request_id, block_offset, block_len, requested_at = outstanding.pop(0)
+        opcode = OP_ZDOWNLOAD if COMPRESS_LEVEL else OP_DOWNLOAD
+        length = conn.receive(opcode, request_id)
+        if opcode == OP_DOWNLOAD and length != block_len:
+            raise ConnectionError(f"server sent a short block at byte {block_offset}")
+        pieces = conn.read_chunks(length) if opcode == OP_ZDOWNLOAD else conn.read_stream(length)
+        writer.position = block_offset
+        block_hash = hashlib.sha256()
+        remaining = block_len
+        recv_seconds = write_seconds = 0.0
+        while True:
+            started_at = time.perf_counter()
+            data = next(pieces, None)
+            received_at = time.perf_counter()
+            if data is None:
+                break
+            if len(data) > remaining:
+                raise ConnectionError(f"server sent a long block at byte {block_offset}")
+            writer.write(data)
+            recv_seconds += received_at - started_at
+            write_seconds += time.perf_counter() - received_at
+            block_hash.update(data)
+            remaining -= len(data)
+            scheduler.add_received(segment, len(data))
+            on_data(len(data))
+            bandwidth.consume(len(data))
+        if remaining:
+            raise ConnectionError(f"server sent a short block at byte {block_offset}")
+        metrics.inc("tcp_client_bytes_received_total", block_len)
+        metrics.inc("tcp_client_wire_bytes_received_total", length)
+        metrics.inc("tcp_client_blocks_total")
+        metrics.inc("tcp_client_socket_recv_seconds_total", recv_seconds)
+        metrics.inc("tcp_client_disk_write_seconds_total", write_seconds)
+        metrics.observe("tcp_client_block_seconds", [time.perf_counter() - requested_at])
+        if not scheduler.verify(block_offset, block_len, block_hash):
+            metrics.inc("tcp_client_corrupt_blocks_total")
+            raise CorruptBlock(block_offset)
+        journal.add(block_offset, block_offset + block_len)
+        request_more()
+
+# ghi một phần vào đúng vị trí của nó trong file đích. os.pwrite ghi theo offset nên các luồng không
+# cần seek chung một con trỏ file; Windows không có os.pwrite nên khi đó mỗi phần seek trên file object riêng
+class RangeWriter:
+    def __init__(self, path, offset):
+        self.f = open(path, "r+b", buffering=0)
+        self.position = offset
+
+    def write(self, data):
+        view = memoryview(data)
+        while view:
+            if hasattr(os, "pwrite"):
+                written = os.pwrite(self.f.fileno(), view, self.position)
+            else:
+                self.f.seek(self.position)
+                written = self.f.write(view)
+            view = view[written:]
+            self.position += written
+
+    def close(self):
+        self.f.close()
+
+# file tạm đang tải và file ghi chú đi kèm (kích thước, các phần), đổi tên thành file thật khi tải xong
+def temp_paths(file_name):
+    temp_path = os.path.join(DOWNLOAD_FOLDER, f"{file_name}.part")
+    return temp_path, temp_path + ".json"
+
+# nhật ký tiến độ của một lượt tải, lưu trong file .part.json: thông tin file trên server (kích thước,
+# mtime, SHA-256) và các đoạn byte đã nằm chắc chắn trên đĩa. Khi client bị tắt giữa chừng, lần chạy sau
+# chỉ tải lại những đoạn còn thiếu nếu file trên server vẫn y như cũ
+class Journal:
+    def __init__(self, path, part_path, info, ranges=None):
+        self.path = path
+        self.part_path = part_path
+        self.info = info  # {"name", "size", "mtime", "sha256"}
+        self.ranges = ranges or []  # các đoạn [start, end) đã tải xong, đã sắp xếp và không chồng nhau
+        self.saved_at = 0
+        self.lock = threading.Lock()
+
+    # đọc nhật ký cũ, None nếu không có, hỏng hoặc không còn khớp với file trên server / file tạm
+    @classmethod
+    def load(cls, path, part_path, info):
+        try:
+            with open(path, "r") as f:
+                data = json.load(f)
+            if {key: data.get(key) for key in info} != info or os.path.getsize(part_path) != info["size"]:
+                return None
+            return cls(path, part_path, info, [list(r) for r in data["ranges"]])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def add(self, start, end):
+        with self.lock:
+            merged = []
+            for first, last in sorted(self.ranges + [[start, end]]):
+                if merged and first <= merged[-1][1]:
+                    merged[-1][1] = max(merged[-1][1], last)
+                else:
+                    merged.append([first, last])
+            self.ranges = merged
+        if time.monotonic() - self.saved_at >= JOURNAL_INTERVAL:
+            self.save()
+
+    # kiểm tra lại các đoạn đã tải với bảng băm, bỏ những khối không khớp (ví dụ bị hỏng khi máy bị tắt đột ngột)
+    def verify(self, block_size, hashes):
+        with self.lock:
+            ranges, self.ranges = self.ranges, []
+        with open(self.part_path, "rb") as f:
+            for first, last in ranges:
+                for start in range(first - first % block_size, last, block_size):
+                    end = min(start + block_size, self.info["size"])
+                    if start < first or end > last:
+                        continue  # khối chỉ tải được một phần, tải lại cả khối
+                    f.seek(start)
+                    if hashlib.sha256(f.read(end - start)).digest() == hashes[start // block_size]:
+                        self.add(start, end)
+
+    # các đoạn còn phải tải
+    def missing(self):
+        with self.lock:
+            gaps, position = [], 0
+            for first, last in self.ranges:
+                if first > position:
+                    gaps.append((position, first))
+                position = max(position, last)
+            if position < self.info["size"]:
+                gaps.append((position, self.info["size"]))
+            return gaps
+
+    # dữ liệu phải xuống đĩa trước nhật ký, nếu không sau khi mất điện nhật ký có thể ghi nhận
+    # những đoạn chưa thực sự được ghi. Nhật ký được ghi ra file tạm rồi đổi tên để không bao giờ bị ghi dở
+    def save(self):
+        with self.lock:
+            self.saved_at = time.monotonic()
+            ranges = [list(r) for r in self.ranges]
+            fd = os.open(self.part_path, os.O_RDWR)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            temp = self.path + ".tmp"
+            with open(temp, "w") as f:
+                json.dump(dict(self.info, ranges=ranges), f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp, self.path)
+
+# SHA-256 của file đã tải, so với SHA-256 server báo trong STAT
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+# tạo sẵn file đích đủ kích thước để các phần ghi thẳng vào, không cần ghép file
+def preallocate(path, file_size):
+    with open(path, "wb") as f:
+        if hasattr(os, "posix_fallocate") and file_size > 0:
+            try:
+                os.posix_fallocate(f.fileno(), 0, file_size)
+                return
+            except OSError:
+                pass  # hệ thống file không hỗ trợ, dùng truncate (file thưa)
+        f.truncate(file_size)
+
+# một worker tải lần lượt các đoạn do scheduler giao cho tới khi file không còn gì để tải.
+# worker_slots giới hạn tổng số worker đang chạy trên mọi file
+def download_worker(file_name, scheduler, journal, pool, worker, temp_path, failed, progress):
+    with worker_slots:
+        writer = RangeWriter(temp_path, 0)
+        try:
+            while not failed:
+                segment = scheduler.next_segment()
+                if segment is None:
+                    break
+                if not download_segment(file_name, segment, scheduler, journal, pool, worker, writer, progress):
+                    failed.append(worker)
+        finally:
+            writer.close()
+
+def download_segment(file_name, segment, scheduler, journal, pool, worker, writer, progress):
+    progress.segments[worker - 1] = segment
+    received = progress.received
+
+    def on_data(length):
+        # chỉ cộng bộ đếm của worker này, việc vẽ lại là của luồng vẽ
+        received[worker - 1] += length
+
+    retries = 0
+    try:
+        while segment.remaining() > 0:
+            conn = pool.acquire()
+            try:
+                fetch_segment(conn, writer, file_name, segment, scheduler, journal, on_data)
+            except CorruptBlock as e:
+                # các câu trả lời đã pipeline phía sau vẫn còn trên kết nối: bỏ kết nối và chỉ tải lại từ khối hỏng
+                print(f"{file_name}: {e}, fetching it again.")
+                conn.close()
+                scheduler.rewind(segment, e.offset)
+                metrics.inc("tcp_client_retries_total", labels='reason="corrupt"')
+                retries += 1
+                if retries > MAX_RETRIES:
+                    return False
+                continue
+            except RequestError as e:
+                # server từ chối yêu cầu (ví dụ file đã bị xóa): tải lại cũng không khác
+                conn.close()
+                print(f"Worker {worker} of {file_name} failed: {e}")
+                return False
+            except OSError as e:
+                # kết nối cũ trong pool có thể đã bị server đóng: bỏ nó và tải tiếp phần còn thiếu trên kết nối mới
+                conn.close()
+                scheduler.rewind(segment)
+                metrics.inc("tcp_client_retries_total", labels='reason="connection"')
+                retries += 1
+                if retries > MAX_RETRIES:
+                    print(f"Worker {worker} of {file_name} failed: {e}")
+                    return False
+                continue
+            pool.release(conn)
+    finally:
+        scheduler.finish(segment)
+    return True
+
+# gửi một yêu cầu trên một kết nối của pool và trả về payload của câu trả lời. Câu trả lời lỗi được đọc hết
+# nên kết nối vẫn dùng tiếp được; chỉ bỏ kết nối khi nó bị đứt
+def pool_request(pool, opcode, payload=b""):
+    conn = pool.acquire()
+    started_at = time.perf_counter()
+    try:
+        reply = conn.request(opcode, payload)
+    except RequestError:
+        pool.release(conn)
+        raise
+    except OSError:
+        conn.close()
+        raise
+    pool.release(conn)
+    metrics.observe("tcp_client_request_seconds", [time.perf_counter() - started_at])
+    return reply
+
+# STAT: kích thước, mtime và SHA-256 của file trên server, None nếu server không có file
+def get_file_info(pool, file_name):
+    try:
+        reply = pool_request(pool, OP_STAT, file_name.encode(FORMAT))
+    except RequestError as e:
+        if e.status == STATUS_NOT_FOUND:
+            return None
+        raise
+    size, mtime = struct.unpack("!Q Q", reply[:16])
+    return {"name": file_name, "size": size, "mtime": mtime, "sha256": reply[16:48].hex()}
+
+# HASHES: (cỡ khối, băm từng khối), None nếu server không có bảng băm
+# hoặc các giá trị băm không khớp với gốc Merkle server gửi kèm
+def get_block_index(pool, file_name):
+    try:
+        reply = pool_request(pool, OP_HASHES, file_name.encode(FORMAT))
+    except RequestError:
+        return None
+    (block_size,) = struct.unpack("!I", reply[:4])
+    root, data = reply[4:36], reply[36:]
+    hashes = [data[i:i + 32] for i in range(0, len(data), 32)]
+    return (block_size, hashes) if merkle_root(hashes) == root else None
+
+# gốc cây Merkle, tính giống như server
+def merkle_root(hashes):
+    level = list(hashes) or [hashlib.sha256().digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(b"".join(level[i:i + 2])).digest() for i in range(0, len(level), 2)]
+    return level[0]
+
+# cỡ khối chữ ký cho bản cũ dài `size` byte: khoảng căn bậc hai, tròn KB, không quá DELTA_MAX_BLOCKS khối
+def delta_block_size(size):
+    return max(DELTA_MIN_BLOCK, math.isqrt(size) // 1024 * 1024, -(-size // DELTA_MAX_BLOCKS))
+
+# cập nhật kiểu rsync: gửi chữ ký từng khối của bản cũ, server trả về những đoạn của file mới có trong bản cũ,
+# chép các đoạn đó vào file tạm và ghi vào nhật ký; phần còn thiếu được tải như thường. Trả về số byte đã chép
+def copy_unchanged(pool, file_name, old_path, journal):
+    block_size = delta_block_size(os.path.getsize(old_path))
+    signatures = []
+    with open(old_path, "rb") as f:
+        while len(block := f.read(block_size)) == block_size:
+            signatures.append(struct.pack(DELTA_SIGNATURE, zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest()))
+    if not signatures:
+        return 0
+    try:
+        reply = pool_request(pool, OP_DELTA, struct.pack("!I I", block_size, len(signatures)) + b"".join(signatures) + file_name.encode(FORMAT))
+    except RequestError as e:
+        print(f"{file_name}: server cannot compare with the old copy ({e}), downloading all of it.")
+        return 0
+
+    copied = 0
+    writer = RangeWriter(journal.part_path, 0)
+    try:
+        with open(old_path, "rb") as f:
+            for position, first, count in struct.iter_unpack(DELTA_RUN, reply):
+                length = count * block_size
+                if first + count > len(signatures) or position + length > journal.info["size"]:
+                    raise ConnectionError("server sent a bad DELTA reply")
+                f.seek(first * block_size)
+                writer.position = position
+                for start in range(0, length, PIPELINE_BLOCK):
+                    writer.write(f.read(min(PIPELINE_BLOCK, length - start)))
+                journal.add(position, position + length)
+                copied += length
+    finally:
+        writer.close()
+    metrics.inc("tcp_client_delta_reused_bytes_total", copied)
+    return copied
+
+# tải một file và ghi lại metrics (cả khi tải lỗi) ra METRICS_FILE
+def download_file(file_name, pool, workers=WORKERS_PER_FILE):
+    metrics.inc("tcp_client_active_downloads")
+    done = False
+    try:
+        done = transfer_file(file_name, pool, workers)
+    finally:
+        metrics.inc("tcp_client_active_downloads", -1)
+        metrics.inc("tcp_client_downloads_total", labels=f'result="{"done" if done else "failed"}"')
+        try:
+            metrics.dump(METRICS_FILE)
+        except OSError as e:
+            print(f"Could not write {METRICS_FILE}: {e}")
+    return done
+
+def transfer_file(file_name, pool, workers):
+    started_at = time.monotonic()
     threads = []
-    chunk_size = file_size // 4
+    failed = []
+    temp_path, info_path = temp_paths(file_name)
 
-    for i in range(4):
-        offset = i * chunk_size
-        chunk_len = 0 
-        if i < 3:
-            chunk_len = chunk_size
-        else:
-            chunk_len = file_size - offset
-        thread = threading.Thread(target=download_chunk, args=(file_name, offset, chunk_len, server_ip, server_port, i + 1))
+    info = get_file_info(pool, file_name)
+    if info is None:
+        print(f"File {file_name} not found on server.")
+        return False
+
+    # bản đã tải trước đây giống hệt file trên server thì không cần tải lại
+    local_path = os.path.join(DOWNLOAD_FOLDER, file_name)
+    if os.path.isfile(local_path) and os.path.getsize(local_path) == info["size"] and file_digest(local_path) == info["sha256"]:
+        print(f"{file_name} is already up to date.")
+        return True
+
+    index = get_block_index(pool, file_name)
+    block_size, hashes = index if index else (PIPELINE_BLOCK, None)
+
+    # tải tiếp từ nhật ký nếu file trên server không đổi, nếu không thì tải lại từ đầu
+    # (file đã có bản cũ thì chỉ tải phần khác với bản cũ)
+    journal = Journal.load(info_path, temp_path, info)
+    reused = 0
+    if journal is None:
+        preallocate(temp_path, info["size"])
+        journal = Journal(info_path, temp_path, info)
+        if DELTA_SYNC and os.path.isfile(local_path):
+            reused = copy_unchanged(pool, file_name, local_path, journal)
+        journal.save()
+    elif hashes:
+        journal.verify(block_size, hashes)
+    done = sum(last - first for first, last in journal.ranges)
+    if reused:
+        print(f"Updating {file_name}: {reused}/{info['size']} bytes reused from the old copy.")
+    elif done:
+        print(f"Resuming {file_name}: {done}/{info['size']} bytes already downloaded.")
+    scheduler = Scheduler(journal.missing(), block_size, hashes, size=info["size"])
+
+    # file nhỏ không cần nhiều worker hơn số đoạn
+    workers = max(1, min(workers, len(scheduler.pending)))
+    progress = Progress(info["size"], done, workers)
+    renderer.add(file_name, progress)
+
+    for i in range(workers):
+        thread = threading.Thread(target=download_worker, args=(file_name, scheduler, journal, pool, i + 1, temp_path, failed, progress))
         threads.append(thread)
         thread.start()
 
@@ -84,82 +836,286 @@ def download_file(file_name, file_size, server_ip, server_port):
     for thread in threads:
         thread.join()
 
-    merge_files(file_name, 4)
-    del process_display[file_name]
+    renderer.remove(file_name)
+    journal.save()
+    if failed:
+        print(f"Download of {file_name} failed, run the client again to resume it.")
+        return False
+
+    # kiểm tra cả file trước khi coi là tải xong (khi có bảng băm và không chép gì từ bản cũ thì từng khối
+    # đã được kiểm tra rồi); nếu sai thì bỏ phần đã tải để lần sau tải lại từ đầu
+    if (not hashes or reused) and file_digest(temp_path) != info["sha256"]:
+        print(f"{file_name} failed the SHA-256 check, it will be downloaded again.")
+        os.remove(temp_path)
+        os.remove(info_path)
+        return False
+
+    # các đoạn đã nằm đúng chỗ trong file tạm, chỉ cần đổi tên
+    os.replace(temp_path, os.path.join(DOWNLOAD_FOLDER, file_name))
+    os.remove(info_path)
+    metrics.observe("tcp_client_download_throughput_bytes_per_second", [(info["size"] - done) / max(time.monotonic() - started_at, 1e-6)])
+    print(f"Downloaded {file_name} completely.")
+    return True
+
+# hàng đợi tải: tải nhiều file cùng lúc, tối đa max_files file, file có priority lớn hơn được tải trước
+# (cùng priority thì theo thứ tự thêm vào). Giới hạn số kết nối và tốc độ là chung cho mọi file
+# (worker_slots, bandwidth). callback(file_name, done) được gọi trên luồng tải khi file xong hoặc lỗi
+class TransferQueue:
+    def __init__(self, pool, max_files=MAX_FILES, workers=WORKERS_PER_FILE):
+        self.pool = pool
+        self.max_files = max_files
+        self.workers = workers
+        self.pending = []  # heap (-priority, thứ tự, tên file, callback)
+        self.order = itertools.count()
+        self.queued = set()  # các file đang chờ hoặc đang tải
+        self.running = 0
+        self.threads = []
+        self.condition = threading.Condition()
+
+    # thêm một file vào hàng đợi, False nếu file đã nằm trong hàng đợi
+    def submit(self, file_name, priority=0, callback=None):
+        with self.condition:
+            if file_name in self.queued:
+                return False
+            self.queued.add(file_name)
+            heapq.heappush(self.pending, (-priority, next(self.order), file_name, callback))
+            # mỗi luồng tải lần lượt từng file, chỉ mở thêm luồng khi các luồng cũ đều bận
+            if len(self.threads) < self.max_files and self.running + len(self.pending) > len(self.threads):
+                thread = threading.Thread(target=self.run, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+            return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                _, _, file_name, callback = heapq.heappop(self.pending)
+                self.running += 1
+            try:
+                try:
+                    done = download_file(file_name, self.pool, self.workers)
+                except OSError as e:
+                    print(f"Download of {file_name} failed: {e}")
+                    done = False
+                if callback:
+                    callback(file_name, done)
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.queued.discard(file_name)
+                    self.condition.notify_all()
+
+    # tên file -> "queued" (đang chờ) hoặc "running" (đang tải)
+    def status(self):
+        with self.condition:
+            waiting = {item[2] for item in self.pending}
+            return {file_name: "queued" if file_name in waiting else "running" for file_name in self.queued}
 
-    time.sleep(3)
-    os.system('cls' if os.name == 'nt' else 'clear')
+    # đợi cho tới khi hàng đợi không còn file nào đang chờ hay đang tải
+    def join(self):
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending and not self.running)
 
-def main():
-    server_ip = "127.0.0.1"
-    server_port = 65432
+# mở socket điều khiển: Unix socket CONTROL_PATH, hoặc cổng CONTROL_PORT khi không có Unix socket.
+# Socket cũ còn sót lại sau khi client bị tắt đột ngột thì xóa đi, trừ khi đang có một client khác nghe trên đó
+def open_control_socket():
+    if not hasattr(socket, "AF_UNIX"):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", CONTROL_PORT))
+        listener.listen()
+        return listener
 
-    data = None
-    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as client:
-        client.connect((server_ip, server_port))
-        client.send("LIST".encode(FORMAT))
-        data = client.recv(4096).decode(FORMAT)
+    if os.path.exists(CONTROL_PATH):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(CONTROL_PATH)
+        except OSError:
+            os.remove(CONTROL_PATH)
+        else:
+            raise OSError(f"another client is already listening on {CONTROL_PATH}")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(CONTROL_PATH)
+    listener.listen()
+    return listener
+
+# nhận lệnh tải qua socket điều khiển và đưa vào hàng đợi. Mỗi dòng là một lệnh JSON, client trả lời
+# và báo kết quả bằng các dòng JSON trên cùng kết nối:
+#   {"op": "get", "files": [...], "priority": 0} -> {"event": "queued", "file": ...} cho từng file,
+#       rồi {"event": "done" | "failed", "file": ...} khi file tải xong hoặc lỗi, nếu kết nối vẫn còn mở
+#   {"op": "status"} -> {"event": "status", "jobs": {tên file: "queued" | "running" | "done" | "failed"}}
+class ControlServer:
+    def __init__(self, queue):
+        self.queue = queue
+        self.finished = {}  # tên file -> "done" / "failed"
+        self.watchers = {}  # tên file -> hàm gửi sự kiện của các kết nối đang chờ file đó
+        self.lock = threading.Lock()
+
+    def serve(self, listener):
+        try:
+            while True:
+                conn, _ = listener.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            if listener.family != socket.AF_INET:
+                os.remove(CONTROL_PATH)
+
+    # file đang chờ hay đang tải thì chỉ chờ thêm kết quả. File đã có trong thư mục tải về vẫn được đưa vào
+    # hàng đợi: nếu trên server đã đổi thì nó được cập nhật, nếu không thì xong ngay
+    def submit(self, file_name, priority=0, send=None):
+        with self.lock:
+            self.finished.pop(file_name, None)
+            if send:
+                self.watchers.setdefault(file_name, []).append(send)
+        self.queue.submit(file_name, priority, self.on_done)
+        if send:
+            send({"event": "queued", "file": file_name})
+
+    def on_done(self, file_name, done):
+        event = {"event": "done" if done else "failed", "file": file_name}
+        with self.lock:
+            self.finished[file_name] = event["event"]
+            watchers = self.watchers.pop(file_name, [])
+        for send in watchers:
+            send(event)
+
+    def handle(self, conn):
+        lock = threading.Lock()  # các luồng tải cũng gửi sự kiện trên kết nối này
+
+        def send(event):
+            try:
+                with lock:
+                    conn.sendall(json.dumps(event).encode(FORMAT) + b"\n")
+            except OSError:
+                pass  # getInput.py đã thoát, không cần báo nữa
 
-    files = dict(line.split() for line in data.splitlines())
-    downloaded_files = set()
+        with conn, conn.makefile("r", encoding=FORMAT) as reader:
+            for line in reader:
+                try:
+                    command = json.loads(line)
+                    op = command["op"]
+                    if op == "get":
+                        for file_name in command["files"]:
+                            self.submit(file_name, int(command.get("priority", 0)), send)
+                    elif op == "status":
+                        with self.lock:
+                            jobs = dict(self.finished)
+                        jobs.update(self.queue.status())
+                        send({"event": "status", "jobs": jobs})
+                    else:
+                        send({"event": "error", "message": f"unknown op {op}"})
+                except (ValueError, KeyError, TypeError) as e:
+                    send({"event": "error", "message": f"bad command: {e}"})
 
-    # upline = 3 + len(data.splitlines())
+def decode_varint(data, position):
+    value = shift = 0
     while True:
-        print("Available files:")
-        print(data)
-        print("| Please run file getInput.py to enter files you'd like to download.")
-        print("| Press Enter to continue")
-        print("| Press Ctrl + C to exit")
-
-        enter = input()
-        os.system('cls' if os.name == 'nt' else 'clear')
-
-        input_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "input.txt")
-        if os.path.exists(input_file):
-            flag = 0
-
-            with open(input_file, "r") as f:
-                # tải những file thực sự chưa tải
-                files_to_download = [line.strip() for line in f if line.strip() not in downloaded_files and not os.path.exists(os.path.join(DOWNLOAD_FOLDER, line.strip()))]
-
-            for file_name in files_to_download:
-                if file_name == None or file_name == "":
-                    continue
-
-                process_display[file_name] = [0] * 4
-
-                if file_name in files:
-                    file_size = int(files[file_name])
-                    print(f"Downloading {file_name}...")
-                    download_file(file_name, file_size, server_ip, server_port)
-                    downloaded_files.add(file_name)
-                else:
-                    print(f"File {file_name} not found on server.")
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+# giải mã một trang CATALOG: mỗi mục gồm số byte trùng với tên trước, độ dài phần còn lại, phần còn lại và kích thước
+def decode_list_page(body):
+    entries, position, previous = [], 0, b""
+    while position < len(body):
+        shared, position = decode_varint(body, position)
+        length, position = decode_varint(body, position)
+        name = previous[:shared] + body[position:position + length]
+        size, position = decode_varint(body, position + length)
+        entries.append((name.decode(FORMAT), size))
+        previous = name
+    return entries
+
+# CATALOG: số file (4 byte) rồi các trang, mỗi trang có 4 byte độ dài phía trước, kết thúc bằng
+# một trang rỗng. Trả về danh sách (tên, kích thước) đã sắp xếp theo tên
+def get_file_list(pool, prefix=""):
+    reply = pool_request(pool, OP_CATALOG, prefix.encode(FORMAT))
+    files, position = [], 4
+    while True:
+        (length,) = struct.unpack("!I", reply[position:position + 4])
+        position += 4
+        if length == 0:
+            return files
+        files += decode_list_page(reply[position:position + length])
+        position += length
 
-                    # xóa file không tồn tại đó ra khỏi file input.txt
-                    files_to_download.remove(file_name)
-                    flag = 1
+# tải các file cho trước (song song, file đứng trước được bắt đầu trước) rồi thoát,
+# không cần input.txt hay bàn phím (dùng cho script và benchmark)
+def run_headless(file_names, server_ip, server_port, workers):
+    pool = ConnectionPool(server_ip, server_port, POOL_SIZE)
+    queue = TransferQueue(pool, MAX_FILES, workers)
+    failed = []
 
-                if flag == 1:
-                    # xóa file không tồn tại đó ra khỏi file input.txt
-                    with open(input_file, "r") as f:  
-                        lines = f.readlines()   
+    def on_done(file_name, done):
+        if not done:
+            failed.append(file_name)
 
-                    lines = [line.strip() for line in lines]
+    for file_name in file_names:
+        queue.submit(file_name, callback=on_done)
+    queue.join()
+    pool.close()
+    if failed:
+        print(f"Failed: {' '.join(failed)}")
+    return 1 if failed else 0
 
-                    lines.remove(file_name)
+# chạy nền: nhận lệnh tải qua socket điều khiển (getInput.py) và tải ngay, không cần bàn phím hay đọc lại input.txt
+def main(server_ip="127.0.0.1", server_port=65432, workers=WORKERS_PER_FILE):
+    pool = ConnectionPool(server_ip, server_port, POOL_SIZE)
+    print("Available files:")
+    print("\n".join(f"{name} {size}" for name, size in get_file_list(pool)))
 
-                    with open(input_file, "w") as f:  
-                        f.write('\n'.join(lines) + '\n')   
+    control = ControlServer(TransferQueue(pool, MAX_FILES, workers))
+    try:
+        listener = open_control_socket()
+    except OSError as e:
+        print(f"Could not open the control socket: {e}")
+        sys.exit(1)
 
+    # các file getInput.py ghi vào input.txt khi client chưa chạy; xoá nội dung sau khi nhận để lần chạy sau không tải lại
+    if os.path.exists(INPUT_FILE):
+        with open(INPUT_FILE, "r") as f:
+            for line in f:
+                if line.strip():
+                    control.submit(line.strip())
+        open(INPUT_FILE, "w").close()
 
-        time.sleep(5)
-        os.system('cls' if os.name == 'nt' else 'clear')
+    print(f"Waiting for jobs on {CONTROL_PATH if listener.family != socket.AF_INET else f'127.0.0.1:{CONTROL_PORT}'}")
+    print("| Please run file getInput.py to enter files you'd like to download.")
+    print("| Press Ctrl + C to exit")
+    control.serve(listener)
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="TCP file client. Without file names it runs as a daemon: it takes download jobs from getInput.py over the control socket, and at startup queues whatever input.txt holds once, then empties it")
+    parser.add_argument("files", nargs="*", help="download these files and exit instead")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=65432)
+    parser.add_argument("--output", default=DOWNLOAD_FOLDER, help="directory to download into")
+    parser.add_argument("--workers", type=int, default=WORKERS_PER_FILE, help="download threads per file")
+    parser.add_argument("--parallel", type=int, default=MAX_FILES, help="files downloaded at the same time")
+    parser.add_argument("--connections", type=int, default=MAX_WORKERS, help="connections open at the same time, over all files")
+    parser.add_argument("--bandwidth", type=int, default=MAX_BANDWIDTH, help="total download rate in bytes per second, 0 for no limit")
+    parser.add_argument("--compress", choices=sorted(COMPRESS_MODES), default="off", help="ask the server to compress what compresses (fast = zlib level 1)")
+    parser.add_argument("--compress-level", type=int, choices=range(1, 10), metavar="1-9", help="zlib level, overrides the one of --compress")
+    parser.add_argument("--no-delta", dest="delta", action="store_false", help="download changed files completely instead of only the parts that differ from the old copy")
+    parser.add_argument("--metrics", default=METRICS_FILE, help="where to write the JSON metrics dump")
+    args = parser.parse_args()
+    DOWNLOAD_FOLDER, METRICS_FILE = os.path.abspath(args.output), os.path.abspath(args.metrics)
+    MAX_FILES, MAX_WORKERS, POOL_SIZE = args.parallel, args.connections, args.connections
+    worker_slots = threading.BoundedSemaphore(args.connections)
+    bandwidth = RateLimiter(args.bandwidth)
+    COMPRESS_LEVEL = args.compress_level or COMPRESS_MODES[args.compress]
+    DELTA_SYNC = args.delta
+
     os.makedirs(DOWNLOAD_FOLDER, exist_ok=True)
     try:
-        main()
+        if args.files:
+            sys.exit(run_headless(args.files, args.host, args.port, args.workers))
+        main(args.host, args.port, args.workers)
     except KeyboardInterrupt:
         print("Client out")
         exit()
@@ -1,8 +1,27 @@
 import os
+import sys
+import json
+import socket
+import argparse
 
+FORMAT = "utf-8"
 input_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "input.txt")
+CONTROL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "control.sock")  # phải giống Client.py
+CONTROL_PORT = 9442
 
-def main():
+# kết nối tới socket điều khiển của Client.py đang chạy
+def connect():
+    if hasattr(socket, "AF_UNIX"):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(CONTROL_PATH)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+    return socket.create_connection(("127.0.0.1", CONTROL_PORT))
+
+def read_files():
     print("Please enter file(s) that you want to download:")
     print("Press Enter twice to stop")
 
@@ -12,14 +31,66 @@ def main():
         line = input()
         if line == "":
             break
-        
+
         lines.append(line)
 
-    with open(input_file, "a") as f:  
-        f.write('\n'.join(lines) + '\n')
+    return lines
+
+# gửi lệnh tải rồi in trạng thái của từng file; với wait thì chờ tới khi mọi file tải xong hoặc lỗi
+def submit(files, priority, wait):
+    try:
+        sock = connect()
+    except OSError:
+        # client chưa chạy: ghi vào input.txt, client sẽ tải các file này khi khởi động
+        with open(input_file, "a") as f:
+            f.write('\n'.join(files) + '\n')
+        print("Client is not running, the files were added to input.txt.")
+        return 0
+
+    failed = False
+    with sock, sock.makefile("r", encoding=FORMAT) as reader:
+        sock.sendall(json.dumps({"op": "get", "files": files, "priority": priority}).encode(FORMAT) + b"\n")
+        pending = set(files)
+        for line in reader:
+            event = json.loads(line)
+            print(f"{event.get('file', '')}: {event['event']} {event.get('message', '')}".rstrip())
+            if event["event"] in ("done", "failed") or event["event"] == "queued" and not wait:
+                pending.discard(event.get("file"))
+            failed = failed or event["event"] in ("failed", "error")
+            if not pending or event["event"] == "error":
+                break
+    return 1 if failed else 0
 
+def show_status():
+    try:
+        sock = connect()
+    except OSError:
+        print("Client is not running.")
+        return 1
+    with sock, sock.makefile("r", encoding=FORMAT) as reader:
+        sock.sendall(json.dumps({"op": "status"}).encode(FORMAT) + b"\n")
+        jobs = json.loads(reader.readline())["jobs"]
+    for file_name, state in sorted(jobs.items()):
+        print(f"{file_name} {state}")
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="Send files to the running TCP client to download")
+    parser.add_argument("files", nargs="*", help="files to download; without them they are read from the keyboard")
+    parser.add_argument("--priority", type=int, default=0, help="files with a higher priority start first")
+    parser.add_argument("--wait", action="store_true", help="wait until the files are downloaded")
+    parser.add_argument("--status", action="store_true", help="show the client's jobs instead")
+    args = parser.parse_args()
+
+    if args.status:
+        return show_status()
+    if args.files:
+        return submit(args.files, args.priority, args.wait)
+
+    files = read_files()
     os.system('cls' if os.name == 'nt' else 'clear')
-        
+    return submit(files, args.priority, args.wait) if files else 0
+
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    sys.exit(main())
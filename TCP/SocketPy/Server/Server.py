@@ -1,46 +1,784 @@
 import socket
 import os
 import threading
+import asyncio
+import signal
+import argparse
+import time
+import hashlib
+import struct
+import bisect
+import itertools
+import http.server
+import zlib
+import concurrent.futures
+import collections
+import mmap
+
+try:
+    import resource  # chỉ có trên Unix, dùng để nâng giới hạn số file/socket được mở
+except ImportError:
+    resource = None
 
 HOST = "127.0.0.1"
 PORT = 65432
 FORMAT = "utf-8"
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # Server directory, holds the files and file_list.txt
+CATALOG_INTERVAL = 2  # mỗi bao nhiêu giây kiểm tra lại thư mục xem có file mới / file bị sửa / bị xóa
+CATALOG_PAGE_BYTES = 64 * 1024  # kích thước tối đa mỗi trang của câu trả lời CATALOG
+
+# giao thức đóng khung: client gửi FRAME_MAGIC ngay sau khi kết nối, sau đó mỗi yêu cầu và mỗi câu trả lời
+# đều có một header cố định (opcode, request id, độ dài payload, trạng thái) rồi tới payload.
+# Kết nối không bắt đầu bằng FRAME_MAGIC dùng giao thức văn bản cũ (LIST / DOWNLOAD ...)
+FRAME_MAGIC = b"\x00MMT1"  # byte 0 đầu tiên không thể là đầu một lệnh văn bản
+FRAME_FORMAT = "!B I I B"  # opcode, request id, độ dài payload, trạng thái
+FRAME_SIZE = struct.calcsize(FRAME_FORMAT)
+MAX_REQUEST_PAYLOAD = 64 * 1024
+OP_LIST = 1  # payload rỗng -> các dòng "tên kích thước"
+OP_CATALOG = 2  # payload là tiền tố -> số file (4 byte) rồi các trang như CATALOG
+OP_DOWNLOAD = 3  # payload là offset, số byte (8 byte mỗi số) rồi tên file -> dữ liệu
+OP_STAT = 4  # payload là tên file -> kích thước, mtime (8 byte mỗi số) rồi 32 byte SHA-256
+OP_HASHES = 5  # payload là tên file -> cỡ khối (4 byte), 32 byte gốc Merkle rồi 32 byte băm của từng khối
+OP_ZDOWNLOAD = 6  # như DOWNLOAD nhưng có thêm mức nén (1 byte) trước tên file -> các khúc CHUNK_FORMAT, khúc nén hoặc không
+OP_DELTA = 7  # payload là cỡ khối, số khối (4 byte mỗi số), chữ ký DELTA_SIGNATURE của từng khối bản cũ phía client rồi tên file -> các DELTA_RUN
+OP_NAMES = {OP_LIST: "LIST", OP_CATALOG: "CATALOG", OP_DOWNLOAD: "DOWNLOAD", OP_STAT: "STAT", OP_HASHES: "HASHES", OP_ZDOWNLOAD: "ZDOWNLOAD", OP_DELTA: "DELTA"}
+MAX_PAYLOADS = {OP_DELTA: 4 * 1024 * 1024}  # chữ ký của một file lớn không vừa MAX_REQUEST_PAYLOAD
+CHUNK_FORMAT = "!B I I"  # codec, số byte gốc, số byte trên đường truyền; theo sau là dữ liệu
+CODEC_RAW = 0
+CODEC_DEFLATE = 1  # raw deflate (zlib không header), giải nén bằng zlib.decompress(data, -15)
+COMPRESS_CHUNK = 128 * 1024  # mỗi đoạn ZDOWNLOAD được nén thành từng khúc cỡ này, song song trên COMPRESS_WORKERS luồng
+COMPRESS_WORKERS = os.cpu_count() or 2
+MAX_ZDOWNLOAD = 4 * 1024 * 1024  # đoạn ZDOWNLOAD lớn nhất: cả đoạn nén nằm trong bộ nhớ trước khi gửi; client xin từng khối 1 MB
+COMPRESS_SAMPLES = 8  # số mẫu rải đều trong file để đoán file có nén được không
+COMPRESS_SAMPLE_SIZE = 16 * 1024
+COMPRESS_THRESHOLD = 0.9  # nén mẫu mà không nhỏ hơn mức này (file .zip, .jpg...) thì gửi nguyên, khỏi tốn CPU
+DELTA_SIGNATURE = "!I 16s"  # adler32 (tổng kiểm tra cuộn được) và 16 byte BLAKE2b của một khối
+DELTA_RUN = "!Q I I"  # vị trí trong file trên server, khối đầu tiên trong bản cũ của client, số khối liền nhau
+DELTA_SEARCH = 256 * 1024  # sau một chỗ khác nhau, thử từng vị trí trong chừng này byte để bắt lại chỗ trùng
+DELTA_STRIDE = 1024 * 1024  # xa hơn thì mỗi DELTA_STRIDE byte chỉ thử một cửa sổ cỡ một khối, để file khác hẳn không tốn quá nhiều CPU
+CACHE_SIZE = 64 * 1024 * 1024  # số byte khúc đã nén giữ trong bộ nhớ cho mọi kết nối dùng chung, 0 để tắt
+CACHE_PROTECTED = 0.8  # phần của cache dành cho các khúc được dùng lại từ hai lần trở lên
+STATUS_OK = 0
+STATUS_NOT_FOUND = 1
+STATUS_BAD_REQUEST = 2
+STATUS_ERROR = 3  # lỗi phía server; payload của câu trả lời lỗi là thông báo lỗi dạng văn bản
+BACKLOG = 1024  # hàng đợi kết nối chờ accept, dùng chung cho cả hai chế độ
+SHUTDOWN_TIMEOUT = 10  # thời gian chờ các kết nối đang tải xong khi tắt server (giây)
+HASH_BLOCK = 1024 * 1024  # kích thước mỗi khối trong bảng băm của file, bằng cỡ yêu cầu DOWNLOAD của client
+METRICS_PORT = 9432  # endpoint Prometheus trên máy local: http://HOST:METRICS_PORT/metrics, 0 để tắt
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+THROUGHPUT_BUCKETS = (1e5, 1e6, 1e7, 1e8, 1e9)  # byte mỗi giây
+METRIC_DEFINITIONS = [
+    ("tcp_connections_total", "counter", "Connections accepted"),
+    ("tcp_active_connections", "gauge", "Connections currently open"),
+    ("tcp_requests_total", "counter", "Requests received, by operation"),
+    ("tcp_errors_total", "counter", "Framed requests answered with an error, by status"),
+    ("tcp_bytes_sent_total", "counter", "File bytes sent for DOWNLOAD requests"),
+    ("tcp_send_seconds", "histogram", "Time to send one DOWNLOAD range (sendfile: disk read and socket send together)", SECONDS_BUCKETS),
+    ("tcp_range_throughput_bytes_per_second", "histogram", "Throughput of each DOWNLOAD range", THROUGHPUT_BUCKETS),
+    ("tcp_index_seconds_total", "counter", "Time spent reading and hashing files for STAT and HASHES"),
+    ("tcp_compression_bytes_total", "counter", "ZDOWNLOAD file bytes compressed (stage=\"in\") and the compressed bytes (stage=\"out\")"),
+    ("tcp_compress_seconds_total", "counter", "Time spent reading and compressing ZDOWNLOAD ranges"),
+    ("tcp_compression_skipped_total", "counter", "ZDOWNLOAD ranges sent uncompressed because the file does not compress"),
+    ("tcp_cache_requests_total", "counter", "Compressed chunk cache lookups, by result (a miss is one read and compression)"),
+    ("tcp_cache_evictions_total", "counter", "Chunks dropped from the compressed chunk cache to make room"),
+    ("tcp_cache_bytes", "gauge", "Bytes held in the compressed chunk cache"),
+    ("tcp_delta_bytes_total", "counter", "DELTA file bytes the client already had (result=\"matched\") and has to download (result=\"literal\")"),
+    ("tcp_delta_seconds_total", "counter", "Time spent matching DELTA signatures against files"),
+]
+REQUEST_NAMES = {"LIST", "CATALOG", "DOWNLOAD", "STAT", "HASHES", "ZDOWNLOAD", "DELTA"}
+
+index_cache = {}  # đường dẫn file -> (kích thước, mtime, (SHA-256, băm từng khối, gốc Merkle))
+index_lock = threading.Lock()
+compress_cache = {}  # đường dẫn file -> (kích thước, mtime, có nén được không)
+compress_lock = threading.Lock()
+compress_pool = concurrent.futures.ThreadPoolExecutor(COMPRESS_WORKERS, thread_name_prefix="compress")  # zlib nhả GIL khi nén
+
+# các counter, gauge và histogram của server, xuất ra theo định dạng văn bản của Prometheus.
+# Mỗi metric được khai báo trước trong METRIC_DEFINITIONS; mỗi chuỗi số liệu được chọn bằng chuỗi nhãn,
+# ví dụ 'op="DOWNLOAD"'. Mỗi lần cập nhật chỉ giữ một khóa trong chốc lát, và chỉ cập nhật một lần
+# cho mỗi yêu cầu chứ không phải cho mỗi lần gửi
+class Metrics:
+    def __init__(self, definitions):
+        self.lock = threading.Lock()
+        self.definitions = {definition[0]: definition for definition in definitions}
+        self.values = {name: {} for name in self.definitions}  # tên -> nhãn -> giá trị
+
+    def inc(self, name, value=1, labels=""):
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels=""):
+        with self.lock:
+            self.values[name][labels] = value
+
+    # thêm một loạt mẫu vào histogram
+    def observe(self, name, samples, labels=""):
+        buckets = self.definitions[name][3]
+        with self.lock:
+            counts = self.values[name].setdefault(labels, [[0] * (len(buckets) + 1), 0.0, 0])
+            for sample in samples:
+                counts[0][bisect.bisect_left(buckets, sample)] += 1
+                counts[1] += sample
+                counts[2] += 1
+
+    # tên -> nhãn -> giá trị; histogram thành số mẫu cộng dồn theo từng ngưỡng, tổng và số mẫu
+    def snapshot(self):
+        with self.lock:
+            snapshot = {}
+            for name, series in self.values.items():
+                definition = self.definitions[name]
+                snapshot[name] = {}
+                for labels, value in series.items():
+                    if definition[1] == "histogram":
+                        bounds = [str(bound) for bound in definition[3]] + ["+Inf"]
+                        value = {"buckets": dict(zip(bounds, itertools.accumulate(value[0]))), "sum": value[1], "count": value[2]}
+                    snapshot[name][labels] = value
+            return snapshot
+
+    def render(self):
+        lines = []
+        for name, series in self.snapshot().items():
+            _, kind, help_text = self.definitions[name][:3]
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, value in sorted(series.items()):
+                if kind == "histogram":
+                    for bound, count in value["buckets"].items():
+                        lines.append(f'{name}_bucket{{{labels + "," if labels else ""}le="{bound}"}} {count}')
+                    suffix = f"{{{labels}}}" if labels else ""
+                    lines += [f"{name}_sum{suffix} {value['sum']}", f"{name}_count{suffix} {value['count']}"]
+                else:
+                    lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+# phục vụ metrics tại http://host:port/metrics từ một thread nền
+def start_metrics_server(host, port):
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode(FORMAT)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # không in một dòng cho mỗi lần scrape
+
+    try:
+        httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"Could not start the metrics endpoint on {host}:{port}: {e}")
+        return None
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"Serving metrics on http://{host}:{port}/metrics")
+    return httpd
+
+def count_request(name):
+    metrics.inc("tcp_requests_total", labels=f'op="{name if name in REQUEST_NAMES else "unknown"}"')
+
+# ghi lại một đoạn DOWNLOAD đã gửi xong
+def record_range(count, elapsed):
+    metrics.inc("tcp_bytes_sent_total", count)
+    metrics.observe("tcp_send_seconds", [elapsed])
+    if elapsed > 0:
+        metrics.observe("tcp_range_throughput_bytes_per_second", [count / elapsed])
+
+# số nguyên không dấu dạng LEB128: mỗi byte chứa 7 bit, bit cao cho biết còn byte tiếp theo
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+# mã hóa gọn danh sách file (giống LIST phân trang của server UDP): tên đã được sắp xếp nên mỗi mục chỉ
+# lưu số byte trùng với tên trước, độ dài phần còn lại, phần còn lại của tên và kích thước, các số đều là varint.
+# Mỗi trang bắt đầu lại từ đầu nên giải mã được độc lập
+def encode_list_pages(entries, page_bytes):
+    pages, page, previous = [], bytearray(), b""
+    for name, size in entries:
+        name = name.encode(FORMAT)
+        shared = 0
+        while shared < min(len(name), len(previous)) and name[shared] == previous[shared]:
+            shared += 1
+        entry = encode_varint(shared) + encode_varint(len(name) - shared) + name[shared:] + encode_varint(size)
+        if page and len(page) + len(entry) > page_bytes:
+            pages.append(bytes(page))
+            page, previous = bytearray(), b""
+            entry = encode_varint(0) + encode_varint(len(name)) + name + encode_varint(size)
+        page += entry
+        previous = name
+    if page or not pages:
+        pages.append(bytes(page))
+    return pages
+
+# danh sách file đang phục vụ, giữ trong bộ nhớ: tên -> (kích thước, mtime, SHA-256).
+# Một luồng nền quét lại thư mục mỗi CATALOG_INTERVAL giây và chỉ cập nhật những file đã thay đổi
+# (so kích thước và mtime), nên LIST / STAT được trả lời ngay từ bộ nhớ, không phải đọc đĩa.
+# Python không có sẵn inotify nên dùng cách hỏi vòng theo mtime, chạy được trên mọi hệ điều hành
+class Catalog:
+    def __init__(self, directory, exclude, on_change=None):
+        self.directory = directory
+        self.exclude = set(exclude)
+        self.on_change = on_change
+        self.entries = {}
+        self.listing = ""  # câu trả lời LIST dựng sẵn, dựng lại khi danh sách thay đổi
+        self.page_cache = {}  # tiền tố -> câu trả lời CATALOG đã mã hóa, xóa khi danh sách thay đổi
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.entries
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def items(self):
+        with self.lock:
+            return list(self.entries.items())
+
+    def scan(self):
+        found = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name in self.exclude or entry.name.startswith(".") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                found[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return found
+
+    def refresh(self):
+        found = self.scan()
+        with self.lock:
+            changed = [name for name, key in found.items() if self.entries.get(name, (None, None))[:2] != key]
+            removed = [name for name in self.entries if name not in found]
+            if not changed and not removed:
+                return
+            for name in removed:
+                del self.entries[name]
+            for name in changed:
+                self.entries[name] = found[name] + (None,)
+            self.listing = "\n".join(f"{name} {entry[0]}" for name, entry in sorted(self.entries.items()))
+            self.page_cache = {}
+        if self.on_change:
+            self.on_change(self)
+
+        # băm các file mới / bị sửa sau khi đã công bố chúng, file lớn không làm chậm việc cập nhật danh sách
+        for name in changed:
+            try:
+                digest = file_digest(os.path.join(self.directory, name))
+            except OSError:
+                continue  # file vừa bị xóa, lần quét sau sẽ bỏ nó khỏi danh sách
+            with self.lock:
+                if self.entries.get(name, (None, None))[:2] == found[name]:
+                    self.entries[name] = found[name] + (digest,)
+
+    # các file có tên bắt đầu bằng prefix: (số file, các trang đã mã hóa, mỗi trang có 4 byte độ dài phía trước
+    # và kết thúc bằng một trang rỗng). Chỉ mã hóa lại khi danh sách thay đổi
+    def catalog_pages(self, prefix=""):
+        with self.lock:
+            cached = self.page_cache.get(prefix)
+            if cached is None:
+                matches = [(name, entry[0]) for name, entry in sorted(self.entries.items()) if name.startswith(prefix)]
+                pages = encode_list_pages(matches, CATALOG_PAGE_BYTES)
+                cached = (len(matches), len(pages), b"".join(struct.pack("!I", len(page)) + page for page in pages) + struct.pack("!I", 0))
+                if len(self.page_cache) >= 64:
+                    self.page_cache = {}
+                self.page_cache[prefix] = cached
+            return cached
+
+    def catalog_reply(self, prefix=""):
+        count, page_count, pages = self.catalog_pages(prefix)
+        return f"OK {count} {page_count}\n".encode(FORMAT) + pages
+
+    def watch(self, interval=CATALOG_INTERVAL):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except OSError as e:
+                print(f"Error: {e}")
+
+    def start(self):
+        self.refresh()
+        threading.Thread(target=self.watch, daemon=True).start()
+        return self
+
+# ghi lại file_list.txt (tên và kích thước) mỗi khi danh sách thay đổi, để người dùng vẫn xem được
+def write_file_list(catalog):
+    with open(os.path.join(BASE_DIR, "file_list.txt"), "w") as f:
+        f.write(catalog.listing + "\n" if catalog.listing else "")
 
-# đọc lấy thông tin tên file, kích thước (theo BYTE)
 def list_files():
-    files = {}
-    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "file_list.txt"), "r") as f:
-        for line in f:
-            name, size = line.strip().split()
-            files[name] = size
-    return files
+    return Catalog(BASE_DIR, [os.path.basename(__file__), "file_list.txt"], write_file_list).start()
 
-def handle_client(conn, files):
-    while True:
+# gửi `count` byte của file bắt đầu từ `offset` mà không chép dữ liệu qua Python:
+# socket.sendfile dùng os.sendfile khi hệ điều hành hỗ trợ, nếu không thì tự gửi qua một buffer
+# nhỏ cố định, nên bộ nhớ server không phụ thuộc vào độ lớn của đoạn được yêu cầu
+def send_range(conn, file_path, offset, count):
+    started_at = time.perf_counter()
+    with open(file_path, "rb") as f:
+        sent = conn.sendfile(f, offset, count)
+    record_range(sent, time.perf_counter() - started_at)
+    return sent
+
+# như send_range nhưng trên event loop: loop.sendfile chỉ ghi khi socket còn chỗ (flow control) và khi không có
+# os.sendfile thì tự đọc/ghi qua một buffer nhỏ, nên bộ nhớ mỗi kết nối có giới hạn
+async def send_range_async(loop, writer, file_path, offset, count):
+    started_at = time.perf_counter()
+    with open(file_path, "rb") as f:
+        sent = await loop.sendfile(writer.transport, f, offset, count)
+    record_range(sent, time.perf_counter() - started_at)
+    return sent
+
+# đường dẫn file và số byte thực sự gửi được cho một yêu cầu DOWNLOAD:
+# không gửi quá cuối file, nếu không client sẽ chờ mãi phần còn thiếu
+def resolve_range(file_name, offset, chunk_size):
+    file_path = os.path.join(BASE_DIR, file_name)
+    return file_path, max(0, min(chunk_size, os.path.getsize(file_path) - offset))
+
+# gốc cây Merkle trên các giá trị băm của khối: băm từng cặp lên từng tầng, nút lẻ được đưa thẳng lên
+def merkle_root(hashes):
+    level = list(hashes) or [hashlib.sha256().digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(b"".join(level[i:i + 2])).digest() for i in range(0, len(level), 2)]
+    return level[0]
+
+# SHA-256 của cả file cùng SHA-256 của từng khối HASH_BLOCK byte và gốc Merkle, tính trong một lần đọc file.
+# Client dùng bảng băm để kiểm tra từng khối ngay khi nhận được. Chỉ tính lại khi kích thước hoặc mtime thay đổi
+def file_index(file_path):
+    stat = os.stat(file_path)
+    with index_lock:
+        cached = index_cache.get(file_path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    started_at = time.perf_counter()
+    digest = hashlib.sha256()
+    hashes = []
+    with open(file_path, "rb") as f:
+        while block := f.read(HASH_BLOCK):
+            digest.update(block)
+            hashes.append(hashlib.sha256(block).digest())
+    index = (digest.hexdigest(), hashes, merkle_root(hashes))
+    metrics.inc("tcp_index_seconds_total", time.perf_counter() - started_at)
+    with index_lock:
+        index_cache[file_path] = (stat.st_size, stat.st_mtime_ns, index)
+    return index
+
+def file_digest(file_path):
+    return file_index(file_path)[0]
+
+# file có đáng nén không: nén thử COMPRESS_SAMPLES mẫu rải đều trong file ở mức nhanh nhất, một lần cho mỗi
+# phiên bản của file (kết quả được cache theo kích thước và mtime)
+def compressible(file_path):
+    stat = os.stat(file_path)
+    with compress_lock:
+        cached = compress_cache.get(file_path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    sampled = packed = 0
+    with open(file_path, "rb") as f:
+        step = max(stat.st_size // COMPRESS_SAMPLES, COMPRESS_SAMPLE_SIZE)
+        for position in range(0, stat.st_size, step):
+            f.seek(position)
+            sample = f.read(COMPRESS_SAMPLE_SIZE)
+            sampled += len(sample)
+            packed += len(zlib.compress(sample, 1))
+    result = sampled > 0 and packed < sampled * COMPRESS_THRESHOLD
+    with compress_lock:
+        compress_cache[file_path] = (stat.st_size, stat.st_mtime_ns, result)
+    return result
+
+# cache dùng chung cho cả server, giới hạn theo số byte. Khóa gồm file, kích thước, mtime và vị trí nên file bị sửa
+# không bao giờ bị gửi từ dữ liệu cũ (dữ liệu cũ tự bị đẩy ra dần). Loại bỏ theo LRU hai đoạn: khúc mới vào đoạn
+# "thử" và chỉ sang đoạn "bảo vệ" khi được dùng lại, nên một client tải một file lớn một lần không đẩy được các
+# file mà ai cũng tải ra khỏi cache. Nhiều kết nối cùng thiếu một khúc thì chỉ một kết nối đọc và nén, số còn lại chờ
+class BlockCache:
+    def __init__(self, capacity):
+        self.capacity = capacity  # 0: không giữ gì, lần nào cũng đọc lại
+        self.probation = collections.OrderedDict()  # khóa -> dữ liệu, cái lâu nhất chưa dùng đứng đầu
+        self.protected = collections.OrderedDict()
+        self.protected_bytes = 0
+        self.size = 0
+        self.loading = {}  # khóa -> Event, được set khi kết nối đang đọc khúc đó làm xong
+        self.lock = threading.Lock()
+
+    # dữ liệu của `key`, gọi load() để tạo ra khi chưa có
+    def get(self, key, load):
+        while True:
+            with self.lock:
+                block = self.lookup(key)
+                loading = self.loading.get(key) if block is None else None
+                if block is None and loading is None:
+                    self.loading[key] = threading.Event()
+            if block is not None:
+                metrics.inc("tcp_cache_requests_total", labels='result="hit"')
+                return block
+            if loading is None:
+                break
+            loading.wait()  # kết nối khác đang đọc khúc này; nếu nó lỗi thì thử lại
+
+        metrics.inc("tcp_cache_requests_total", labels='result="miss"')
         try:
-            data = conn.recv(1024).decode(FORMAT).strip()
-            if not data:
+            block = load()
+            with self.lock:
+                evicted = self.insert(key, block)
+            if evicted:
+                metrics.inc("tcp_cache_evictions_total", evicted)
+            metrics.set("tcp_cache_bytes", self.size)
+            return block
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    # gọi khi đang giữ khóa. Dùng lại lần hai thì khúc sang đoạn bảo vệ; đoạn bảo vệ vượt phần của nó thì
+    # trả các khúc lâu nhất chưa dùng về đoạn thử
+    def lookup(self, key):
+        block = self.protected.get(key)
+        if block is not None:
+            self.protected.move_to_end(key)
+            return block
+        block = self.probation.pop(key, None)
+        if block is not None:
+            self.protected[key] = block
+            self.protected_bytes += len(block)
+            while self.protected_bytes > self.capacity * CACHE_PROTECTED:
+                demoted, data = self.protected.popitem(last=False)
+                self.protected_bytes -= len(data)
+                self.probation[demoted] = data
+        return block
+
+    # gọi khi đang giữ khóa; trả về số khúc bị loại
+    def insert(self, key, block):
+        if len(block) > self.capacity or key in self.probation or key in self.protected:
+            return 0
+        self.probation[key] = block
+        self.size += len(block)
+        evicted = 0
+        while self.size > self.capacity:
+            segment = self.probation or self.protected
+            _, data = segment.popitem(last=False)
+            self.size -= len(data)
+            if segment is self.protected:
+                self.protected_bytes -= len(data)
+            evicted += 1
+        return evicted
+
+block_cache = BlockCache(CACHE_SIZE)
+
+# một khúc của câu trả lời ZDOWNLOAD; khúc nén không nhỏ hơn thì gửi nguyên
+def compress_chunk(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+    packed = compressor.compress(data) + compressor.flush()
+    if len(packed) < len(data):
+        return struct.pack(CHUNK_FORMAT, CODEC_DEFLATE, len(data), len(packed)) + packed
+    return struct.pack(CHUNK_FORMAT, CODEC_RAW, len(data), len(data)) + data
+
+def read_and_compress(file_path, start, end, level):
+    with open(file_path, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+    chunk = compress_chunk(data, level)
+    metrics.inc("tcp_compression_bytes_total", len(data), 'stage="in"')
+    metrics.inc("tcp_compression_bytes_total", len(chunk), 'stage="out"')
+    return chunk
+
+# nén `count` byte từ `offset`, song song trên compress_pool. Các khúc được cắt theo ranh giới COMPRESS_CHUNK tính
+# từ đầu file, nên khi nhiều client tải cùng một file thì mỗi khúc trọn vẹn chỉ bị đọc và nén một lần rồi lấy từ
+# block_cache; khúc lẻ ở hai đầu đoạn thì nén riêng. DOWNLOAD thường vẫn dùng sendfile: page cache của hệ điều
+# hành đã là cache khối dùng chung, lại không phải chép dữ liệu qua Python
+def compress_range(file_path, offset, count, level):
+    started_at = time.perf_counter()
+    stat = os.stat(file_path)
+    end = offset + count
+    bounds = [offset, *range((offset // COMPRESS_CHUNK + 1) * COMPRESS_CHUNK, end, COMPRESS_CHUNK), end]
+
+    def chunk(start, stop):
+        if stop - start < COMPRESS_CHUNK and stop < stat.st_size:
+            return read_and_compress(file_path, start, stop, level)
+        key = (file_path, stat.st_size, stat.st_mtime_ns, start, level)
+        return block_cache.get(key, lambda: read_and_compress(file_path, start, stop, level))
+
+    body = b"".join(compress_pool.map(chunk, bounds[:-1], bounds[1:]))
+    metrics.inc("tcp_compress_seconds_total", time.perf_counter() - started_at)
+    return body
+
+# so file với chữ ký các khối bản cũ của client theo kiểu rsync, trả về các đoạn (vị trí, khối đầu, số khối) mà
+# client chép được từ bản cũ; phần còn lại client tải bằng DOWNLOAD như thường. Khối ở đúng chỗ được nhận ra
+# bằng BLAKE2b; sau một chỗ khác nhau thì cuộn adler32 từng byte để tìm chỗ trùng kể cả khi dữ liệu bị dịch đi
+def delta_runs(file_path, block_size, signatures):
+    started_at = time.perf_counter()
+    weak = set()
+    strong = {}  # BLAKE2b -> khối đầu tiên có nội dung đó
+    for index, (checksum, digest) in enumerate(signatures):
+        weak.add(checksum)
+        strong.setdefault(digest, index)
+    size = os.path.getsize(file_path)
+    last = size - block_size  # vị trí cuối cùng còn đủ một khối
+    runs = []
+    if last < 0 or not signatures:
+        metrics.inc("tcp_delta_bytes_total", size, 'result="literal"')
+        return runs
+
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        def match(position):
+            return strong.get(hashlib.blake2b(data[position:position + block_size], digest_size=16).digest())
+
+        def add(position, index):
+            if runs and runs[-1][0] + runs[-1][2] * block_size == position and runs[-1][1] + runs[-1][2] == index:
+                runs[-1][2] += 1
+            else:
+                runs.append([position, index, 1])
+
+        # vị trí đầu tiên trong [first, end) có adler32 rồi BLAKE2b trùng với một khối của client
+        def roll(first, end):
+            checksum = zlib.adler32(data[first:first + block_size])
+            a, b = checksum & 0xFFFF, checksum >> 16
+            position = first
+            while True:
+                if b << 16 | a in weak:
+                    index = match(position)
+                    if index is not None:
+                        return position, index
+                position += 1
+                if position >= end:
+                    return None
+                old, new = data[position - 1], data[position + block_size - 1]
+                a = (a - old + new) % 65521
+                b = (b - block_size * old + a - 1) % 65521
+
+        position = 0
+        while position <= last:
+            index = match(position)
+            if index is not None:
+                add(position, index)
+                position += block_size
+                continue
+            windows = itertools.chain([(position + 1, position + 1 + DELTA_SEARCH)],
+                                      ((start, start + block_size) for start in range(position + 1 + DELTA_SEARCH, last + 1, DELTA_STRIDE)))
+            found = next(filter(None, (roll(first, min(end, last + 1)) for first, end in windows if first <= last)), None)
+            if found is None:
                 break
+            # các khối ngay trước chỗ bắt lại được, bị bỏ qua khi nhảy cóc, cũng có thể trùng
+            found_at, index = found
+            behind = []
+            start = found_at - block_size
+            while start > position and (previous := match(start)) is not None:
+                behind.append((start, previous))
+                start -= block_size
+            for start, previous in reversed(behind):
+                add(start, previous)
+            add(found_at, index)
+            position = found_at + block_size
 
-            request, *others = data.split()
+    matched = sum(count for _, _, count in runs) * block_size
+    metrics.inc("tcp_delta_bytes_total", matched, 'result="matched"')
+    metrics.inc("tcp_delta_bytes_total", size - matched, 'result="literal"')
+    metrics.inc("tcp_delta_seconds_total", time.perf_counter() - started_at)
+    return runs
 
-            if request == "LIST": # get líst of files on server
-                file_list = "\n".join(f"{name} {size}" for name, size in files.items())
-                conn.send(file_list.encode(FORMAT))
+# trả lời STAT: kích thước, mtime (ns) và SHA-256 để client biết phần đã tải dở có còn khớp với file
+# trên server không trước khi tải tiếp
+def stat_reply(file_name, files):
+    entry = files.get(file_name)
+    if entry is None:
+        return f"ERROR: {file_name} not found\n".encode(FORMAT)
+    size, mtime, digest = entry
+    # SHA-256 chưa được luồng nền tính xong thì tính luôn (kết quả được cache)
+    return f"OK {size} {mtime} {digest or file_digest(os.path.join(BASE_DIR, file_name))}\n".encode(FORMAT)
 
-            elif request == "DOWNLOAD": # download a file
-                file_name, offset, chunk_size = others
-            
-                offset = int(offset)
-                chunk_size = int(chunk_size) 
+# trả lời HASHES: một dòng "OK <cỡ khối> <số khối> <gốc Merkle>" rồi 32 byte băm của từng khối
+def hashes_reply(file_name, files):
+    if file_name not in files:
+        return f"ERROR: {file_name} not found\n".encode(FORMAT)
+    _, hashes, root = file_index(os.path.join(BASE_DIR, file_name))
+    return f"OK {HASH_BLOCK} {len(hashes)} {root.hex()}\n".encode(FORMAT) + b"".join(hashes)
 
-                if file_name in files:
-                    with open(file_name, "rb") as f:
-                        f.seek(offset)
-                        chunk_to_send = f.read(chunk_size)
-                        conn.send(chunk_to_send)
-                else:
-                    conn.send(f"ERROR: {file_name} not found")
+def pack_frame(opcode, request_id, status, length):
+    return struct.pack(FRAME_FORMAT, opcode, request_id, length, status)
+
+# trả lời một yêu cầu đóng khung: (trạng thái, payload, đoạn file cần gửi sau payload hoặc None)
+def framed_reply(opcode, payload, files):
+    count_request(OP_NAMES.get(opcode))
+    if opcode == OP_LIST:
+        return STATUS_OK, files.listing.encode(FORMAT), None
+
+    if opcode == OP_CATALOG:
+        count, _, pages = files.catalog_pages(payload.decode(FORMAT))
+        return STATUS_OK, struct.pack("!I", count) + pages, None
+
+    if opcode == OP_DOWNLOAD:
+        if len(payload) < 16:
+            return STATUS_BAD_REQUEST, b"DOWNLOAD needs an offset, a length and a file name", None
+        offset, count = struct.unpack("!Q Q", payload[:16])
+        file_name = payload[16:].decode(FORMAT)
+        if file_name not in files:
+            return STATUS_NOT_FOUND, f"{file_name} not found".encode(FORMAT), None
+        file_path, count = resolve_range(file_name, offset, count)
+        return STATUS_OK, b"", (file_path, offset, count)
+
+    if opcode == OP_ZDOWNLOAD:
+        if len(payload) < 17:
+            return STATUS_BAD_REQUEST, b"ZDOWNLOAD needs an offset, a length, a level and a file name", None
+        offset, count, level = struct.unpack("!Q Q B", payload[:17])
+        file_name = payload[17:].decode(FORMAT)
+        if file_name not in files:
+            return STATUS_NOT_FOUND, f"{file_name} not found".encode(FORMAT), None
+        if not 1 <= level <= 9:
+            return STATUS_BAD_REQUEST, f"compression level {level} is not 1-9".encode(FORMAT), None
+        file_path, count = resolve_range(file_name, offset, count)
+        if count > MAX_ZDOWNLOAD:
+            return STATUS_BAD_REQUEST, f"ZDOWNLOAD ranges are at most {MAX_ZDOWNLOAD} bytes".encode(FORMAT), None
+        if count > 0 and compressible(file_path):
+            return STATUS_OK, compress_range(file_path, offset, count, level), None
+        # file không nén được: một khúc nguyên, vẫn gửi bằng sendfile
+        metrics.inc("tcp_compression_skipped_total")
+        return STATUS_OK, struct.pack(CHUNK_FORMAT, CODEC_RAW, count, count) if count else b"", (file_path, offset, count)
+
+    if opcode == OP_DELTA:
+        if len(payload) < 8:
+            return STATUS_BAD_REQUEST, b"DELTA needs a block size, a block count, the signatures and a file name", None
+        block_size, count = struct.unpack("!I I", payload[:8])
+        end = 8 + count * struct.calcsize(DELTA_SIGNATURE)
+        file_name = payload[end:].decode(FORMAT)
+        if block_size == 0 or len(payload) < end:
+            return STATUS_BAD_REQUEST, b"bad DELTA signatures", None
+        if file_name not in files:
+            return STATUS_NOT_FOUND, f"{file_name} not found".encode(FORMAT), None
+        signatures = list(struct.iter_unpack(DELTA_SIGNATURE, payload[8:end]))
+        runs = delta_runs(os.path.join(BASE_DIR, file_name), block_size, signatures)
+        return STATUS_OK, b"".join(struct.pack(DELTA_RUN, *run) for run in runs), None
+
+    if opcode in (OP_STAT, OP_HASHES):
+        file_name = payload.decode(FORMAT)
+        entry = files.get(file_name)
+        if entry is None:
+            return STATUS_NOT_FOUND, f"{file_name} not found".encode(FORMAT), None
+        digest, hashes, root = file_index(os.path.join(BASE_DIR, file_name))
+        if opcode == OP_STAT:
+            return STATUS_OK, struct.pack("!Q Q", entry[0], entry[1]) + bytes.fromhex(entry[2] or digest), None
+        return STATUS_OK, struct.pack("!I", HASH_BLOCK) + root + b"".join(hashes), None
+
+    return STATUS_BAD_REQUEST, f"unknown opcode {opcode}".encode(FORMAT), None
+
+# phục vụ một kết nối đóng khung: đọc lần lượt từng yêu cầu và trả lời theo đúng thứ tự,
+# client có thể gửi nhiều yêu cầu liền nhau mà không cần chờ
+def handle_framed_client(conn, files):
+    reader = conn.makefile("rb")
+    try:
+        if reader.read(len(FRAME_MAGIC)) != FRAME_MAGIC:
+            return
+        while True:
+            header = reader.read(FRAME_SIZE)
+            if len(header) < FRAME_SIZE:
+                return
+            opcode, request_id, length, _ = struct.unpack(FRAME_FORMAT, header)
+            if length > MAX_PAYLOADS.get(opcode, MAX_REQUEST_PAYLOAD):
+                conn.sendall(pack_frame(opcode, request_id, STATUS_BAD_REQUEST, 0))
+                return  # không đọc bỏ được payload quá lớn, phải đóng kết nối
+            payload = reader.read(length)
+            if len(payload) < length:
+                return
+
+            try:
+                status, body, file_range = framed_reply(opcode, payload, files)
+            except (OSError, ValueError) as e:
+                status, body, file_range = STATUS_ERROR, str(e).encode(FORMAT), None
+            if status != STATUS_OK:
+                metrics.inc("tcp_errors_total", labels=f'status="{status}"')
+            if file_range is None:
+                conn.sendall(pack_frame(opcode, request_id, status, len(body)) + body)
+            else:
+                file_path, offset, count = file_range
+                conn.sendall(pack_frame(opcode, request_id, status, len(body) + count) + body)
+                if count > 0:
+                    send_range(conn, file_path, offset, count)
+    finally:
+        reader.close()
+
+# tách các yêu cầu trong buffer. Client mới kết thúc mỗi yêu cầu bằng "\n" và có thể gửi nhiều yêu cầu
+# liền nhau (pipelining); client cũ gửi mỗi lệnh trong một lần send và không có "\n", nên khi kết nối
+# chưa từng gửi "\n" thì phần còn lại vẫn được coi là một yêu cầu nếu đã đủ tham số.
+# Trả về các cặp (yêu cầu, có "\n" hay không) và phần dư.
+def split_requests(buffer, legacy):
+    *lines, rest = buffer.split(b"\n")
+    requests = [(line.decode(FORMAT).strip(), True) for line in lines if line.strip()]
+    words = rest.split()
+    if legacy and not lines and words and (words[0] == b"LIST" or (words[0] == b"DOWNLOAD" and len(words) == 4)):
+        requests.append((rest.decode(FORMAT).strip(), False))
+        rest = b""
+    return requests, rest
+
+# trả lời LIST: client mới (yêu cầu có "\n") cần một dòng trống ở cuối để biết danh sách đã hết,
+# vì kết nối còn được dùng tiếp cho các yêu cầu sau
+def list_reply(files, terminated):
+    reply = files.listing
+    return (reply + "\n\n" if terminated else reply).encode(FORMAT)
+
+def handle_request(conn, data, terminated, files):
+    request, *others = data.split()
+    count_request(request)
+
+    if request == "LIST": # get líst of files on server
+        conn.sendall(list_reply(files, terminated))
+
+    elif request == "DOWNLOAD": # download a file
+        file_name, offset, chunk_size = others
+
+        offset = int(offset)
+        chunk_size = int(chunk_size)
+
+        if file_name in files:
+            file_path, chunk_size = resolve_range(file_name, offset, chunk_size)
+            if chunk_size > 0:  # sendfile hiểu count = 0 là gửi tới hết file
+                send_range(conn, file_path, offset, chunk_size)
+        else:
+            conn.send(f"ERROR: {file_name} not found".encode(FORMAT))
+
+    elif request == "STAT": # size, mtime and digest of a file
+        conn.sendall(stat_reply(others[0], files))
+
+    elif request == "HASHES": # block hashes of a file
+        conn.sendall(hashes_reply(others[0], files))
+
+    elif request == "CATALOG": # paged, compact list of files, optionally only names starting with a prefix
+        conn.sendall(files.catalog_reply(others[0] if others else ""))
+
+def handle_client(conn, files):
+    buffer = b""
+    legacy = True  # cho tới khi client gửi yêu cầu đầu tiên có "\n"
+    try:
+        # xem trước byte đầu tiên để chọn giao thức mà không lấy nó ra khỏi socket
+        if conn.recv(1, socket.MSG_PEEK) == FRAME_MAGIC[:1]:
+            handle_framed_client(conn, files)
+            conn.close()
+            return
+    except OSError as e:
+        print(f"Error: {e}")
+        conn.close()
+        return
+
+    while True:
+        try:
+            data = conn.recv(1024)
+            if not data:
+                break
+
+            requests, buffer = split_requests(buffer + data, legacy)
+            legacy = legacy and not any(terminated for _, terminated in requests)
+            for request, terminated in requests:
+                handle_request(conn, request, terminated, files)
 
         except Exception as e:
             print(f"Error: {e}")
@@ -48,18 +786,26 @@ def handle_client(conn, files):
 
     conn.close()
 
+def serve_connection(conn, files):
+    metrics.inc("tcp_connections_total")
+    metrics.inc("tcp_active_connections")
+    try:
+        handle_client(conn, files)
+    finally:
+        metrics.inc("tcp_active_connections", -1)
+
 def start_server():
     files = list_files()
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.bind((HOST, PORT))
-    server.listen(30)
+    server.listen(BACKLOG)
     print(f"Server listening on {HOST}:{PORT}")
 
     try:
         while True:
             conn, addr = server.accept()
             print(f"Accepted connection from {addr}")
-            client_handler = threading.Thread(target=handle_client, args=(conn, files))
+            client_handler = threading.Thread(target=serve_connection, args=(conn, files))
             client_handler.start()
     except KeyboardInterrupt:
         print("Shutting down server...")
@@ -67,5 +813,179 @@ def start_server():
         server.close()
         print("Server stopped.")
 
+# cùng giao thức LIST/DOWNLOAD như handle_client, nhưng là một coroutine trên event loop thay vì một thread
+async def handle_request_async(loop, writer, data, terminated, files):
+    request, *others = data.split()
+    count_request(request)
+
+    if request == "LIST":
+        writer.write(list_reply(files, terminated))
+        await writer.drain()
+
+    elif request == "DOWNLOAD":
+        file_name, offset, chunk_size = others
+        offset = int(offset)
+        chunk_size = int(chunk_size)
+
+        if file_name in files:
+            file_path, chunk_size = resolve_range(file_name, offset, chunk_size)
+            if chunk_size > 0:
+                await send_range_async(loop, writer, file_path, offset, chunk_size)
+        else:
+            writer.write(f"ERROR: {file_name} not found".encode(FORMAT))
+            await writer.drain()
+
+    elif request == "STAT":
+        # băm cả file có thể mất vài giây, không được chặn event loop
+        writer.write(await loop.run_in_executor(None, stat_reply, others[0], files))
+        await writer.drain()
+
+    elif request == "HASHES":
+        writer.write(await loop.run_in_executor(None, hashes_reply, others[0], files))
+        await writer.drain()
+
+    elif request == "CATALOG":
+        writer.write(files.catalog_reply(others[0] if others else ""))
+        await writer.drain()
+
+async def handle_framed_client_async(loop, reader, writer, files):
+    if await reader.readexactly(len(FRAME_MAGIC) - 1) != FRAME_MAGIC[1:]:
+        return
+    while True:
+        try:
+            header = await reader.readexactly(FRAME_SIZE)
+        except asyncio.IncompleteReadError:
+            return
+        opcode, request_id, length, _ = struct.unpack(FRAME_FORMAT, header)
+        if length > MAX_PAYLOADS.get(opcode, MAX_REQUEST_PAYLOAD):
+            writer.write(pack_frame(opcode, request_id, STATUS_BAD_REQUEST, 0))
+            await writer.drain()
+            return
+        payload = await reader.readexactly(length)
+
+        try:
+            if opcode in (OP_STAT, OP_HASHES, OP_ZDOWNLOAD, OP_DELTA):
+                # băm cả file, nén một đoạn hay so chữ ký có thể mất khá lâu, không được chặn event loop
+                status, body, file_range = await loop.run_in_executor(None, framed_reply, opcode, payload, files)
+            else:
+                status, body, file_range = framed_reply(opcode, payload, files)
+        except (OSError, ValueError) as e:
+            status, body, file_range = STATUS_ERROR, str(e).encode(FORMAT), None
+        if status != STATUS_OK:
+            metrics.inc("tcp_errors_total", labels=f'status="{status}"')
+        if file_range is None:
+            writer.write(pack_frame(opcode, request_id, status, len(body)) + body)
+            await writer.drain()
+        else:
+            file_path, offset, count = file_range
+            writer.write(pack_frame(opcode, request_id, status, len(body) + count) + body)
+            if count > 0:
+                await send_range_async(loop, writer, file_path, offset, count)
+            else:
+                await writer.drain()
+
+async def handle_client_async(reader, writer, files):
+    loop = asyncio.get_running_loop()
+    buffer = b""
+    legacy = True
+    try:
+        first = await reader.read(1)
+        if first == FRAME_MAGIC[:1]:
+            await handle_framed_client_async(loop, reader, writer, files)
+            return
+        data = first
+        while data:
+            requests, buffer = split_requests(buffer + data, legacy)
+            legacy = legacy and not any(terminated for _, terminated in requests)
+            for request, terminated in requests:
+                await handle_request_async(loop, writer, request, terminated, files)
+            data = await reader.read(1024)
+
+    except asyncio.IncompleteReadError:
+        pass
+    except (ConnectionError, ValueError, OSError) as e:
+        print(f"Error: {e}")
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+# mỗi kết nối chỉ tốn một task và một file descriptor, nên nâng giới hạn số file được mở lên mức tối đa
+def raise_open_file_limit():
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    try:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ValueError, OSError):
+        pass
+
+async def serve_async(files):
+    clients = set()
+
+    async def on_connect(reader, writer):
+        print(f"Accepted connection from {writer.get_extra_info('peername')}")
+        task = asyncio.current_task()
+        clients.add(task)
+        metrics.inc("tcp_connections_total")
+        metrics.inc("tcp_active_connections")
+        try:
+            await handle_client_async(reader, writer, files)
+        finally:
+            clients.discard(task)
+            metrics.inc("tcp_active_connections", -1)
+
+    server = await asyncio.start_server(on_connect, HOST, PORT, backlog=BACKLOG)
+    print(f"Server listening on {HOST}:{PORT} (asyncio)")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except (NotImplementedError, AttributeError):
+            pass  # Windows: Ctrl + C vẫn dừng server qua KeyboardInterrupt
+
+    await stop.wait()
+
+    # tắt êm: ngừng nhận kết nối mới, chờ các lượt tải đang chạy rồi mới đóng những kết nối còn lại
+    print("Shutting down server...")
+    server.close()
+    if clients:
+        _, pending = await asyncio.wait(clients, timeout=SHUTDOWN_TIMEOUT)
+        for task in pending:
+            task.cancel()
+        await asyncio.gather(*pending, return_exceptions=True)
+    await server.wait_closed()
+    print("Server stopped.")
+
+def start_async_server():
+    files = list_files()
+    raise_open_file_limit()
+    try:
+        asyncio.run(serve_async(files))
+    except KeyboardInterrupt:
+        print("Server stopped.")
+
 if __name__ == "__main__":
-    start_server()
+    parser = argparse.ArgumentParser(description="TCP file server (LIST / CATALOG / DOWNLOAD / ZDOWNLOAD / DELTA / STAT / HASHES)")
+    parser.add_argument("--async", dest="use_async", action="store_true", help="serve all connections from one asyncio event loop instead of one thread each")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--dir", default=BASE_DIR, help="directory holding the files to serve")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="port of the Prometheus /metrics endpoint, 0 to disable it")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE // (1024 * 1024), help="MB of compressed ZDOWNLOAD chunks shared between connections, 0 to disable the cache")
+    args = parser.parse_args()
+    HOST, PORT, BASE_DIR = args.host, args.port, os.path.abspath(args.dir)
+    block_cache.capacity = max(args.cache_size, 0) * 1024 * 1024
+
+    metrics.set("tcp_active_connections", 0)
+    if args.metrics_port:
+        start_metrics_server(HOST, args.metrics_port)
+
+    if args.use_async:
+        start_async_server()
+    else:
+        start_server()
@@ -1,101 +1,1270 @@
 import socket
 import os
 import struct
+import time
+import threading
+import queue
+import zlib
+import hashlib
+import mmap
+import bisect
+import itertools
+import http.server
+import argparse
+import collections
+import contextlib
+import sys
 
 HOST = "127.0.0.1"  # Loopback IP address
 PORT = 65432
 BUFFER_SIZE = 1024
-CHUNK_SIZE = 1015  # Adjusted to account for header size (9 bytes)
+CHUNK_SIZE = 1007  # Adjusted to account for header size (17 bytes); the default for clients that do not ask for PAYLOAD:<n>
+MAX_DATAGRAM = 65507  # Largest UDP payload over IPv4
+SOCKET_BUFFER = 4 * 1024 * 1024  # SO_SNDBUF / SO_RCVBUF asked for, so bursts of large datagrams are not dropped locally
+IP_MTU_DISCOVER = 10  # Linux values, the socket module does not export them: send with Don't Fragment set,
+IP_PMTUDISC_PROBE = 3  # so a PROBE reply larger than the path MTU is dropped instead of arriving in pieces
 FORMAT = "utf-8"
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))  # Server directory
-TIMEOUT = 2  # Retransmission timeout (in seconds)
+TIMEOUT = 2  # Idle timeout of the main receive loop (in seconds)
+CATALOG_INTERVAL = 2  # How often the file catalog looks for new, changed or deleted files (in seconds)
+INITIAL_RTO = 1  # Retransmission timeout until the first RTT sample (in seconds)
+MIN_RTO = 0.01  # Bounds for the adaptive retransmission timeout (in seconds)
+MAX_RTO = 10
+WINDOW_SIZE = 256  # Maximum number of unacknowledged packets in flight (selective repeat)
+CONGESTION_CONTROL = "aimd"  # Default controller, a client may ask for another with CC:<name>
+INITIAL_CWND = 10  # Congestion window before any ACK has arrived (in packets)
+MIN_CWND = 2
+LOSS_THRESHOLD = 3  # A packet is lost once a packet sent 3 places after it has been ACKed
+PACING_QUANTUM = 0.001  # Packets due within this many seconds go out together (sleep granularity)
+CC_LOG_INTERVAL = 1  # How often each session logs its window and rate (in seconds)
+MAX_RETRIES = 10  # Abort a transfer after a packet has timed out this many times
+MAX_FEC_GROUP = 64  # Largest group a client may ask for with FEC:<n>, one parity packet per n data packets
+HEADER_FORMAT = "!B I I I I"  # packet type, transfer_id, seq_num, chunk_len, checksum
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ACK_FORMAT = "!B I I I B"  # packet type, transfer_id, seq_num, next expected seq_num (cumulative), status
+ACK_SIZE = struct.calcsize(ACK_FORMAT)
+PKT_DATA = 1  # Binary packets start with a type byte so they never look like text commands
+PKT_ACK = 2
+PKT_PARITY = 3  # XOR of a group of data packets; seq_num is the group number (forward error correction)
+PKT_ZDATA = 4  # Data packet whose payload is the raw-deflated chunk, only sent to clients that ask with COMPRESS:<level>
+ACK_OK = 0
+ACK_CORRUPT = 1  # The client received seq_num but the checksum did not match
+HASH_BLOCK = 1024 * 1024  # Size of the blocks in a file's hash index
+INDEX_PAGE = 20  # Block hashes per HASHES reply, so each page fits in one 1 KB datagram
+DELTA_SIGNATURE = "!I 16s"  # adler32 (rolls byte by byte) and 16-byte BLAKE2b of one block of the client's old copy
+DELTA_SIGNATURE_SIZE = struct.calcsize(DELTA_SIGNATURE)
+DELTA_RUN = "!Q I I"  # Position in the served file, first block of the client's old copy, number of blocks in a row
+DELTA_RUN_PAGE = 56  # Runs per DELTA reply, so each page fits in one 1 KB datagram
+DELTA_MAX_BLOCKS = 128 * 1024  # Most signatures a single DELTA may send
+DELTA_SEARCH = 256 * 1024  # After a difference, every position this far on is tried to find the next match
+DELTA_STRIDE = 1024 * 1024  # Further on only one block-sized window per DELTA_STRIDE bytes is tried, so unrelated files cost little CPU
+DELTA_TTL = 60  # DELTA comparisons are forgotten this long after the client last asked about them (in seconds)
+MAX_DELTA_JOBS = 64  # DELTA comparisons kept at once
+LIST_PAGE_BYTES = 900  # Encoded catalog entries per LIST page, so each page fits in one 1 KB datagram
+COMPRESS_AHEAD = 512  # Chunks a transfer's compressor thread may have ready ahead of its send loop
+COMPRESS_SAMPLES = 8  # Evenly spread samples compressed to tell whether a file is worth compressing
+COMPRESS_SAMPLE_SIZE = 16 * 1024
+COMPRESS_THRESHOLD = 0.9  # Files whose samples do not shrink below this (.zip, .jpg...) are sent as they are
+CACHE_SIZE = 64 * 1024 * 1024  # Bytes of file data kept in memory for every transfer to share, 0 to read each chunk from disk
+CACHE_BLOCK = 1024 * CHUNK_SIZE  # Cached blocks are whole numbers of chunks, so most chunks come from a single block
+CACHE_PROTECTED = 0.8  # Share of the cache kept for blocks read more than once
+METRICS_PORT = 9433  # Local Prometheus scrape endpoint, http://HOST:METRICS_PORT/metrics
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+THROUGHPUT_BUCKETS = (1e5, 1e6, 1e7, 1e8, 1e9)  # Bytes per second
+METRIC_DEFINITIONS = [
+    ("udp_requests_total", "counter", "Control messages received, by type"),
+    ("udp_transfers_total", "counter", "Finished transfers, by result"),
+    ("udp_active_sessions", "gauge", "Transfers in progress"),
+    ("udp_packets_sent_total", "counter", "Data packets sent, retransmissions included"),
+    ("udp_bytes_sent_total", "counter", "Payload bytes sent, retransmissions included"),
+    ("udp_retransmits_total", "counter", "Data packets sent again, by reason"),
+    ("udp_parity_packets_sent_total", "counter", "FEC parity packets sent"),
+    ("udp_compressed_packets_sent_total", "counter", "Data packets sent compressed, retransmissions included"),
+    ("udp_compression_saved_bytes_total", "counter", "Payload bytes compression kept off the wire (first transmissions)"),
+    ("udp_compression_skipped_total", "counter", "Transfers that asked for compression of a file that does not compress"),
+    ("udp_acks_received_total", "counter", "ACKs handed to a transfer"),
+    ("udp_rtt_seconds", "histogram", "Round-trip time samples (packets sent exactly once)", SECONDS_BUCKETS),
+    ("udp_ack_latency_seconds", "histogram", "Time between the receive loop getting an ACK and its transfer processing it", SECONDS_BUCKETS),
+    ("udp_transfer_throughput_bytes_per_second", "histogram", "Average throughput of each finished transfer", THROUGHPUT_BUCKETS),
+    ("udp_disk_read_seconds_total", "counter", "Time spent reading file data for data packets"),
+    ("udp_cache_requests_total", "counter", "Block cache lookups, by result (a miss is one disk read)"),
+    ("udp_cache_evictions_total", "counter", "Blocks dropped from the block cache to make room"),
+    ("udp_cache_bytes", "gauge", "File bytes held in the block cache"),
+    ("udp_socket_send_seconds_total", "counter", "Time spent sending data packets"),
+    ("udp_delta_bytes_total", "counter", "DELTA file bytes the client already had (result=\"matched\") and has to download (result=\"literal\")"),
+    ("udp_delta_seconds_total", "counter", "Time spent matching DELTA signatures against files"),
+]
 
-# Update list.txt with files in the Server directory
-def update_file_list():
-    files = [f for f in os.listdir(BASE_DIR) if os.path.isfile(os.path.join(BASE_DIR, f))]
-    filtered_files = [file for file in files if file not in ["server.py", "list.txt"]]
-    
+index_cache = {}  # file_path -> (size, mtime_ns, (SHA-256 hex digest, block hashes, Merkle root))
+index_lock = threading.Lock()
+compress_cache = {}  # file_path -> (size, mtime_ns, whether the file compresses)
+compress_lock = threading.Lock()
+
+sessions = {}  # (client_addr, transfer_id) -> Session, one per transfer in progress
+sessions_lock = threading.Lock()
+
+delta_jobs = {}  # (client_addr, ID) -> DeltaJob, signatures being received or matched
+delta_lock = threading.Lock()
+
+# Update list.txt with files in the Server directory, called whenever the catalog changes
+def update_file_list(catalog):
     with open(os.path.join(BASE_DIR, "list.txt"), "w") as f:
-        for file in filtered_files:
+        for file, _ in catalog.items():
             f.write(file + "\n")
-    
-    return filtered_files
+
+class Metrics:
+    """Counters, gauges and histograms, exported in the Prometheus text format or as plain data.
+
+    Every metric is declared up front as (name, type, help[, buckets]); a series is picked by its
+    label string, e.g. 'reason="timeout"'. Each update takes one lock, so per-packet loops keep
+    their own tallies and hand them over in batches.
+    """
+
+    def __init__(self, definitions):
+        self.lock = threading.Lock()
+        self.definitions = {definition[0]: definition for definition in definitions}
+        self.values = {name: {} for name in self.definitions}  # name -> labels -> value
+
+    def inc(self, name, value=1, labels=""):
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels=""):
+        with self.lock:
+            self.values[name][labels] = value
+
+    def observe(self, name, samples, labels=""):
+        """Add a batch of samples to a histogram."""
+        buckets = self.definitions[name][3]
+        with self.lock:
+            counts = self.values[name].setdefault(labels, [[0] * (len(buckets) + 1), 0.0, 0])
+            for sample in samples:
+                counts[0][bisect.bisect_left(buckets, sample)] += 1
+                counts[1] += sample
+                counts[2] += 1
+
+    def snapshot(self):
+        """name -> labels -> value; a histogram becomes its cumulative bucket counts, sum and count."""
+        with self.lock:
+            snapshot = {}
+            for name, series in self.values.items():
+                definition = self.definitions[name]
+                snapshot[name] = {}
+                for labels, value in series.items():
+                    if definition[1] == "histogram":
+                        bounds = [str(bound) for bound in definition[3]] + ["+Inf"]
+                        value = {"buckets": dict(zip(bounds, itertools.accumulate(value[0]))), "sum": value[1], "count": value[2]}
+                    snapshot[name][labels] = value
+            return snapshot
+
+    def render(self):
+        lines = []
+        for name, series in self.snapshot().items():
+            _, kind, help_text = self.definitions[name][:3]
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+            for labels, value in sorted(series.items()):
+                if kind == "histogram":
+                    for bound, count in value["buckets"].items():
+                        lines.append(f'{name}_bucket{{{labels + "," if labels else ""}le="{bound}"}} {count}')
+                    suffix = f"{{{labels}}}" if labels else ""
+                    lines += [f"{name}_sum{suffix} {value['sum']}", f"{name}_count{suffix} {value['count']}"]
+                else:
+                    lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+def start_metrics_server(host, port):
+    """Serve the metrics at http://host:port/metrics from a background thread."""
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = metrics.render().encode(FORMAT)
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass  # One line per scrape would drown the transfer log
+
+    try:
+        httpd = http.server.ThreadingHTTPServer((host, port), MetricsHandler)
+    except OSError as e:
+        print(f"[ERROR] Could not start the metrics endpoint on {host}:{port}: {e}")
+        return None
+    threading.Thread(target=httpd.serve_forever, daemon=True).start()
+    print(f"[METRICS] Serving metrics on http://{host}:{port}/metrics")
+    return httpd
 
 # Calculate a simple checksum for error detection
 def checksum(data):
     return sum(data) % 256
 
-# Send a file to the client
-def send_file(server, client_addr, file_name):
+# Per-packet integrity checks a client can ask for with INTEGRITY:<name>. Clients that do not ask
+# get the original byte sum; zlib.crc32 runs in C and also catches reordered bytes and burst errors.
+INTEGRITY_MODES = {"sum8": checksum, "crc32": zlib.crc32}
+DEFAULT_INTEGRITY = "sum8"
+
+# Root of a Merkle tree over the block hashes: pairs are hashed together level by level and
+# a node without a partner moves up alone
+def merkle_root(hashes):
+    level = list(hashes) or [hashlib.sha256().digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(b"".join(level[i:i + 2])).digest() for i in range(0, len(level), 2)]
+    return level[0]
+
+# SHA-256 of the whole file plus the SHA-256 of every HASH_BLOCK-sized block and their Merkle root,
+# built in one pass over the file. Clients check each block as it lands and the whole file at the end.
+# Cached until the file's size or modification time changes.
+def file_index(file_path):
+    stat = os.stat(file_path)
+    with index_lock:
+        cached = index_cache.get(file_path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    digest = hashlib.sha256()
+    hashes = []
+    with open(file_path, "rb") as f:
+        while block := f.read(HASH_BLOCK):
+            digest.update(block)
+            hashes.append(hashlib.sha256(block).digest())
+    index = (digest.hexdigest(), hashes, merkle_root(hashes))
+    with index_lock:
+        index_cache[file_path] = (stat.st_size, stat.st_mtime_ns, index)
+    return index
+
+def file_digest(file_path):
+    return file_index(file_path)[0]
+
+def compressible(file_path):
+    """Whether a file is worth compressing, from COMPRESS_SAMPLES samples compressed at the fastest level.
+
+    Sampled once per version of the file: the answer is cached until its size or modification time changes.
+    """
+    stat = os.stat(file_path)
+    with compress_lock:
+        cached = compress_cache.get(file_path)
+    if cached and cached[:2] == (stat.st_size, stat.st_mtime_ns):
+        return cached[2]
+
+    sampled = packed = 0
+    with open(file_path, "rb") as f:
+        step = max(stat.st_size // COMPRESS_SAMPLES, COMPRESS_SAMPLE_SIZE)
+        for position in range(0, stat.st_size, step):
+            f.seek(position)
+            sample = f.read(COMPRESS_SAMPLE_SIZE)
+            sampled += len(sample)
+            packed += len(zlib.compress(sample, 1))
+    result = sampled > 0 and packed < sampled * COMPRESS_THRESHOLD
+    with compress_lock:
+        compress_cache[file_path] = (stat.st_size, stat.st_mtime_ns, result)
+    return result
+
+# One page of a file's block index: the text header, an empty line, then up to INDEX_PAGE raw 32-byte hashes
+def index_reply(file_name, page):
+    file_path = os.path.join(BASE_DIR, file_name)
+    if not os.path.isfile(file_path):
+        return "ERROR: File not found.\n".encode(FORMAT)
+    size = os.path.getsize(file_path)
+    digest, hashes, root = file_index(file_path)
+    first = page * INDEX_PAGE
+    header = f"OK:{len(hashes)}\nBLOCK:{HASH_BLOCK}\nROOT:{root.hex()}\nSHA256:{digest}\nSIZE:{size}\nPAGE:{page}\n\n"
+    return header.encode(FORMAT) + b"".join(hashes[first:first + INDEX_PAGE])
+
+def delta_runs(file_path, block_size, signatures):
+    """Compare the file with the block signatures of a client's old copy, rsync style.
+
+    Returns the runs [position, first block, count] of the file the client can copy from its old copy;
+    it downloads the rest with range REQUESTs. Blocks still in place are found with one BLAKE2b each;
+    after a difference adler32 is rolled byte by byte to find the next match even when the data moved.
+    """
+    started_at = time.perf_counter()
+    weak = set()
+    strong = {}  # BLAKE2b -> first block with that content
+    for index, (checksum, digest) in enumerate(signatures):
+        weak.add(checksum)
+        strong.setdefault(digest, index)
+    size = os.path.getsize(file_path)
+    last = size - block_size  # Last position that still has a whole block
+    runs = []
+    if last < 0 or not signatures:
+        metrics.inc("udp_delta_bytes_total", size, 'result="literal"')
+        return runs
+
+    with open(file_path, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+        def match(position):
+            return strong.get(hashlib.blake2b(data[position:position + block_size], digest_size=16).digest())
+
+        def add(position, index):
+            if runs and runs[-1][0] + runs[-1][2] * block_size == position and runs[-1][1] + runs[-1][2] == index:
+                runs[-1][2] += 1
+            else:
+                runs.append([position, index, 1])
+
+        # First position in [first, end) whose adler32 and then BLAKE2b match a block of the client
+        def roll(first, end):
+            checksum = zlib.adler32(data[first:first + block_size])
+            a, b = checksum & 0xFFFF, checksum >> 16
+            position = first
+            while True:
+                if b << 16 | a in weak:
+                    index = match(position)
+                    if index is not None:
+                        return position, index
+                position += 1
+                if position >= end:
+                    return None
+                old, new = data[position - 1], data[position + block_size - 1]
+                a = (a - old + new) % 65521
+                b = (b - block_size * old + a - 1) % 65521
+
+        position = 0
+        while position <= last:
+            index = match(position)
+            if index is not None:
+                add(position, index)
+                position += block_size
+                continue
+            windows = itertools.chain([(position + 1, position + 1 + DELTA_SEARCH)],
+                                      ((start, start + block_size) for start in range(position + 1 + DELTA_SEARCH, last + 1, DELTA_STRIDE)))
+            found = next(filter(None, (roll(first, min(end, last + 1)) for first, end in windows if first <= last)), None)
+            if found is None:
+                break
+            # The blocks right before the match, skipped over while striding, may match as well
+            found_at, index = found
+            behind = []
+            start = found_at - block_size
+            while start > position and (previous := match(start)) is not None:
+                behind.append((start, previous))
+                start -= block_size
+            for start, previous in reversed(behind):
+                add(start, previous)
+            add(found_at, index)
+            position = found_at + block_size
+
+    matched = sum(count for _, _, count in runs) * block_size
+    metrics.inc("udp_delta_bytes_total", matched, 'result="matched"')
+    metrics.inc("udp_delta_bytes_total", size - matched, 'result="literal"')
+    metrics.inc("udp_delta_seconds_total", time.perf_counter() - started_at)
+    return runs
+
+class DeltaJob:
+    """One DELTA comparison: the signatures a client has sent so far, then the runs matched against the file.
+
+    The signatures arrive in several datagrams, each one tagged with the index of its first signature.
+    Once all of them are in, the file is matched in a thread of its own so the main loop keeps serving;
+    until then a request for the runs is answered with WAIT.
+    """
+
+    def __init__(self, file_name, block_size, count, sha256):
+        self.file_name = file_name
+        self.block_size = block_size
+        self.count = count
+        self.sha256 = sha256  # The version of the file the client was told about; another one is not matched
+        self.parts = {}  # Index of the first signature -> the raw signatures of that datagram
+        self.received = 0
+        self.runs = None
+        self.error = None
+        self.touched = time.monotonic()
+
+    def add(self, first, signatures):
+        """Store one datagram of signatures; returns True when it completes the set."""
+        if self.received == self.count or first in self.parts or first + len(signatures) // DELTA_SIGNATURE_SIZE > self.count:
+            return False
+        self.parts[first] = signatures
+        self.received += len(signatures) // DELTA_SIGNATURE_SIZE
+        return self.received == self.count
+
+    def match(self, file_path):
+        try:
+            if file_digest(file_path) != self.sha256:
+                self.error = "File changed."
+                return
+            signatures = b"".join(self.parts[first] for first in sorted(self.parts))
+            self.runs = delta_runs(file_path, self.block_size, list(struct.iter_unpack(DELTA_SIGNATURE, signatures)))
+        except Exception as e:
+            print(f"[ERROR] Could not compare {self.file_name} with the client's copy: {e}")
+            self.error = "Could not compare the file."
+        finally:
+            self.parts = {}
+
+# Reply to a DELTA message. With RUNS:<page> it asks for a page of the matched runs (WAIT while the
+# file is still being matched); otherwise it carries signatures from FIRST:<index> on, after an
+# empty line, and is acknowledged with the number of signatures received so far.
+def delta_reply(client_addr, file_name, options, body):
+    delta_id = int(options.get("ID", 0))
+    tag = f"ID:{delta_id}\n"
+    now = time.monotonic()
+    with delta_lock:
+        for key in [key for key, job in delta_jobs.items() if now - job.touched > DELTA_TTL]:
+            del delta_jobs[key]
+        job = delta_jobs.get((client_addr, delta_id))
+
+        if "RUNS" in options:
+            page = int(options["RUNS"])
+            if job is None or job.file_name != file_name:
+                return f"ERROR: Unknown DELTA.\n{tag}".encode(FORMAT)
+            job.touched = now
+            if job.error:
+                return f"ERROR: {job.error}\n{tag}".encode(FORMAT)
+            if job.runs is None:
+                return f"WAIT\n{tag}RUNS:{page}\n".encode(FORMAT)
+            runs = job.runs[page * DELTA_RUN_PAGE:(page + 1) * DELTA_RUN_PAGE]
+            header = f"OK:{len(job.runs)}\nBLOCK:{job.block_size}\n{tag}RUNS:{page}\n\n"
+            return header.encode(FORMAT) + b"".join(struct.pack(DELTA_RUN, *run) for run in runs)
+
+        block_size, count, first = int(options.get("BLOCK", 0)), int(options.get("COUNT", 0)), int(options.get("FIRST", -1))
+        if block_size <= 0 or not 0 < count <= DELTA_MAX_BLOCKS or first < 0 or not body or len(body) % DELTA_SIGNATURE_SIZE:
+            return f"ERROR: Bad DELTA signatures.\n{tag}".encode(FORMAT)
+        if job is None:
+            if len(delta_jobs) >= MAX_DELTA_JOBS:
+                return f"ERROR: Too many DELTA requests.\n{tag}".encode(FORMAT)
+            job = delta_jobs[(client_addr, delta_id)] = DeltaJob(file_name, block_size, count, options.get("SHA256"))
+        elif (job.file_name, job.block_size, job.count) != (file_name, block_size, count):
+            return f"ERROR: Bad DELTA signatures.\n{tag}".encode(FORMAT)
+        job.touched = now
+        if job.add(first, body):
+            threading.Thread(target=job.match, args=(os.path.join(BASE_DIR, file_name),), daemon=True).start()
+        return f"OK:{job.received}\n{tag}FIRST:{first}\n".encode(FORMAT)
+
+# Unsigned LEB128: 7 bits per byte, the high bit says another byte follows
+def encode_varint(value):
+    out = bytearray()
+    while value >= 0x80:
+        out.append(value & 0x7F | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+# Compact LIST encoding: names are sorted, so each entry only stores how many bytes it shares with
+# the previous name, the length of the rest, the rest of the name and the size, all numbers as varints. Every page starts over, so pages
+# can be decoded on their own and in any order.
+def encode_list_pages(entries, page_bytes):
+    pages, page, previous = [], bytearray(), b""
+    for name, size in entries:
+        name = name.encode(FORMAT)
+        shared = 0
+        while shared < min(len(name), len(previous)) and name[shared] == previous[shared]:
+            shared += 1
+        entry = encode_varint(shared) + encode_varint(len(name) - shared) + name[shared:] + encode_varint(size)
+        if page and len(page) + len(entry) > page_bytes:
+            pages.append(bytes(page))
+            page, previous = bytearray(), b""
+            entry = encode_varint(0) + encode_varint(len(name)) + name + encode_varint(size)
+        page += entry
+        previous = name
+    if page or not pages:
+        pages.append(bytes(page))
+    return pages
+
+# Old clients send a plain LIST and read a single 1 KB datagram of newline-separated names, so
+# only the names that fit are sent; the paged LIST below has no such limit
+def legacy_listing(names):
+    listing = b""
+    for name in names:
+        line = (b"\n" if listing else b"") + name.encode(FORMAT)
+        if len(listing) + len(line) > BUFFER_SIZE:
+            break
+        listing += line
+    return listing
+
+# One LIST page: a text header, an empty line, then the encoded entries. A plain "LIST" without
+# options still gets the original newline-separated names.
+def list_reply(catalog, options):
+    version, count, pages = catalog.pages(options.get("PREFIX", ""))
+    page = int(options.get("PAGE", 0))
+    if not 0 <= page < len(pages):
+        return "ERROR: No such page.\n".encode(FORMAT)
+    header = f"OK:{count}\nPAGES:{len(pages)}\nPAGE:{page}\nVERSION:{version}\n\n"
+    return header.encode(FORMAT) + pages[page]
+
+# In-memory catalog of the files being served: name -> (size, mtime_ns, SHA-256). A background
+# thread rescans the directory every CATALOG_INTERVAL seconds and only updates the files whose size
+# or mtime changed, so LIST is answered from memory. The standard library has no inotify binding,
+# so this polls, which works the same on every platform.
+class Catalog:
+    def __init__(self, directory, exclude, on_change=None):
+        self.directory = directory
+        self.exclude = set(exclude)
+        self.on_change = on_change
+        self.entries = {}
+        self.listing = b""  # Reply to a plain LIST, rebuilt when the catalog changes
+        self.version = 0  # Bumped on every change, so clients can tell that pages came from different listings
+        self.page_cache = {}  # prefix -> (matching files, encoded pages) for the current version
+        self.lock = threading.Lock()
+
+    def __contains__(self, name):
+        with self.lock:
+            return name in self.entries
+
+    def get(self, name):
+        with self.lock:
+            return self.entries.get(name)
+
+    def items(self):
+        with self.lock:
+            return sorted(self.entries.items())
+
+    def scan(self):
+        found = {}
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name in self.exclude or entry.name.startswith(".") or not entry.is_file():
+                    continue
+                stat = entry.stat()
+                found[entry.name] = (stat.st_size, stat.st_mtime_ns)
+        return found
+
+    def refresh(self):
+        found = self.scan()
+        with self.lock:
+            changed = [name for name, key in found.items() if self.entries.get(name, (None, None))[:2] != key]
+            removed = [name for name in self.entries if name not in found]
+            if not changed and not removed:
+                return
+            for name in removed:
+                del self.entries[name]
+            for name in changed:
+                self.entries[name] = found[name] + (None,)
+            self.listing = legacy_listing(sorted(self.entries))
+            self.version += 1
+            self.page_cache = {}
+        if self.on_change:
+            self.on_change(self)
+
+        # Hash new and modified files only after they are listed, so a large file does not hold up the list
+        for name in changed:
+            try:
+                digest = file_digest(os.path.join(self.directory, name))
+            except OSError:
+                continue  # Deleted meanwhile, the next scan drops it
+            with self.lock:
+                if self.entries.get(name, (None, None))[:2] == found[name]:
+                    self.entries[name] = found[name] + (digest,)
+
+    # LIST pages of the files whose name starts with prefix, encoded once per catalog version
+    def pages(self, prefix=""):
+        with self.lock:
+            cached = self.page_cache.get(prefix)
+            if cached is None:
+                matches = [(name, entry[0]) for name, entry in sorted(self.entries.items()) if name.startswith(prefix)]
+                cached = (len(matches), encode_list_pages(matches, LIST_PAGE_BYTES))
+                if len(self.page_cache) >= 64:
+                    self.page_cache = {}
+                self.page_cache[prefix] = cached
+            return self.version, cached[0], cached[1]
+
+    def watch(self, interval=CATALOG_INTERVAL):
+        while True:
+            time.sleep(interval)
+            try:
+                self.refresh()
+            except OSError as e:
+                print(f"[ERROR] Could not rescan {self.directory}: {e}")
+
+    def start(self):
+        self.refresh()
+        threading.Thread(target=self.watch, daemon=True).start()
+        return self
+
+# Split a control message into its first line and its "KEY:value" option lines
+def parse_message(message):
+    lines = message.strip().splitlines()
+    options = {}
+    for line in lines[1:]:
+        key, sep, value = line.partition(":")
+        if sep:
+            options[key.strip().upper()] = value.strip()
+    return (lines[0].strip() if lines else ""), options
+
+def make_packet(transfer_id, seq_num, chunk, integrity=checksum, packet_type=PKT_DATA, pad=0):
+    """The buffers of one packet: the header with the chunk length, the chunk and, for clients that
+    expect fixed-size packets, zero padding up to `pad` bytes. Compressed packets are never padded."""
+    header = struct.pack(HEADER_FORMAT, packet_type, transfer_id, seq_num, len(chunk), integrity(chunk))
+    if pad > len(chunk) and packet_type != PKT_ZDATA:
+        return header, chunk, bytes(pad - len(chunk))
+    return header, chunk
+
+# socket.sendmsg gathers the buffers of a datagram in the kernel; Windows does not have it
+if hasattr(socket.socket, "sendmsg"):
+    def send_packet(sock, buffers, addr):
+        sock.sendmsg(buffers, (), 0, addr)
+else:
+    def send_packet(sock, buffers, addr):
+        sock.sendto(b"".join(buffers), addr)
+
+def open_server_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for option in (socket.SO_SNDBUF, socket.SO_RCVBUF):
+        sock.setsockopt(socket.SOL_SOCKET, option, SOCKET_BUFFER)
+    if sys.platform.startswith("linux"):
+        sock.setsockopt(socket.IPPROTO_IP, IP_MTU_DISCOVER, IP_PMTUDISC_PROBE)
+    sock.bind((HOST, PORT))
+    return sock
+
+def send_probe_reply(server, client_addr, options, request_size):
+    """Answer a PROBE with a datagram of exactly SIZE bytes; the client keeps the largest size that arrives.
+
+    The client pads its PROBE to the size it asks for, and the reply is never larger than the request,
+    so a spoofed source address cannot turn the server into an amplifier.
+    """
+    size = min(max(int(options.get("SIZE", 0)), 0), request_size)
+    header = f"PROBE:{size}\n".encode(FORMAT)
+    try:
+        send_packet(server, (header, bytes(max(size - len(header), 0))), client_addr)
+    except OSError:
+        pass  # Larger than the MTU of our own interface (EMSGSIZE): the client will not see this size
+
+class BlockCache:
+    """Server-wide, size-bounded cache of file blocks, shared by every transfer.
+
+    Blocks are keyed by file, size, modification time and block number, so a changed file is never
+    served from stale blocks (those simply age out). Eviction is a segmented LRU: a new block waits in
+    the probation segment and only moves to the protected one when it is read again, so one client
+    streaming a large file once cannot push out the files everybody downloads. Transfers that miss the
+    same block at the same time wait for a single disk read.
+    """
+
+    def __init__(self, capacity, block_size):
+        self.capacity = capacity  # 0 disables caching, every block is read from disk
+        self.block_size = block_size
+        self.probation = collections.OrderedDict()  # key -> block, least recently used first
+        self.protected = collections.OrderedDict()
+        self.protected_bytes = 0
+        self.size = 0
+        self.loading = {}  # key -> Event set once the transfer reading that block is done
+        self.lock = threading.Lock()
+
+    def get(self, key, load):
+        """The block stored under `key`, calling load() to read it on a miss."""
+        while True:
+            with self.lock:
+                block = self.lookup(key)
+                loading = self.loading.get(key) if block is None else None
+                if block is None and loading is None:
+                    self.loading[key] = threading.Event()
+            if block is not None:
+                metrics.inc("udp_cache_requests_total", labels='result="hit"')
+                return block
+            if loading is None:
+                break
+            loading.wait()  # Another transfer is reading this block; if that read failed, try again
+
+        metrics.inc("udp_cache_requests_total", labels='result="miss"')
+        try:
+            block = load()
+            with self.lock:
+                evicted = self.insert(key, block)
+            if evicted:
+                metrics.inc("udp_cache_evictions_total", evicted)
+            metrics.set("udp_cache_bytes", self.size)
+            return block
+        finally:
+            with self.lock:
+                self.loading.pop(key).set()
+
+    def lookup(self, key):
+        # Called with the lock held. A second read promotes a block to the protected segment,
+        # whose least recently used blocks go back to probation when it outgrows its share
+        block = self.protected.get(key)
+        if block is not None:
+            self.protected.move_to_end(key)
+            return block
+        block = self.probation.pop(key, None)
+        if block is not None:
+            self.protected[key] = block
+            self.protected_bytes += len(block)
+            while self.protected_bytes > self.capacity * CACHE_PROTECTED:
+                demoted, data = self.protected.popitem(last=False)
+                self.protected_bytes -= len(data)
+                self.probation[demoted] = data
+        return block
+
+    def insert(self, key, block):
+        # Called with the lock held; returns how many blocks were evicted
+        if len(block) > self.capacity or key in self.probation or key in self.protected:
+            return 0
+        self.probation[key] = block
+        self.size += len(block)
+        evicted = 0
+        while self.size > self.capacity:
+            segment = self.probation or self.protected
+            _, data = segment.popitem(last=False)
+            self.size -= len(data)
+            if segment is self.protected:
+                self.protected_bytes -= len(data)
+            evicted += 1
+        return evicted
+
+    def read(self, file_path, start, end):
+        """Memoryviews over the cached blocks covering [start, end) of the file, in order."""
+        stat = os.stat(file_path)
+        with open(file_path, "rb") as f:
+            def load(index):
+                f.seek(index * self.block_size)
+                return f.read(self.block_size)
+
+            position = start
+            while position < end:
+                index, skip = divmod(position, self.block_size)
+                block = self.get((file_path, stat.st_size, stat.st_mtime_ns, index), lambda: load(index))
+                view = memoryview(block)[skip:skip + end - position]
+                if not view:
+                    break  # The file shrank under us
+                yield view
+                position += len(view)
+
+block_cache = BlockCache(CACHE_SIZE, CACHE_BLOCK)
+
+def read_chunks(file_path, start, end, size=CHUNK_SIZE):
+    """The `size`-byte pieces of [start, end) of the file, cut from the block cache."""
+    rest = b""  # The start of a chunk that crosses into the next block
+    for view in block_cache.read(file_path, start, end):
+        if rest:
+            taken = size - len(rest)
+            rest += view[:taken]
+            view = view[taken:]
+            if len(rest) < size:
+                continue
+            yield rest
+        whole = len(view) - len(view) % size
+        for i in range(0, whole, size):
+            yield bytes(view[i:i + size])
+        rest = bytes(view[whole:])
+    if rest:
+        yield rest
+
+def compress_chunks(file_path, start, end, level, size=CHUNK_SIZE):
+    """(chunk, payload, packet type) for every `size`-byte chunk of [start, end), compressed on a helper thread.
+
+    The helper reads and compresses up to COMPRESS_AHEAD chunks ahead, so the send loop never waits
+    on zlib. A chunk that does not shrink goes out as a plain data packet.
+    """
+    ahead = queue.Queue(COMPRESS_AHEAD)
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                ahead.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+    def compress():
+        try:
+            for chunk in read_chunks(file_path, start, end, size):
+                if stop.is_set():
+                    break
+                compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+                payload = compressor.compress(chunk) + compressor.flush()
+                put((chunk, payload, PKT_ZDATA) if len(payload) < len(chunk) else (chunk, chunk, PKT_DATA))
+        finally:
+            put(None)
+
+    threading.Thread(target=compress, daemon=True).start()
+    try:
+        while (item := ahead.get()) is not None:
+            yield item
+    finally:
+        stop.set()
+
+# Retransmission timeout derived from measured round-trip times (Jacobson/Karels, as in RFC 6298)
+class RttEstimator:
+    def __init__(self):
+        self.srtt = None  # Smoothed RTT
+        self.rttvar = None  # RTT variation
+        self.min_rtt = None
+        self.rto = INITIAL_RTO
+        self.backoff = 1  # Doubled on every timeout until a fresh sample arrives
+
+    def sample(self, rtt):
+        self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        self.backoff = 1
+
+    def on_timeout(self):
+        self.backoff = min(self.backoff * 2, MAX_RTO / MIN_RTO)
+
+    def timeout(self):
+        return min(self.rto * self.backoff, MAX_RTO)
+
+# Congestion controllers decide how many packets may be in flight and how fast they are paced.
+# Each one implements window(), pacing_rate(rtt), on_ack(acked, now, rtt) and on_loss(seq_num, next_seq).
+
+# Loss-based AIMD (TCP Reno style): slow start, then one packet per RTT, halve once per loss event
+class AimdController:
+    name = "aimd"
+
+    def __init__(self, max_window):
+        self.max_window = max_window
+        self.cwnd = float(INITIAL_CWND)
+        self.ssthresh = float(max_window)
+        self.recovery_seq = 0  # Losses of packets sent before this belong to an event already handled
+
+    def window(self):
+        return max(MIN_CWND, min(int(self.cwnd), self.max_window))
+
+    def pacing_rate(self, rtt):
+        # Spread one window over one RTT, slightly faster so pacing never limits the window
+        return 1.25 * self.cwnd / rtt.srtt if rtt.srtt else None
+
+    def on_ack(self, acked, now, rtt):
+        if self.cwnd < self.ssthresh:
+            self.cwnd += acked
+        else:
+            self.cwnd += acked / self.cwnd
+        self.cwnd = min(self.cwnd, float(self.max_window))
+
+    def on_loss(self, seq_num, next_seq):
+        if seq_num >= self.recovery_seq:
+            self.ssthresh = max(self.cwnd / 2, float(MIN_CWND))
+            self.cwnd = self.ssthresh
+            self.recovery_seq = next_seq
+
+# Rate-based (BBR style): pace at the highest delivery rate measured over the last rounds and keep
+# about two bandwidth-delay products in flight. Random loss does not cut the rate, only a round in
+# which a large share of the packets was lost does.
+class RateController:
+    name = "rate"
+    GAIN_CYCLE = [1.25, 0.75, 1, 1, 1, 1, 1, 1]  # Probe for more bandwidth, then drain the queue
+    STARTUP_GAIN = 2
+    BW_ROUNDS = 10  # Rounds of delivery-rate samples kept for the max filter
+    HEAVY_LOSS = 0.2  # Share of packets lost in a round that counts as congestion
+
+    def __init__(self, max_window):
+        self.max_window = max_window
+        self.bw_samples = []  # Delivery rate (packets/s) of recent rounds
+        self.min_rtt = None
+        self.startup = True
+        self.full_bw = 0
+        self.full_bw_rounds = 0
+        self.cycle = 0
+        self.round_start = None
+        self.round_delivered = 0
+        self.round_lost = 0
+
+    def bandwidth(self):
+        return max(self.bw_samples) if self.bw_samples else None
+
+    def gain(self):
+        return self.STARTUP_GAIN if self.startup else self.GAIN_CYCLE[self.cycle % len(self.GAIN_CYCLE)]
+
+    def window(self):
+        bw = self.bandwidth()
+        if bw is None or self.min_rtt is None:
+            return min(INITIAL_CWND, self.max_window)
+        # Never below the initial window: on loopback the path RTT is far smaller than the time
+        # it takes to process a packet, so the bandwidth-delay product alone would starve the sender
+        return max(INITIAL_CWND, min(int(2 * self.gain() * bw * self.min_rtt) + 1, self.max_window))
+
+    def pacing_rate(self, rtt):
+        bw = self.bandwidth()
+        return self.gain() * bw if bw else None
+
+    def on_ack(self, acked, now, rtt):
+        self.min_rtt = rtt.min_rtt
+        if self.round_start is None:
+            self.round_start = now
+        self.round_delivered += acked
+        if not rtt.srtt or now - self.round_start < rtt.srtt:
+            return
+
+        # One round is over: record its delivery rate
+        self.bw_samples = (self.bw_samples + [self.round_delivered / (now - self.round_start)])[-self.BW_ROUNDS:]
+        if self.round_lost > self.HEAVY_LOSS * (self.round_delivered + self.round_lost):
+            self.bw_samples = [0.85 * self.bandwidth()]
+            self.startup = False
+        if self.startup:
+            # Leave startup once the bandwidth has stopped growing by 25% for three rounds
+            if self.bandwidth() >= 1.25 * self.full_bw:
+                self.full_bw = self.bandwidth()
+                self.full_bw_rounds = 0
+            else:
+                self.full_bw_rounds += 1
+                self.startup = self.full_bw_rounds < 3
+        else:
+            self.cycle += 1
+        self.round_start = now
+        self.round_delivered = 0
+        self.round_lost = 0
+
+    def on_loss(self, seq_num, next_seq):
+        self.round_lost += 1
+
+CONTROLLERS = {controller.name: controller for controller in (AimdController, RateController)}
+
+def log_congestion(session, bytes_sent, file_size, retransmits):
+    rate = session.cc.pacing_rate(session.rtt)
+    srtt = session.rtt.srtt or 0
+    print(f"[CC] {session.file_name} -> {session.client_addr}: {session.cc.name} window={session.cc.window()} "
+          f"rate={f'{rate:.0f} pkt/s' if rate else 'unpaced'} srtt={srtt * 1000:.2f} ms "
+          f"retransmits={retransmits} ({bytes_sent}/{file_size} bytes)")
+
+# Tallies of one transfer, kept by its thread without locking and added to the metrics in batches
+class TransferStats:
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.packets = 0
+        self.bytes = 0
+        self.acks = 0
+        self.parity = 0
+        self.compressed = 0
+        self.saved = 0
+        self.retransmits = {"timeout": 0, "fast": 0, "corrupt": 0}
+        self.read_seconds = 0.0
+        self.send_seconds = 0.0
+        self.rtt_samples = []
+        self.ack_delays = []
+
+    def flush(self):
+        metrics.inc("udp_packets_sent_total", self.packets)
+        metrics.inc("udp_bytes_sent_total", self.bytes)
+        metrics.inc("udp_acks_received_total", self.acks)
+        metrics.inc("udp_parity_packets_sent_total", self.parity)
+        metrics.inc("udp_compressed_packets_sent_total", self.compressed)
+        metrics.inc("udp_compression_saved_bytes_total", self.saved)
+        for reason, count in self.retransmits.items():
+            if count:
+                metrics.inc("udp_retransmits_total", count, f'reason="{reason}"')
+        metrics.inc("udp_disk_read_seconds_total", self.read_seconds)
+        metrics.inc("udp_socket_send_seconds_total", self.send_seconds)
+        metrics.observe("udp_rtt_seconds", self.rtt_samples)
+        metrics.observe("udp_ack_latency_seconds", self.ack_delays)
+        self.reset()
+
+# One file transfer, identified by the client's address plus the transfer ID the client picked
+class Session:
+    def __init__(self, client_addr, transfer_id, file_name, window, controller, integrity, offset=0, length=None, resume_digest=None, fec=0, compress=0, payload=None):
+        self.client_addr = client_addr
+        self.transfer_id = transfer_id
+        self.file_name = file_name
+        self.window = window
+        self.integrity = integrity  # Name of the per-packet check, a key of INTEGRITY_MODES
+        self.offset = offset  # Where the client's partial copy ends
+        self.length = length  # Bytes to send from the offset, None for the rest of the file
+        self.resume_digest = resume_digest  # SHA-256 of the file that partial copy came from
+        self.fec = fec  # Data packets per parity packet, 0 without forward error correction
+        self.compress = compress  # zlib level the client asked for, 0 to send the chunks as they are
+        self.payload = payload or CHUNK_SIZE  # Data bytes per packet
+        self.negotiated = payload is not None  # Clients that did not ask for PAYLOAD:<n> get packets padded to CHUNK_SIZE
+        self.acks = queue.Queue()  # ACKs routed to this transfer by the main loop
+        self.rtt = RttEstimator()
+        self.cc = controller(window)
+        self.reply = None  # OK/ERROR message, sent again if the client repeats its REQUEST
+        self.stats = TransferStats()
+
+# Send a file to the client using selective repeat: up to `window` packets are in
+# flight at once and only the packets whose timer expires are sent again.
+# Returns True once every byte has been acknowledged
+def send_file(server, session):
+    client_addr, file_name, window = session.client_addr, session.file_name, session.window
     file_path = os.path.join(BASE_DIR, file_name)
     if not os.path.exists(file_path):
-        error_message = "ERROR: File not found.\n".encode(FORMAT)
-        server.sendto(error_message, client_addr)
-        return
+        session.reply = "ERROR: File not found.\n".encode(FORMAT)
+        server.sendto(session.reply, client_addr)
+        return False
 
-    file_size = os.path.getsize(file_path)
-    # Notify client about file size
-    size_message = f"OK:{file_size}\n".encode(FORMAT)
-    server.sendto(size_message, client_addr)
+    stat = os.stat(file_path)
+    file_size = stat.st_size
+    digest = file_digest(file_path)
+    # Resume from the client's offset only if its partial copy is of this exact file
+    offset = session.offset if session.resume_digest == digest and 0 <= session.offset <= file_size else 0
+    end = min(offset + session.length, file_size) if session.length is not None and offset == session.offset else file_size
+    compress = session.compress if session.compress and compressible(file_path) else 0
+    if session.compress and not compress:
+        metrics.inc("udp_compression_skipped_total")
+    # Notify client about file size, the transfer parameters the server will use, the digest
+    # the finished file must have and where the data starts (sequence numbers count from there)
+    session.reply = (f"OK:{file_size}\nWINDOW:{window}\nID:{session.transfer_id}\nCC:{session.cc.name}\n"
+                     f"INTEGRITY:{session.integrity}\nSHA256:{digest}\nMTIME:{stat.st_mtime_ns}\nOFFSET:{offset}\n"
+                     f"LENGTH:{end - offset}\n" + (f"FEC:{session.fec}\n" if session.fec else "") +
+                     (f"COMPRESS:{compress}\n" if compress else "") + (f"PAYLOAD:{session.payload}\n" if session.negotiated else "")).encode(FORMAT)
+    server.sendto(session.reply, client_addr)
 
-    with open(file_path, "rb") as f:
-        seq_num = 0
-        total_bytes_sent = 0
+    size = session.payload
+    pad = 0 if session.negotiated else CHUNK_SIZE
+    chunks = compress_chunks(file_path, offset, end, compress, size) if compress else ((chunk, chunk, PKT_DATA) for chunk in read_chunks(file_path, offset, end, size))
+    with contextlib.closing(chunks):
+        packet_count = -(-(end - offset) // size)
+        next_seq = 0
+        total_bytes_sent = offset
+        end_of_file = False
+        in_flight = {}  # seq_num -> [packet, chunk_len, sent_at, deadline, retries]
+        rtt, cc = session.rtt, session.cc
+        integrity = INTEGRITY_MODES[session.integrity]
+        next_send_at = time.monotonic()  # Pacing timer
+        next_log_at = next_send_at + CC_LOG_INTERVAL
+        retransmits = 0
+        stats = session.stats
+        started_at = next_send_at
+        fec = session.fec
+        parity, parity_len = 0, 0  # XOR of the current group's chunks (zero-padded), as an integer
+
+        while not end_of_file or in_flight:
+            # Keep the window full: the client's window bounds how far ahead we may go, the
+            # congestion window how many packets may be in flight, and the pacing rate how fast
+            base = next(iter(in_flight), next_seq)  # in_flight is kept in sequence order
+            now = time.monotonic()
+            while not end_of_file and next_seq < base + window and len(in_flight) < cc.window() and next_send_at <= now + PACING_QUANTUM:
+                read_at = time.monotonic()
+                item = next(chunks, None)
+                if item is None:
+                    end_of_file = True
+                    break
+                chunk, payload, packet_type = item
+                packet = make_packet(session.transfer_id, next_seq, payload, integrity, packet_type, pad)
+                send_at = time.monotonic()
+                send_packet(server, packet, client_addr)
+                now = time.monotonic()
+                stats.read_seconds += send_at - read_at  # Includes building the packet
+                stats.send_seconds += now - send_at
+                stats.packets += 1
+                stats.bytes += len(chunk)
+                if packet_type == PKT_ZDATA:
+                    stats.compressed += 1
+                    stats.saved += len(chunk) - len(payload)
+                in_flight[next_seq] = [packet, len(chunk), now, now + rtt.timeout(), 0]
+                next_seq += 1
+                rate = cc.pacing_rate(rtt)
+                next_send_at = max(next_send_at, now - PACING_QUANTUM) + (1 / rate if rate else 0)
+
+                # After the last packet of each group (or of the file) send the group's parity. It is not
+                # acknowledged or resent: it only lets the client rebuild one lost packet of the group
+                if fec:
+                    parity ^= int.from_bytes(chunk, "big") << 8 * (size - len(chunk))
+                    parity_len = max(parity_len, len(chunk))
+                    if next_seq % fec == 0 or next_seq == packet_count:
+                        payload = parity.to_bytes(size, "big")[:parity_len]
+                        send_packet(server, make_packet(session.transfer_id, (next_seq - 1) // fec, payload, integrity, PKT_PARITY, pad), client_addr)
+                        stats.parity += 1
+                        parity, parity_len = 0, 0
+                        next_send_at += 1 / rate if rate else 0
 
-        while total_bytes_sent < file_size:
-            chunk = f.read(CHUNK_SIZE)
-            if not chunk:
+            if not in_flight and end_of_file:
                 break
 
-            chunk_len = len(chunk)
-            packet_checksum = checksum(chunk)
-            # Include chunk length in the packet
-            packet = struct.pack(f"I I B {CHUNK_SIZE}s", seq_num, chunk_len, packet_checksum, chunk.ljust(CHUNK_SIZE, b'\x00'))
-            while True:
-                server.sendto(packet, client_addr)
-                try:
-                    # Wait for ACK
-                    ack_packet, _ = server.recvfrom(BUFFER_SIZE)
-                    ack_seq_num, ack_status = struct.unpack("I B", ack_packet)
+            # Wait for an ACK, but no longer than the earliest retransmission deadline or,
+            # when the window has room, the next pacing slot
+            wakeup = min((entry[3] for entry in in_flight.values()), default=next_send_at)
+            if not end_of_file and next_seq < base + window and len(in_flight) < cc.window():
+                wakeup = min(wakeup, next_send_at)
+            try:
+                ack_seq_num, next_expected, ack_status, routed_at = session.acks.get(timeout=max(wakeup - time.monotonic(), 0.0005))
+                stats.acks += 1
+                stats.ack_delays.append(time.monotonic() - routed_at)
+
+                if ack_status == ACK_OK:
+                    now = time.monotonic()
+                    # Karn's rule: only packets that were sent exactly once give an unambiguous RTT sample
+                    entry = in_flight.get(ack_seq_num)
+                    if entry and entry[4] == 0:
+                        rtt.sample(now - entry[2])
+                        stats.rtt_samples.append(now - entry[2])
+                    acked_sent_at = entry[2] if entry else None
+                    # Cumulative part: everything below next_expected has been delivered
+                    acked = []
+                    for seq_num in in_flight:
+                        if seq_num >= next_expected:
+                            break
+                        acked.append(seq_num)
+                    if ack_seq_num >= next_expected and ack_seq_num in in_flight:
+                        acked.append(ack_seq_num)
+                    for seq_num in acked:
+                        total_bytes_sent += in_flight.pop(seq_num)[1]
+                    if acked:
+                        cc.on_ack(len(acked), now, rtt)
+
+                    # Fast retransmit: a packet still missing although one sent well after it has
+                    # arrived is lost, there is no need to wait for its timer. With FEC the client may
+                    # still rebuild it, so only packets sent well after its group's parity count
+                    if acked_sent_at is not None:
+                        for seq_num, entry in in_flight.items():
+                            last = seq_num - seq_num % fec + fec - 1 if fec else seq_num
+                            if last > ack_seq_num - LOSS_THRESHOLD:
+                                break
+                            if entry[2] < acked_sent_at:
+                                cc.on_loss(seq_num, next_seq)
+                                retransmits += 1
+                                stats.retransmits["fast"] += 1
+                                stats.packets += 1
+                                stats.bytes += entry[1]
+                                entry[4] += 1
+                                send_packet(server, entry[0], client_addr)
+                                entry[2] = now
+                                entry[3] = now + rtt.timeout()
+                elif ack_status == ACK_CORRUPT and ack_seq_num in in_flight:
+                    # Resend a corrupted packet right away instead of waiting for its timer
+                    entry = in_flight[ack_seq_num]
+                    entry[4] += 1
+                    stats.retransmits["corrupt"] += 1
+                    stats.packets += 1
+                    stats.bytes += entry[1]
+                    send_packet(server, entry[0], client_addr)
+                    entry[3] = time.monotonic() + rtt.timeout()
+            except queue.Empty:
+                pass
+
+            # Resend only the packets whose timer has expired, backing off once per expiry
+            now = time.monotonic()
+            expired = [(seq_num, entry) for seq_num, entry in in_flight.items() if entry[3] <= now]
+            if expired:
+                rtt.on_timeout()
+            for seq_num, entry in expired:
+                entry[4] += 1
+                if entry[4] > MAX_RETRIES:
+                    print(f"[ERROR] Client {client_addr} stopped responding. Aborting {file_name}.")
+                    return False
+                print(f"[TIMEOUT] Resending packet {seq_num} of {file_name} to {client_addr} (RTO {rtt.timeout() * 1000:.1f} ms)...")
+                cc.on_loss(seq_num, next_seq)
+                retransmits += 1
+                stats.retransmits["timeout"] += 1
+                stats.packets += 1
+                stats.bytes += entry[1]
+                send_packet(server, entry[0], client_addr)
+                entry[2] = now
+                entry[3] = now + rtt.timeout()
 
-                    if ack_status == 0 and ack_seq_num == seq_num:  # ACK is correct
-                        total_bytes_sent += chunk_len
-                        break
-                except socket.timeout:
-                    print(f"[TIMEOUT] Resending packet {seq_num}...")
-            seq_num += 1
+            if now >= next_log_at:
+                log_congestion(session, total_bytes_sent, file_size, retransmits)
+                stats.flush()
+                next_log_at = now + CC_LOG_INTERVAL
 
-    print(f"[SENT] {file_name} to client. ({total_bytes_sent}/{file_size} bytes sent)")
+    elapsed = time.monotonic() - started_at
+    if elapsed > 0:
+        metrics.observe("udp_transfer_throughput_bytes_per_second", [(total_bytes_sent - offset) / elapsed])
+    print(f"[SENT] {file_name} to client {client_addr}. ({total_bytes_sent}/{file_size} bytes sent)")
+    return True
+
+def run_session(server, session):
+    result = "failed"
+    try:
+        if send_file(server, session):
+            result = "done"
+    except Exception as e:
+        print(f"[ERROR] Transfer of {session.file_name} to {session.client_addr} failed: {e}")
+    finally:
+        session.stats.flush()
+        metrics.inc("udp_transfers_total", labels=f'result="{result}"')
+        with sessions_lock:
+            sessions.pop((session.client_addr, session.transfer_id), None)
+            metrics.set("udp_active_sessions", len(sessions))
+
+# Start a transfer in its own thread so the main loop stays free for other clients
+def start_session(server, client_addr, file_name, options):
+    transfer_id = int(options.get("ID", 0))
+    window = max(1, min(int(options.get("WINDOW", WINDOW_SIZE)), WINDOW_SIZE))
+    controller = CONTROLLERS.get(options.get("CC", CONGESTION_CONTROL).lower(), CONTROLLERS[CONGESTION_CONTROL])
+    integrity = options.get("INTEGRITY", DEFAULT_INTEGRITY).lower()
+    if integrity not in INTEGRITY_MODES:
+        integrity = DEFAULT_INTEGRITY
+    offset = int(options.get("OFFSET", 0))
+    length = int(options["LENGTH"]) if "LENGTH" in options else None
+    fec = int(options.get("FEC", 0))
+    fec = fec if 0 < fec <= MAX_FEC_GROUP else 0
+    compress = int(options.get("COMPRESS", 0))
+    compress = compress if 1 <= compress <= 9 else 0
+    payload = min(max(int(options["PAYLOAD"]), 1), MAX_DATAGRAM - HEADER_SIZE) if "PAYLOAD" in options else None
+    key = (client_addr, transfer_id)
+
+    with sessions_lock:
+        session = sessions.get(key)
+        if session is None:
+            session = sessions[key] = Session(client_addr, transfer_id, file_name, window, controller, integrity, offset, length, options.get("SHA256"), fec, compress, payload)
+            metrics.set("udp_active_sessions", len(sessions))
+            print(f"[REQUEST] Client {client_addr} requested file: {file_name} (transfer {transfer_id}, window {window}, {controller.name}"
+                  f"{f', from byte {offset}' if offset else ''}{f', {length} bytes' if length is not None else ''}{f', FEC 1/{fec}' if fec else ''}{f', zlib {compress}' if compress else ''}{f', {payload}-byte packets' if payload else ''})")
+            threading.Thread(target=run_session, args=(server, session), daemon=True).start()
+            return
+
+    # The client repeated its REQUEST because our reply was lost
+    if session.reply:
+        server.sendto(session.reply, client_addr)
+
+# Hand an ACK to the transfer it belongs to
+def route_ack(ack_packet, client_addr):
+    if len(ack_packet) != ACK_SIZE:
+        return
+    _, transfer_id, ack_seq_num, next_expected, ack_status = struct.unpack(ACK_FORMAT, ack_packet)
+    session = sessions.get((client_addr, transfer_id))
+    if session:
+        session.acks.put((ack_seq_num, next_expected, ack_status, time.monotonic()))
 
 def main():
-    server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    server.bind((HOST, PORT))
+    catalog = Catalog(BASE_DIR, [os.path.basename(__file__), "list.txt"], update_file_list).start()
+    metrics.set("udp_active_sessions", 0)
+    if METRICS_PORT:
+        start_metrics_server(HOST, METRICS_PORT)
+    server = open_server_socket()
     server.settimeout(TIMEOUT)
     print(f"[LISTENING] Server is listening on {HOST}:{PORT}")
 
     try:
         while True:
             try:
-                request_packet, client_addr = server.recvfrom(BUFFER_SIZE)
-                request = request_packet.decode(FORMAT).strip()
+                request_packet, client_addr = server.recvfrom(MAX_DATAGRAM)  # PROBE requests are as large as the reply they ask for
+                if not request_packet:
+                    continue
+                if request_packet[0] == PKT_ACK:
+                    route_ack(request_packet, client_addr)
+                    continue
+                # Only the text before an empty line is parsed; DELTA carries binary signatures after it
+                head, _, body = request_packet.partition(b"\n\n")
+                request, options = parse_message(head.decode(FORMAT, errors="replace"))
 
-                if request == "LIST":
-                    files = update_file_list()
-                    files_str = "\n".join(files)
-                    server.sendto(files_str.encode(FORMAT), client_addr)
+                if request == "PROBE":
+                    metrics.inc("udp_requests_total", labels='type="PROBE"')
+                    send_probe_reply(server, client_addr, options, len(request_packet))
+                elif request == "LIST":
+                    metrics.inc("udp_requests_total", labels='type="LIST"')
+                    server.sendto(list_reply(catalog, options) if options else catalog.listing, client_addr)
                     print(f"[LIST] Sent file list to {client_addr}")
+                elif request.startswith("HASHES:"):
+                    metrics.inc("udp_requests_total", labels='type="HASHES"')
+                    file_name = request[len("HASHES:"):].strip()
+                    # Only files in the catalog are served, never a path outside BASE_DIR
+                    if file_name not in catalog:
+                        server.sendto("ERROR: File not found.\n".encode(FORMAT), client_addr)
+                        continue
+                    server.sendto(index_reply(file_name, int(options.get("PAGE", 0))), client_addr)
+                elif request.startswith("DELTA:"):
+                    metrics.inc("udp_requests_total", labels='type="DELTA"')
+                    file_name = request[len("DELTA:"):].strip()
+                    if file_name not in catalog:
+                        server.sendto("ERROR: File not found.\n".encode(FORMAT), client_addr)
+                        continue
+                    server.sendto(delta_reply(client_addr, file_name, options, body), client_addr)
                 else:
                     file_name = request.replace("REQUEST:", "").strip()
 
                     if not file_name:
                         print(f"[ERROR] Invalid file request from {client_addr}.")
                         continue
+                    if file_name not in catalog:
+                        server.sendto("ERROR: File not found.\n".encode(FORMAT), client_addr)
+                        continue
 
-                    print(f"[REQUEST] Client {client_addr} requested file: {file_name}")
-                    send_file(server, client_addr, file_name)
+                    metrics.inc("udp_requests_total", labels='type="REQUEST"')
+                    start_session(server, client_addr, file_name, options)
 
             except socket.timeout:
                 continue  # Continue listening for new requests
+            except ValueError:
+                print(f"[ERROR] Malformed request from {client_addr}.")
             except KeyboardInterrupt:
                 print("\n[SERVER] Shutting down...")
                 break
@@ -108,4 +1277,13 @@ def main():
         print("[SERVER] Server has been shut down.")
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP file server (LIST / PROBE / HASHES / DELTA / REQUEST)")
+    parser.add_argument("--host", default=HOST)
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--dir", default=BASE_DIR, help="directory holding the files to serve")
+    parser.add_argument("--metrics-port", type=int, default=METRICS_PORT, help="port of the Prometheus /metrics endpoint, 0 to disable it")
+    parser.add_argument("--cache-size", type=int, default=CACHE_SIZE // (1024 * 1024), help="MB of file blocks shared between transfers, 0 to disable the cache")
+    args = parser.parse_args()
+    HOST, PORT, BASE_DIR, METRICS_PORT = args.host, args.port, os.path.abspath(args.dir), args.metrics_port
+    block_cache.capacity = max(args.cache_size, 0) * 1024 * 1024
     main()
\ No newline at end of file
@@ -1,129 +1,1179 @@
-
 import socket
 import os
 import time
-import sys
 import struct
+import sys
+import random
+import zlib
+import hashlib
+import json
+import threading
+import bisect
+import itertools
+import argparse
+import heapq
+import math
 
 SERVER_HOST = "127.0.0.1"
 SERVER_PORT = 65432
-CHUNK_SIZE = 1024
+CHUNK_SIZE = 1007  # The server's chunk size for requests without PAYLOAD:<n>
+MAX_DATAGRAM = 65507  # Largest UDP payload over IPv4
+PROBE_SIZES = (MAX_DATAGRAM, 8972, 1472, 1232)  # Datagrams to probe the path with: loopback, jumbo frames, Ethernet, the IPv6 minimum MTU
+PAYLOAD_SIZE = None  # Data bytes per packet to ask for: None to probe the path, 0 for the server's fixed CHUNK_SIZE packets
+SOCKET_BUFFER = 4 * 1024 * 1024  # SO_RCVBUF asked for; the receive window is what fits in it
 FORMAT = "utf-8"
 INPUT_FILE = os.path.join(os.path.dirname(__file__), "input.txt")
 DOWNLOAD_DIR = os.path.join(os.path.dirname(__file__), "downloads")
+CONTROL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "control.sock")  # Unix socket getInput.py submits downloads to
+CONTROL_PORT = 9443  # Used on 127.0.0.1 instead of CONTROL_PATH where there are no Unix sockets
 
 # Ensure the downloads directory exists
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
 
-TIMEOUT = 2  # Timeout for retransmissions (in seconds)
-MAX_RETRIES = 5  # Maximum number of retries per packet
+INITIAL_RTO = 1  # Timeout until the first RTT sample (in seconds)
+MIN_RTO = 0.01  # Bounds for the adaptive timeout (in seconds)
+MAX_RTO = 10
+MAX_RETRIES = 10  # Maximum number of consecutive timeouts before giving up
+LINGER_RTOS = 4  # How many timeouts of silence end the linger after the last packet
+WINDOW_SIZE = 256  # Number of out-of-order packets the client is willing to buffer
+INTEGRITY = "crc32"  # Per-packet check to ask the server for ("crc32" or the original "sum8")
+CONGESTION_CONTROL = None  # Congestion controller to ask the server for ("aimd" or "rate"), None for its default
+FEC_GROUP = 0  # Data packets per XOR parity packet to ask the server for (8 = 12.5% overhead), 0 for no FEC
+COMPRESS_LEVEL = 0  # zlib level to ask the server for (1 fastest - 9 smallest), 0 for none; pays off on slow links
+COMPRESS_MODES = {"off": 0, "fast": 1, "zlib": 6}
+HEADER_FORMAT = "!B I I I I"  # packet type, transfer_id, seq_num, chunk_len, checksum
+HEADER_SIZE = struct.calcsize(HEADER_FORMAT)
+ACK_FORMAT = "!B I I I B"  # packet type, transfer_id, seq_num, next expected seq_num (cumulative), status
+PKT_DATA = 1
+PKT_ACK = 2
+PKT_PARITY = 3  # XOR of a group of FEC_GROUP data packets; seq_num is the group number
+PKT_ZDATA = 4  # Data packet with a raw-deflated payload, sent when the REQUEST asked for COMPRESS_LEVEL
+ACK_OK = 0
+ACK_CORRUPT = 1
+JOURNAL_INTERVAL = 1  # How often the progress journal of a download is written (in seconds)
+DELTA_SYNC = True  # An older copy in DOWNLOAD_DIR is brought up to date by fetching only the bytes the server does not find in it
+DELTA_SIGNATURE = "!I 16s"  # adler32 and 16-byte BLAKE2b of one block of the old copy
+DELTA_RUN = "!Q I I"  # Position in the new file, first block of the old copy, number of blocks in a row
+DELTA_RUN_SIZE = struct.calcsize(DELTA_RUN)
+DELTA_MIN_BLOCK = 2 * 1024  # Signature block size, about the square root of the file size like rsync
+DELTA_MAX_BLOCKS = 128 * 1024  # The most signatures the server takes for one file
+DELTA_PAGE = 48  # Signatures per DELTA datagram, so each one stays below a 1500-byte Ethernet frame
+DELTA_WINDOW = 16  # DELTA datagrams sent at once before waiting for their acknowledgements
+DELTA_POLL = 0.05  # How long to wait before asking again while the server is still matching (in seconds)
+DELTA_WAIT = 60  # Give up on the server's match after this long (in seconds)
+DELTA_MERGE = 64 * 1024  # Bytes to fetch that are closer than this go in one range request, a request costs more than that
+LIST_WINDOW = 16  # LIST pages requested at once while browsing the catalog
+MAX_FILES = 4  # Files downloaded at the same time, each on its own socket and transfer
+MAX_BANDWIDTH = 0  # Total receive rate over all downloads (in bytes per second), 0 for no limit
+METRICS_FILE = os.path.join(os.path.dirname(__file__), "metrics.json")  # Rewritten after every download
+SECONDS_BUCKETS = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+THROUGHPUT_BUCKETS = (1e5, 1e6, 1e7, 1e8, 1e9)  # Bytes per second
+METRIC_DEFINITIONS = [
+    ("udp_client_downloads_total", "counter", "Finished downloads, by result"),
+    ("udp_client_packets_received_total", "counter", "Data packets received for a transfer"),
+    ("udp_client_bytes_received_total", "counter", "Payload bytes written in order"),
+    ("udp_client_duplicate_packets_total", "counter", "Data packets received again or outside the window"),
+    ("udp_client_corrupt_packets_total", "counter", "Data packets that failed the integrity check"),
+    ("udp_client_fec_recovered_total", "counter", "Lost data packets rebuilt from FEC parity"),
+    ("udp_client_compressed_packets_total", "counter", "Data packets that arrived compressed"),
+    ("udp_client_timeouts_total", "counter", "Timeouts while waiting for a data packet"),
+    ("udp_client_acks_sent_total", "counter", "ACKs sent while receiving"),
+    ("udp_client_delta_reused_bytes_total", "counter", "File bytes kept from the old local copy instead of downloaded"),
+    ("udp_client_rtt_seconds", "histogram", "Round-trip time of control messages", SECONDS_BUCKETS),
+    ("udp_client_download_throughput_bytes_per_second", "histogram", "Average throughput of each finished download", THROUGHPUT_BUCKETS),
+    ("udp_client_payload_bytes", "gauge", "Data bytes per packet of the last transfer"),
+    ("udp_client_socket_recv_seconds_total", "counter", "Time spent in recvfrom, waiting included"),
+    ("udp_client_disk_write_seconds_total", "counter", "Time spent writing received data"),
+]
+
+def display_progress(file_name, received, total):
+    progress = int((received / total) * 100 // 5)
+    print(f"[PROGRESS] {file_name} [" + "=" * progress + " " * (20 - progress) + "]" + f" {received}/{total} bytes received.", end="\r")
+
 
+def get_available_files(prefix="", attempts=3):
+    """Browse the server's catalog: a list of (name, size) sorted by name, or None if the server does not answer.
+
+    The first page tells how many pages there are; the rest are requested LIST_WINDOW at a time and
+    only the ones that went missing are asked for again. If the catalog changes while browsing, start over.
+    """
+    def request(page):
+        return f"LIST\nPAGE:{page}\nPREFIX:{prefix}\n"
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        rtt = RttEstimator()
+        response, _ = exchange(client, request(0), rtt)
+        reply = parse_list_reply(response) if response else None
+        if reply is None:
+            return None
+        page_count, _, version, entries = reply
+        pages = {0: entries}
+        retries = 0
+
+        while len(pages) < page_count:
+            wanted = [page for page in range(page_count) if page not in pages][:LIST_WINDOW]
+            for page in wanted:
+                client.sendto(request(page).encode(FORMAT), (SERVER_HOST, SERVER_PORT))
+            client.settimeout(rtt.timeout())
+            try:
+                while not all(page in pages for page in wanted):
+                    response, _ = client.recvfrom(CHUNK_SIZE + HEADER_SIZE)
+                    reply = parse_list_reply(response)
+                    if reply is None:
+                        continue
+                    if reply[2] != version:
+                        return get_available_files(prefix, attempts - 1) if attempts > 1 else None
+                    pages[reply[1]] = reply[3]
+                retries = 0
+            except socket.timeout:
+                rtt.on_timeout()
+                retries += 1
+                if retries >= MAX_RETRIES:
+                    return None
+
+        return [entry for page in range(page_count) for entry in pages[page]]
+
+def decode_varint(data, position):
+    value = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return value, position
+
+def decode_list_page(body):
+    """Decode one LIST page: each entry is the number of bytes shared with the previous name, the length
+    of the rest, the rest of the name and the file size."""
+    entries, position, previous = [], 0, b""
+    while position < len(body):
+        shared, position = decode_varint(body, position)
+        length, position = decode_varint(body, position)
+        name = previous[:shared] + body[position:position + length]
+        size, position = decode_varint(body, position + length)
+        entries.append((name.decode(FORMAT), size))
+        previous = name
+    return entries
+
+def parse_list_reply(response):
+    header, _, body = response.partition(b"\n\n")
+    status, options = parse_message(header.decode(FORMAT, errors="replace"))
+    if not status.startswith("OK:"):
+        return None
+    return int(options["PAGES"]), int(options["PAGE"]), int(options["VERSION"]), decode_list_page(body)
 
 def checksum(data):
     """Calculate a simple checksum for error detection."""
     return sum(data) % 256
 
+INTEGRITY_MODES = {"sum8": checksum, "crc32": zlib.crc32}
 
-def download_file(file_name):
-    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
-        client.settimeout(TIMEOUT)
+class Metrics:
+    """Counters, gauges and histograms, dumped as JSON.
+
+    Every metric is declared up front as (name, type, help[, buckets]); a series is picked by its
+    label string, e.g. 'result="done"'. The receive loop keeps its own tallies and hands them over
+    once per transfer.
+    """
+
+    def __init__(self, definitions):
+        self.lock = threading.Lock()
+        self.definitions = {definition[0]: definition for definition in definitions}
+        self.values = {name: {} for name in self.definitions}  # name -> labels -> value
+        self.dump_lock = threading.Lock()  # Parallel downloads all dump to the same file
+
+    def inc(self, name, value=1, labels=""):
+        with self.lock:
+            series = self.values[name]
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels=""):
+        with self.lock:
+            self.values[name][labels] = value
+
+    def observe(self, name, samples, labels=""):
+        """Add a batch of samples to a histogram."""
+        buckets = self.definitions[name][3]
+        with self.lock:
+            counts = self.values[name].setdefault(labels, [[0] * (len(buckets) + 1), 0.0, 0])
+            for sample in samples:
+                counts[0][bisect.bisect_left(buckets, sample)] += 1
+                counts[1] += sample
+                counts[2] += 1
+
+    def snapshot(self):
+        """name -> labels -> value; a histogram becomes its cumulative bucket counts, sum and count."""
+        with self.lock:
+            snapshot = {}
+            for name, series in self.values.items():
+                definition = self.definitions[name]
+                snapshot[name] = {}
+                for labels, value in series.items():
+                    if definition[1] == "histogram":
+                        bounds = [str(bound) for bound in definition[3]] + ["+Inf"]
+                        value = {"buckets": dict(zip(bounds, itertools.accumulate(value[0]))), "sum": value[1], "count": value[2]}
+                    snapshot[name][labels] = value
+            return snapshot
+
+    def dump(self, path):
+        """Write the snapshot as JSON, replacing the previous dump in one step."""
+        temp_path = path + ".tmp"
+        with self.dump_lock:
+            with open(temp_path, "w") as f:
+                json.dump({"time": time.time(), "metrics": self.snapshot()}, f, indent=2)
+            os.replace(temp_path, path)
+
+metrics = Metrics(METRIC_DEFINITIONS)
+
+class RateLimiter:
+    """Token bucket shared by every download, capping their total receive rate (0 means no limit).
+
+    A receive loop takes what it just got out of the bucket and then sleeps off any debt. While it
+    sleeps it sends no ACKs, so the server's window fills and its sending slows down to match.
+    """
+
+    def __init__(self, rate):
+        self.rate = rate
+        self.allowance = rate  # Bytes that may arrive right away, at most one second's worth
+        self.updated_at = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, length):
+        if not self.rate:
+            return
+        with self.lock:
+            now = time.monotonic()
+            self.allowance = min(self.allowance + (now - self.updated_at) * self.rate, self.rate) - length
+            self.updated_at = now
+            wait = -self.allowance / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+bandwidth = RateLimiter(MAX_BANDWIDTH)
+
+# Tallies of one receive loop, added to the metrics when it ends
+class ReceiveStats:
+    def __init__(self):
+        self.packets = 0
+        self.bytes = 0
+        self.duplicates = 0
+        self.corrupt = 0
+        self.recovered = 0
+        self.compressed = 0
+        self.timeouts = 0
+        self.acks = 0
+        self.recv_seconds = 0.0
+        self.write_seconds = 0.0
+
+    def flush(self):
+        metrics.inc("udp_client_packets_received_total", self.packets)
+        metrics.inc("udp_client_bytes_received_total", self.bytes)
+        metrics.inc("udp_client_duplicate_packets_total", self.duplicates)
+        metrics.inc("udp_client_corrupt_packets_total", self.corrupt)
+        metrics.inc("udp_client_fec_recovered_total", self.recovered)
+        metrics.inc("udp_client_compressed_packets_total", self.compressed)
+        metrics.inc("udp_client_timeouts_total", self.timeouts)
+        metrics.inc("udp_client_acks_sent_total", self.acks)
+        metrics.inc("udp_client_socket_recv_seconds_total", self.recv_seconds)
+        metrics.inc("udp_client_disk_write_seconds_total", self.write_seconds)
+        self.__init__()
+
+def parse_message(message):
+    """Split a control message into its first line and its "KEY:value" option lines."""
+    lines = message.strip().splitlines()
+    options = {}
+    for line in lines[1:]:
+        key, sep, value = line.partition(":")
+        if sep:
+            options[key.strip().upper()] = value.strip()
+    return (lines[0].strip() if lines else ""), options
+
+class RttEstimator:
+    """Timeout derived from measured round-trip times (Jacobson/Karels, as in RFC 6298)."""
+
+    def __init__(self):
+        self.srtt = None  # Smoothed RTT
+        self.rttvar = None  # RTT variation
+        self.rto = INITIAL_RTO
+        self.backoff = 1  # Doubled on every timeout, reset once the server is heard from again
+
+    def sample(self, rtt):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, MIN_RTO), MAX_RTO)
+        self.backoff = 1
+
+    def on_timeout(self):
+        self.backoff = min(self.backoff * 2, MAX_RTO / MIN_RTO)
+
+    def timeout(self):
+        return min(self.rto * self.backoff, MAX_RTO)
+
+def load_journal(journal_path, part_path):
+    """Progress journal of an interrupted download, or None if there is none or it does not fit the partial file."""
+    try:
+        with open(journal_path, "r") as f:
+            journal = json.load(f)
+        received = journal["ranges"][0][1] if journal["ranges"] else 0
+        if journal["ranges"] and journal["ranges"][0][0] != 0 or os.path.getsize(part_path) < received:
+            return None
+        journal["received"] = received
+        return journal
+    except (OSError, ValueError, KeyError, IndexError, TypeError):
+        return None
+
+def save_journal(journal_path, f, info, received):
+    """Record that the first `received` bytes of the partial file are on disk.
+
+    The data is synced before the journal is written, so a crash can never leave a journal that
+    claims bytes which were lost, and the journal is replaced in one step so it is never half written.
+    """
+    f.flush()
+    os.fsync(f.fileno())
+    temp_path = journal_path + ".tmp"
+    with open(temp_path, "w") as journal:
+        json.dump(dict(info, ranges=[[0, received]] if received else []), journal)
+        journal.flush()
+        os.fsync(journal.fileno())
+    os.replace(temp_path, journal_path)
+
+def send_ack(client, server_addr, transfer_id, seq_num, expected_seq, status=ACK_OK):
+    client.sendto(struct.pack(ACK_FORMAT, PKT_ACK, transfer_id, seq_num, expected_seq, status), server_addr)
+
+def linger(client, transfer_id, expected_seq, rtt):
+    """Keep acknowledging retransmissions until the server goes quiet, in case our last ACKs were lost."""
+    client.settimeout(LINGER_RTOS * rtt.timeout())
+    while True:
+        try:
+            packet, server_addr = client.recvfrom(MAX_DATAGRAM)
+        except socket.timeout:
+            return
+        if len(packet) >= HEADER_SIZE:
+            packet_type, packet_id, seq_num, _, _ = struct.unpack(HEADER_FORMAT, packet[:HEADER_SIZE])
+            if packet_type in (PKT_DATA, PKT_ZDATA) and packet_id == transfer_id:
+                send_ack(client, server_addr, transfer_id, seq_num, expected_seq)
+
+def exchange(client, message, rtt, accept=None):
+    """Send a control message, repeating it if the server's reply is lost, and return the raw reply.
+
+    Replies for which accept(reply) is false answer an earlier message (a duplicated or late
+    datagram) and are skipped. Replies also give RTT samples for the transfer.
+    """
+    request_packet = message.encode(FORMAT)
+    for attempt in range(MAX_RETRIES):
+        client.settimeout(rtt.timeout())
+        sent_at = time.monotonic()
+        client.sendto(request_packet, (SERVER_HOST, SERVER_PORT))
         try:
-            # Send the file request
-            request_packet = f"REQUEST:{file_name}".encode(FORMAT)
-            client.sendto(request_packet, (SERVER_HOST, SERVER_PORT))
+            while True:
+                response, server_addr = client.recvfrom(MAX_DATAGRAM)
+                # Skip early or stray data packets; the reply is the text message
+                if response and response[0] not in (PKT_DATA, PKT_ACK, PKT_PARITY, PKT_ZDATA) and (accept is None or accept(response)):
+                    # Karn's rule: a reply to a repeated message is ambiguous
+                    if attempt == 0:
+                        rtt.sample(time.monotonic() - sent_at)
+                        metrics.observe("udp_client_rtt_seconds", [time.monotonic() - sent_at])
+                    return response, server_addr
+        except socket.timeout:
+            rtt.on_timeout()
+    return None, None
+
+def receive_window(client, payload):
+    """Packets of `payload` bytes to let the server have in flight: WINDOW_SIZE, or fewer if they would overflow the socket buffer."""
+    buffer = min(client.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), SOCKET_BUFFER)
+    return max(min(WINDOW_SIZE, buffer // (payload + HEADER_SIZE)), 1)
+
+def request_file(client, file_name, transfer_id, rtt, offset=0, length=None, sha256=None, payload=None):
+    """Send the REQUEST and return the decoded reply.
+
+    With an offset the server is asked to send the file from there on (or only `length` bytes of it);
+    it only does so if `sha256` is still the file's digest. With a payload the server is asked for
+    packets of that many data bytes; it answers with the size it will send.
+    """
+    window = receive_window(client, payload or CHUNK_SIZE)
+    request = f"REQUEST:{file_name}\nWINDOW:{window}\nID:{transfer_id}\nINTEGRITY:{INTEGRITY}\n"
+    if CONGESTION_CONTROL:
+        request += f"CC:{CONGESTION_CONTROL}\n"
+    if FEC_GROUP:
+        request += f"FEC:{FEC_GROUP}\n"
+    if COMPRESS_LEVEL:
+        request += f"COMPRESS:{COMPRESS_LEVEL}\n"
+    if payload:
+        request += f"PAYLOAD:{payload}\n"
+    if sha256 and (offset or length is not None):
+        request += f"OFFSET:{offset}\nSHA256:{sha256}\n"
+        if length is not None:
+            request += f"LENGTH:{length}\n"
+    # The reply to this REQUEST carries its transfer ID
+    tag = f"\nID:{transfer_id}\n".encode(FORMAT)
+    response, server_addr = exchange(client, request, rtt, lambda reply: reply.startswith(b"ERROR") or tag in reply)
+    return (response.decode(FORMAT), server_addr) if response else (None, None)
 
-            # Receive server's response (file size or error)
+def probe_payload(client, rtt):
+    """Largest data payload per packet the path from the server carries without being fragmented.
+
+    Asks for a reply of every PROBE_SIZES size at once; the server sends them with Don't Fragment
+    set, so the largest one that arrives fits the path MTU. Each PROBE is padded to the size it asks
+    for, since the server never answers with more bytes than it received. Returns None if the server
+    does not answer PROBE (it then only sends CHUNK_SIZE packets).
+    """
+    for attempt in range(3):
+        client.settimeout(rtt.timeout())
+        for size in PROBE_SIZES:
+            request = f"PROBE\nSIZE:{size}\n\n".encode(FORMAT)
             try:
-                response, server_addr = client.recvfrom(CHUNK_SIZE)
-                response = response.decode(FORMAT)
+                client.sendto(request + bytes(size - len(request)), (SERVER_HOST, SERVER_PORT))
+            except OSError:
+                pass  # Too large for our own interface: that size will not be answered
+        largest = 0
+        try:
+            while largest < PROBE_SIZES[0]:
+                response, _ = client.recvfrom(MAX_DATAGRAM)
+                if response.startswith(b"PROBE:") and len(response) == int(response[6:response.index(b"\n")]):
+                    largest = max(largest, len(response))
+        except (socket.timeout, ValueError):
+            pass
+        if largest:
+            return largest - HEADER_SIZE
+        rtt.on_timeout()
+    return None
 
-                if response.startswith("ERROR"):
-                    print(f"[ERROR] {response}")
-                    return
+def negotiate_payload(client, rtt):
+    """The PAYLOAD to ask for: PAYLOAD_SIZE, or what probe_payload finds, probed once per server."""
+    if PAYLOAD_SIZE is not None:
+        return PAYLOAD_SIZE or None
+    with payload_lock:
+        server = (SERVER_HOST, SERVER_PORT)
+        if server not in probed_payloads:
+            probed_payloads[server] = probe_payload(client, rtt)
+            print(f"[INFO] Path to {server[0]}:{server[1]} carries {probed_payloads[server] or CHUNK_SIZE}-byte packets")
+        return probed_payloads[server]
 
-                _, file_size = response.split(":")
-                file_size = int(file_size)
-                print(f"[INFO] Downloading {file_name} ({file_size} bytes)...")
+payload_lock = threading.Lock()
+probed_payloads = {}  # (host, port) -> the payload negotiate_payload probed for that server
 
-            except socket.timeout:
-                print("[ERROR] No response from server.")
-                return
+def merkle_root(hashes):
+    """Root of a Merkle tree over the block hashes, built the same way as on the server."""
+    level = list(hashes) or [hashlib.sha256().digest()]
+    while len(level) > 1:
+        level = [hashlib.sha256(b"".join(level[i:i + 2])).digest() for i in range(0, len(level), 2)]
+    return level[0]
+
+def fetch_block_index(client, file_name, rtt):
+    """Fetch the file's block index page by page.
+
+    Returns (block size, block hashes, SHA-256 of the file, file size or None from servers that do
+    not send it), or None if the server has no index or the hashes do not add up to the Merkle root
+    it announced.
+    """
+    hashes, page = [], 0
+    while True:
+        tag = f"\nPAGE:{page}\n\n".encode(FORMAT)
+        response, _ = exchange(client, f"HASHES:{file_name}\nPAGE:{page}\n", rtt, lambda reply: reply.startswith(b"ERROR") or tag in reply)
+        if response is None:
+            return None
+        header, _, body = response.partition(b"\n\n")
+        status, options = parse_message(header.decode(FORMAT, errors="replace"))
+        if not status.startswith("OK:") or int(options.get("PAGE", -1)) != page:
+            return None
+        count = int(status.split(":")[1])
+        hashes += [body[i:i + 32] for i in range(0, len(body), 32)]
+        if len(hashes) >= count or not body:
+            break
+        page += 1
+    if len(hashes) != count or merkle_root(hashes).hex() != options.get("ROOT"):
+        return None
+    return int(options["BLOCK"]), hashes, options.get("SHA256"), int(options["SIZE"]) if "SIZE" in options else None
+
+class BlockVerifier:
+    """Checks the file block by block against the server's index as the data is written in order."""
+
+    def __init__(self, file_size, block_size, hashes):
+        self.file_size = file_size
+        self.block_size = block_size
+        self.hashes = hashes
+        self.digest = hashlib.sha256()  # Hash of the block being written
+        self.bad = []  # Blocks that did not match their hash
+
+    def update(self, position, chunk):
+        view = memoryview(chunk)
+        while view:
+            block_end = min((position // self.block_size + 1) * self.block_size, self.file_size)
+            take = min(len(view), block_end - position)
+            self.digest.update(view[:take])
+            position += take
+            view = view[take:]
+            if position == block_end:
+                block = (position - 1) // self.block_size
+                if self.digest.digest() != self.hashes[block]:
+                    self.bad.append(block)
+                self.digest = hashlib.sha256()
+
+def rebuild_packet(group, members, parity, fec, start, end, payload=CHUNK_SIZE):
+    """XOR a group's parity with the packets of the group that arrived to rebuild the one that did not.
+
+    Every data packet but the last of the range carries `payload` bytes, so the length of the
+    rebuilt one is known. Returns (seq_num, chunk), or None unless exactly one packet is missing.
+    """
+    first = group * fec
+    last = min(first + fec, -(-(end - start) // payload))
+    missing = [seq_num for seq_num in range(first, last) if seq_num not in members]
+    if len(missing) != 1:
+        return None
+    # Shorter chunks count as zero-padded up to `payload` bytes
+    value = int.from_bytes(parity, "big") << 8 * (payload - len(parity))
+    for chunk in members.values():
+        value ^= int.from_bytes(chunk, "big") << 8 * (payload - len(chunk))
+    seq_num = missing[0]
+    return seq_num, value.to_bytes(payload, "big")[:min(payload, end - start - seq_num * payload)]
+
+def decompress_chunk(payload, size):
+    """The chunk of a PKT_ZDATA packet, or None if it does not inflate to exactly `size` bytes."""
+    if size <= 0:
+        return None  # A sequence number beyond the range
+    try:
+        chunk = zlib.decompressobj(-15).decompress(payload, size + 1)
+    except zlib.error:
+        return None
+    return chunk if len(chunk) == size else None
+
+def receive_range(client, server_addr, f, transfer_id, window, integrity, rtt, start, end, on_write, fec=0, payload=CHUNK_SIZE):
+    """Receive the bytes [start, end) of a transfer the server has started and write them in order.
+
+    on_write(position, chunk) is called for every chunk written. With fec, the server sends one
+    parity packet per fec data packets and a single lost packet per group is rebuilt instead of
+    waiting for its retransmission. Every packet but the last carries `payload` data bytes.
+    Returns False if the server stopped sending.
+    """
+    f.seek(start)
+    position = start
+    expected_seq = 0
+    buffered = {}  # seq_num -> chunk, packets that arrived ahead of expected_seq
+    total = -(-(end - start) // payload)  # Data packets in the range
+    packet = memoryview(bytearray(HEADER_SIZE + payload))  # Every datagram is received into this one buffer
+    groups = {}  # group -> {seq_num: chunk}, FEC groups that may still need a repair
+    parities = {}  # group -> parity payload of those groups
+    retries = 0
+    stats = ReceiveStats()
+
+    while position < end:
+        try:
+            # Receive a packet
+            client.settimeout(rtt.timeout())
+            recv_at = time.monotonic()
+            size, server_addr = client.recvfrom_into(packet)
+            stats.recv_seconds += time.monotonic() - recv_at
+        except socket.timeout:
+            stats.recv_seconds += time.monotonic() - recv_at
+            stats.timeouts += 1
+            retries += 1
+            if retries >= MAX_RETRIES:
+                print("[ERROR] Max retries reached. Download failed.")
+                stats.flush()
+                return False
+            print(f"[WARNING] Timeout waiting for packet ({rtt.timeout() * 1000:.1f} ms). Retrying...")
+            rtt.on_timeout()
+            # Our last ACK may have been lost; repeat the cumulative ACK
+            if expected_seq > 0:
+                send_ack(client, server_addr, transfer_id, expected_seq - 1, expected_seq)
+                stats.acks += 1
+            continue
+
+        if size < HEADER_SIZE:
+            continue
+        packet_type, packet_id, seq_num, chunk_len, received_checksum = struct.unpack_from(HEADER_FORMAT, packet)
+        if packet_type not in (PKT_DATA, PKT_ZDATA, PKT_PARITY) or packet_id != transfer_id:
+            continue
+        retries = 0
+        rtt.backoff = 1
+        chunk = bytes(packet[HEADER_SIZE:min(HEADER_SIZE + chunk_len, size)])
+        stats.packets += 1
+        bandwidth.consume(len(chunk))
+
+        valid = integrity(chunk) == received_checksum
+        if valid and packet_type == PKT_ZDATA:
+            # Every chunk but the last of the range is full size, so the inflated length is known
+            chunk = decompress_chunk(chunk, min(payload, end - start - seq_num * payload))
+            valid = chunk is not None
+            stats.compressed += 1
+        if not valid:
+            stats.corrupt += 1
+            if packet_type == PKT_PARITY:
+                continue  # Parity is never resent, a corrupted one is simply not used
+            # Ask for a corrupted packet again instead of waiting for the server's timer
+            print(f"[ERROR] Packet {seq_num} corrupted. Requesting retransmission.")
+            send_ack(client, server_addr, transfer_id, seq_num, expected_seq, ACK_CORRUPT)
+            stats.acks += 1
+            continue
+
+        rebuilt = group = None
+        if packet_type == PKT_PARITY:
+            # Parity of a group that is already written out is of no use any more
+            group = seq_num
+            if not fec or min(group * fec + fec, total) <= expected_seq:
+                continue
+            parities[group] = chunk
+            rebuilt = rebuild_packet(group, groups.get(group, {}), chunk, fec, start, end, payload)
+        # Buffer anything inside the window; older packets are duplicates and only need a new ACK
+        elif expected_seq <= seq_num < expected_seq + window and seq_num not in buffered:
+            buffered[seq_num] = chunk
+            if fec:
+                group = seq_num // fec
+                groups.setdefault(group, {})[seq_num] = chunk
+                if group in parities:
+                    rebuilt = rebuild_packet(group, groups[group], parities[group], fec, start, end, payload)
+        else:
+            stats.duplicates += 1
+
+        if rebuilt:
+            if expected_seq <= rebuilt[0] < expected_seq + window:
+                buffered[rebuilt[0]] = rebuilt[1]
+                groups.setdefault(group, {})[rebuilt[0]] = rebuilt[1]
+                stats.recovered += 1
+            else:
+                rebuilt = None
+        # A group with every packet in needs no repair, so forget it and its parity
+        if fec and group in groups and len(groups[group]) == min(fec, total - group * fec):
+            del groups[group]
+            parities.pop(group, None)
+
+        # Write out every packet that is now in order
+        while expected_seq in buffered:
+            chunk = buffered.pop(expected_seq)
+            write_at = time.monotonic()
+            f.write(chunk)
+            stats.write_seconds += time.monotonic() - write_at
+            on_write(position, chunk)
+            position += len(chunk)
+            stats.bytes += len(chunk)
+            expected_seq += 1
+
+        # Acknowledge this packet (parity is never acknowledged) and, cumulatively, everything before expected_seq
+        if packet_type != PKT_PARITY:
+            send_ack(client, server_addr, transfer_id, seq_num, expected_seq)
+            stats.acks += 1
+        # The server must not resend a packet rebuilt from parity
+        if rebuilt:
+            send_ack(client, server_addr, transfer_id, rebuilt[0], expected_seq)
+            stats.acks += 1
+
+    stats.flush()
+    linger(client, transfer_id, expected_seq, rtt)
+    return True
+
+def fetch_range(client, file_name, f, start, end, sha256, rtt, on_write, payload=None):
+    """Download the bytes [start, end) of the file into f with a range REQUEST. Returns False if that version of the file is gone."""
+    transfer_id = random.getrandbits(32)
+    response, server_addr = request_file(client, file_name, transfer_id, rtt, start, end - start, sha256, payload)
+    if response is None:
+        return False
+    status, options = parse_message(response)
+    if status.startswith("ERROR") or int(options.get("OFFSET", 0)) != start:
+        return False  # The file changed on the server
+    return receive_range(client, server_addr, f, transfer_id, int(options.get("WINDOW", WINDOW_SIZE)),
+                         INTEGRITY_MODES[options.get("INTEGRITY", "sum8")], rtt, start, end, on_write,
+                         int(options.get("FEC", 0)), int(options.get("PAYLOAD", CHUNK_SIZE)))
+
+def refetch_blocks(client, file_name, f, verifier, sha256, rtt, payload=None):
+    """Download the blocks that failed their hash check again, one range request each. Returns True once all of them match."""
+    for attempt in range(MAX_RETRIES):
+        bad, verifier.bad = verifier.bad, []
+        for block in bad:
+            start = block * verifier.block_size
+            end = min(start + verifier.block_size, verifier.file_size)
+            print(f"[INFO] Block {block} of {file_name} does not match its hash. Fetching bytes {start}-{end} again...")
+            verifier.digest = hashlib.sha256()
+            if not fetch_range(client, file_name, f, start, end, sha256, rtt, verifier.update, payload):
+                return False
+        if not verifier.bad:
+            return True
+    return False
+
+def delta_block_size(size):
+    """Signature block size for an old copy of `size` bytes: about the square root, in whole KB, at most DELTA_MAX_BLOCKS blocks."""
+    return max(DELTA_MIN_BLOCK, math.isqrt(size) // 1024 * 1024, -(-size // DELTA_MAX_BLOCKS))
+
+def block_signatures(file_path, block_size):
+    """The DELTA signature of every whole block of the file, and the SHA-256 of all of it."""
+    signatures, digest = [], hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while block := f.read(block_size):
+            digest.update(block)
+            if len(block) == block_size:
+                signatures.append(struct.pack(DELTA_SIGNATURE, zlib.adler32(block), hashlib.blake2b(block, digest_size=16).digest()))
+    return signatures, digest.hexdigest()
+
+def fetch_delta_runs(client, file_name, sha256, block_size, signatures, rtt):
+    """Have the server compare the file with the signatures of the old copy, rsync style.
+
+    The signatures go DELTA_PAGE to a datagram, DELTA_WINDOW datagrams at a time, and only the ones
+    the server has not acknowledged are sent again. The runs (position, first block, count) of the
+    new file that the old copy already has are then fetched page by page. Returns None if the server
+    cannot compare them (the file changed, an older server, no answer).
+    """
+    delta_id = random.getrandbits(32)
+    tag = f"\nID:{delta_id}\n".encode(FORMAT)
+    header = f"DELTA:{file_name}\nID:{delta_id}\nBLOCK:{block_size}\nCOUNT:{len(signatures)}\nSHA256:{sha256}\n"
+    pages = range(0, len(signatures), DELTA_PAGE)  # Index of the first signature of each datagram
+    acked, retries = set(), 0
+    while len(acked) < len(pages):
+        wanted = [first for first in pages if first not in acked][:DELTA_WINDOW]
+        for first in wanted:
+            message = f"{header}FIRST:{first}\n\n".encode(FORMAT) + b"".join(signatures[first:first + DELTA_PAGE])
+            client.sendto(message, (SERVER_HOST, SERVER_PORT))
+        client.settimeout(rtt.timeout())
+        try:
+            while not all(first in acked for first in wanted):
+                response, _ = client.recvfrom(MAX_DATAGRAM)
+                if response.startswith(b"ERROR"):
+                    return None
+                if response.startswith(b"OK:") and tag in response:
+                    _, options = parse_message(response.decode(FORMAT, errors="replace"))
+                    if int(options.get("FIRST", -1)) in pages:
+                        acked.add(int(options["FIRST"]))
+            retries = 0
+        except socket.timeout:
+            rtt.on_timeout()
+            retries += 1
+            if retries >= MAX_RETRIES:
+                return None
+
+    runs, page = [], 0
+    give_up_at = time.monotonic() + DELTA_WAIT
+    while True:
+        page_tag = tag + f"RUNS:{page}\n".encode(FORMAT)
+        response, _ = exchange(client, f"DELTA:{file_name}\nID:{delta_id}\nRUNS:{page}\n", rtt,
+                               lambda reply: reply.startswith(b"ERROR") or page_tag in reply)
+        if response is None:
+            return None
+        header, _, body = response.partition(b"\n\n")
+        status, options = parse_message(header.decode(FORMAT, errors="replace"))
+        if status == "WAIT" and time.monotonic() < give_up_at:
+            time.sleep(DELTA_POLL)  # The server is still matching
+            continue
+        if not status.startswith("OK:") or int(options.get("BLOCK", 0)) != block_size or len(body) % DELTA_RUN_SIZE:
+            return None
+        count = int(status.split(":")[1])
+        runs += struct.iter_unpack(DELTA_RUN, body)
+        if len(runs) >= count or not body:
+            break
+        page += 1
+    return runs if len(runs) == count else None
+
+def update_file(client, file_name, file_path, part_path, index, rtt, payload):
+    """Bring the old copy at file_path up to date, downloading only the bytes the server does not find in it.
 
-            # Initialize file download
+    The server matches the signatures of the old copy against the new file, even where data was
+    inserted or removed; the runs it finds are copied from the old copy into the .part file and only
+    the bytes between them are fetched with range REQUESTs. The result is checked against the file's
+    SHA-256. Returns True once the file is current, False to fall back to a full download.
+    """
+    sha256, file_size = index[2], index[3]
+    block_size = delta_block_size(os.path.getsize(file_path))
+    signatures, old_digest = block_signatures(file_path, block_size)
+    if old_digest == sha256:
+        print(f"[INFO] {file_name} is already up to date.")
+        return True
+    if not signatures:
+        return False  # Too short to share a whole block with the new file
+    runs = fetch_delta_runs(client, file_name, sha256, block_size, signatures, rtt)
+    if runs is None:
+        return False
+
+    # The bytes not covered by a run, with gaps shorter than DELTA_MERGE between them filled in
+    missing, position = [], 0
+    for start, first, count in sorted(runs):
+        end = start + count * block_size
+        if start < position or first + count > len(signatures) or end > file_size:
+            return False  # Not a reply to these signatures
+        if start > position:
+            if missing and position - missing[-1][1] < DELTA_MERGE:
+                missing[-1][1] = start
+            else:
+                missing.append([position, start])
+        position = end
+    if position < file_size:
+        if missing and position - missing[-1][1] < DELTA_MERGE:
+            missing[-1][1] = file_size
+        else:
+            missing.append([position, file_size])
+    fetched = sum(end - start for start, end in missing)
+    print(f"[INFO] Updating {file_name}: {file_size - fetched}/{file_size} bytes kept from the old copy, {fetched} to download.")
+
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as old, open(part_path, "w+b") as f:
+        f.truncate(file_size)
+        for start, first, count in runs:
+            old.seek(first * block_size)
+            f.seek(start)
+            for offset in range(0, count * block_size, 1024 * 1024):
+                f.write(old.read(min(1024 * 1024, count * block_size - offset)))
+        for start, end in missing:
+            if not fetch_range(client, file_name, f, start, end, sha256, rtt, lambda position, chunk: None, payload):
+                os.remove(part_path)
+                return False
+        # Runs and fetched ranges do not line up with the block index, so the whole file is checked
+        f.seek(0)
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    if digest.hexdigest() != sha256:
+        print(f"[ERROR] {file_name} failed the SHA-256 check after the update.")
+        os.remove(part_path)
+        return False
+    metrics.inc("udp_client_delta_reused_bytes_total", file_size - fetched)
+    os.replace(part_path, file_path)
+    print(f"[COMPLETE] {file_name} updated.")
+    return True
+
+def download_file(file_name):
+    """Download one file into DOWNLOAD_DIR, resuming from its journal if there is one. Returns True on success."""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+        rtt = RttEstimator()
+        result = "failed"
+        started_at = time.monotonic()
+        try:
             file_path = os.path.join(DOWNLOAD_DIR, file_name)
-            with open(file_path, "wb") as f:
-                bytes_received = 0
-                expected_seq = 0
-
-                while bytes_received < file_size:
-                    for _ in range(MAX_RETRIES):
-                        try:
-                            # Receive a packet
-                            packet, server_addr = client.recvfrom(CHUNK_SIZE + 8)
-                            seq_num, received_checksum, chunk = struct.unpack(
-                                "I B 1024s", packet[:8] + packet[8:]
-                            )
-                            chunk = chunk.rstrip(b"\x00")
-
-                            # Verify checksum and sequence number
-                            if checksum(chunk) == received_checksum and seq_num == expected_seq:
-                                f.write(chunk)
-                                bytes_received += len(chunk)
-                                print(f"[PROGRESS] {bytes_received}/{file_size} bytes received.", end="\r")
-
-                                # Send ACK
-                                ack_packet = struct.pack("I B", seq_num, 0)  # ACK = 0
-                                client.sendto(ack_packet, server_addr)
-
-                                # Move to the next sequence
-                                expected_seq += 1
-                                break
-                            else:
-                                print("[ERROR] Packet error. Resending ACK for last valid packet.")
-                                ack_packet = struct.pack("I B", expected_seq - 1, 0)
-                                client.sendto(ack_packet, server_addr)
-
-                        except socket.timeout:
-                            print("[WARNING] Timeout waiting for packet. Retrying...")
-                            continue
-                    else:
-                        print("[ERROR] Max retries reached. Download failed.")
-                        return
+            part_path = file_path + ".part"
+            journal_path = part_path + ".json"
+            journal = load_journal(journal_path, part_path)
+
+            # Fetch the block index first: once the REQUEST is answered the data starts flowing
+            index = fetch_block_index(client, file_name, rtt)
+            payload = negotiate_payload(client, rtt)
+            if DELTA_SYNC and index and index[3] is not None and not journal and os.path.isfile(file_path):
+                if update_file(client, file_name, file_path, part_path, index, rtt, payload):
+                    result = "done"
+                    return True
+                print(f"[INFO] Could not update {file_name} in place, downloading it again.")
+
+            # Send the file request along with our receive window and a transfer ID
+            # that tells our packets apart from every other transfer the server is running
+            transfer_id = random.getrandbits(32)
+            if journal:
+                response, server_addr = request_file(client, file_name, transfer_id, rtt, journal["received"], None, journal["sha256"], payload)
+            else:
+                response, server_addr = request_file(client, file_name, transfer_id, rtt, payload=payload)
+            if response is None:
+                print("[ERROR] No response from server.")
+                return False
+
+            # Server's response is the file size or an error
+            status, options = parse_message(response)
+            if status.startswith("ERROR"):
+                print(f"[ERROR] {status}")
+                return False
+
+            file_size = int(status.split(":")[1])
+            window = int(options.get("WINDOW", WINDOW_SIZE))
+            integrity = INTEGRITY_MODES[options.get("INTEGRITY", "sum8")]
+            packet_size = int(options.get("PAYLOAD", CHUNK_SIZE))
+            metrics.set("udp_client_payload_bytes", packet_size)
+            expected_digest = options.get("SHA256")
+            offset = int(options.get("OFFSET", 0))
+            info = {"name": file_name, "size": file_size, "mtime": int(options.get("MTIME", 0)), "sha256": expected_digest}
+            if index and index[2] != expected_digest:
+                index = None  # The file changed between the two requests
+            digest = hashlib.sha256()
+            verifier = BlockVerifier(file_size, index[0], index[1]) if index else None
+            bytes_received = offset
+            next_save_at = time.monotonic() + JOURNAL_INTERVAL
 
+            def on_write(position, chunk):
+                nonlocal bytes_received, next_save_at
+                digest.update(chunk)
+                if verifier:
+                    verifier.update(position, chunk)
+                bytes_received = position + len(chunk)
+                display_progress(file_name, bytes_received, file_size)
+                if time.monotonic() >= next_save_at:
+                    save_journal(journal_path, f, info, bytes_received)
+                    next_save_at = time.monotonic() + JOURNAL_INTERVAL
+
+            # Continue the partial file if the server agreed to resume, otherwise start it over
+            with open(part_path, "r+b" if offset else "wb") as f:
+                if offset:
+                    print(f"[INFO] Resuming {file_name} at byte {offset} of {file_size}...")
+                    # The bytes already on disk go through the same checks as the new ones
+                    while f.tell() < offset:
+                        position = f.tell()
+                        on_write(position, f.read(min(1024 * 1024, offset - position)))
+                    f.truncate()
+                else:
+                    print(f"[INFO] Downloading {file_name} ({file_size} bytes)...")
+                save_journal(journal_path, f, info, bytes_received)
+
+                try:
+                    if not receive_range(client, server_addr, f, transfer_id, window, integrity, rtt, offset, file_size, on_write,
+                                         int(options.get("FEC", 0)), packet_size):
+                        return False
+                    # Only the blocks that failed their hash are downloaded again
+                    if verifier and verifier.bad and not refetch_blocks(client, file_name, f, verifier, expected_digest, rtt, payload):
+                        print(f"\n[ERROR] Could not repair {file_name}, it will be downloaded again from the start.")
+                        bytes_received = 0
+                        return False
+                finally:
+                    # Whatever happens, leave a journal so the next attempt continues from here
+                    save_journal(journal_path, f, info, bytes_received)
+
+            # End-to-end check: with a block index every block has been checked already
+            if not verifier and expected_digest and digest.hexdigest() != expected_digest:
+                print(f"\n[ERROR] {file_name} failed the SHA-256 check. Deleting it.")
+                os.remove(part_path)
+                os.remove(journal_path)
+                return False
+            os.replace(part_path, file_path)
+            os.remove(journal_path)
+            result = "done"
+            metrics.observe("udp_client_download_throughput_bytes_per_second", [(file_size - offset) / max(time.monotonic() - started_at, 1e-6)])
             print(f"\n[COMPLETE] {file_name} downloaded successfully.")
+            return True
 
         except ConnectionRefusedError:
             raise ConnectionRefusedError("[ERROR] Could not connect to the server.")
+        finally:
+            metrics.inc("udp_client_downloads_total", labels=f'result="{result}"')
+            try:
+                metrics.dump(METRICS_FILE)
+            except OSError as e:
+                print(f"[ERROR] Could not write {METRICS_FILE}: {e}")
 
+class TransferQueue:
+    """Downloads files in the background, up to max_files at a time.
 
-def main():
-    print("[CLIENT] Starting...")
-    already_downloaded = set()
+    Files with a higher priority start first, files of equal priority in the order they were
+    submitted. callback(file_name, done) runs on the download thread once a file is done or has
+    failed. The bandwidth limit is shared by every download.
+    """
 
-    while True:
-        if not os.path.exists(INPUT_FILE):
-            print(f"[WARNING] {INPUT_FILE} not found.")
-            time.sleep(5)
-            continue
+    def __init__(self, max_files=MAX_FILES):
+        self.max_files = max_files
+        self.pending = []  # heap of (-priority, order, file_name, callback)
+        self.order = itertools.count()
+        self.queued = set()  # Files waiting or downloading
+        self.running = 0
+        self.threads = []
+        self.condition = threading.Condition()
+
+    def submit(self, file_name, priority=0, callback=None):
+        """Queue a file; returns False if it is already queued."""
+        with self.condition:
+            if file_name in self.queued:
+                return False
+            self.queued.add(file_name)
+            heapq.heappush(self.pending, (-priority, next(self.order), file_name, callback))
+            # Each thread downloads one file after another; start another only while all are busy
+            if len(self.threads) < self.max_files and self.running + len(self.pending) > len(self.threads):
+                thread = threading.Thread(target=self.run, daemon=True)
+                self.threads.append(thread)
+                thread.start()
+            self.condition.notify()
+            return True
+
+    def run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.pending)
+                _, _, file_name, callback = heapq.heappop(self.pending)
+                self.running += 1
+            try:
+                try:
+                    done = download_file(file_name)
+                except OSError as e:
+                    print(f"[ERROR] Download of {file_name} failed: {e}")
+                    done = False
+                if callback:
+                    callback(file_name, done)
+            finally:
+                with self.condition:
+                    self.running -= 1
+                    self.queued.discard(file_name)
+                    self.condition.notify_all()
+
+    def status(self):
+        """file_name -> "queued" or "running" for every file in the queue."""
+        with self.condition:
+            waiting = {item[2] for item in self.pending}
+            return {file_name: "queued" if file_name in waiting else "running" for file_name in self.queued}
+
+    def join(self):
+        """Wait until no file is waiting or downloading."""
+        with self.condition:
+            self.condition.wait_for(lambda: not self.pending and not self.running)
+
+def open_control_socket():
+    """Listen on CONTROL_PATH, or on CONTROL_PORT where there are no Unix sockets.
+
+    A socket file left behind by a client that was killed is removed, unless another client is
+    still listening on it.
+    """
+    if not hasattr(socket, "AF_UNIX"):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(("127.0.0.1", CONTROL_PORT))
+        listener.listen()
+        return listener
+
+    if os.path.exists(CONTROL_PATH):
+        try:
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                probe.connect(CONTROL_PATH)
+        except OSError:
+            os.remove(CONTROL_PATH)
+        else:
+            raise OSError(f"another client is already listening on {CONTROL_PATH}")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(CONTROL_PATH)
+    listener.listen()
+    return listener
 
+class ControlServer:
+    """Takes download jobs from the control socket and puts them in the transfer queue.
+
+    Every line is a JSON command; replies and job results go back as JSON lines on the same connection:
+      {"op": "get", "files": [...], "priority": 0} -> {"event": "queued", "file": ...} per file,
+          then {"event": "done" | "failed", "file": ...} once it finishes, if the connection is still open
+      {"op": "status"} -> {"event": "status", "jobs": {file_name: "queued" | "running" | "done" | "failed"}}
+    """
+
+    def __init__(self, queue):
+        self.queue = queue
+        self.finished = {}  # file_name -> "done" or "failed"
+        self.watchers = {}  # file_name -> send functions of the connections waiting for it
+        self.lock = threading.Lock()
+
+    def serve(self, listener):
         try:
-            with open(INPUT_FILE, "r") as f:
-                files_to_download = {line.strip() for line in f if line.strip()}
+            while True:
+                conn, _ = listener.accept()
+                threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+        finally:
+            listener.close()
+            if listener.family != socket.AF_INET:
+                os.remove(CONTROL_PATH)
+
+    def submit(self, file_name, priority=0, send=None):
+        """Queue a file; one downloaded already is checked against the server and updated. A file in the queue only gets another watcher."""
+        with self.lock:
+            self.finished.pop(file_name, None)
+            if send:
+                self.watchers.setdefault(file_name, []).append(send)
+        self.queue.submit(file_name, priority, self.on_done)
+        if send:
+            send({"event": "queued", "file": file_name})
+
+    def on_done(self, file_name, done):
+        event = {"event": "done" if done else "failed", "file": file_name}
+        with self.lock:
+            self.finished[file_name] = event["event"]
+            watchers = self.watchers.pop(file_name, [])
+        for send in watchers:
+            send(event)
 
-            new_files = files_to_download - already_downloaded
-            for file_name in new_files:
-                download_file(file_name)
-                already_downloaded.add(file_name)
+    def handle(self, conn):
+        lock = threading.Lock()  # Download threads send their results on this connection too
+
+        def send(event):
+            try:
+                with lock:
+                    conn.sendall(json.dumps(event).encode(FORMAT) + b"\n")
+            except OSError:
+                pass  # getInput.py is gone and no longer needs to know
+
+        with conn, conn.makefile("r", encoding=FORMAT) as reader:
+            for line in reader:
+                try:
+                    command = json.loads(line)
+                    op = command["op"]
+                    if op == "get":
+                        for file_name in command["files"]:
+                            self.submit(file_name, int(command.get("priority", 0)), send)
+                    elif op == "status":
+                        with self.lock:
+                            jobs = dict(self.finished)
+                        jobs.update(self.queue.status())
+                        send({"event": "status", "jobs": jobs})
+                    else:
+                        send({"event": "error", "message": f"unknown op {op}"})
+                except (ValueError, KeyError, TypeError) as e:
+                    send({"event": "error", "message": f"bad command: {e}"})
 
-        except ConnectionRefusedError as e:
-            print(e)
-            print("[CLIENT] Closing program in 3 seconds...")
-            time.sleep(3)
-            sys.exit()
+def run_headless(file_names):
+    """Download the given files in parallel and exit, without input.txt or the keyboard (for scripts and benchmarks)."""
+    queue = TransferQueue(MAX_FILES)
+    failed = []
 
-        print("[INFO] Waiting for new files...")
-        time.sleep(5)
+    def on_done(file_name, done):
+        if not done:
+            failed.append(file_name)
+
+    for file_name in file_names:
+        queue.submit(file_name, callback=on_done)
+    queue.join()
+    if failed:
+        print(f"[ERROR] Failed: {' '.join(failed)}")
+    return 1 if failed else 0
+
+def main():
+    """Run in the background: download what getInput.py submits on the control socket, as soon as it arrives."""
+    print("[CLIENT] Starting...")
+    files = get_available_files()
+    if files is None:
+        print("[ERROR] No response from server.")
+    else:
+        print("Available files:")
+        print("\n".join(f"{name} {size}" for name, size in files))
+
+    control = ControlServer(TransferQueue(MAX_FILES))
+    try:
+        listener = open_control_socket()
+    except OSError as e:
+        print(f"[ERROR] Could not open the control socket: {e}")
+        sys.exit(1)
+
+    # Files written to input.txt while no client was running; emptied once queued so the next start does not fetch them again
+    if os.path.exists(INPUT_FILE):
+        with open(INPUT_FILE, "r") as f:
+            for line in f:
+                if line.strip():
+                    control.submit(line.strip())
+        open(INPUT_FILE, "w").close()
+
+    print(f"[INFO] Waiting for jobs on {CONTROL_PATH if listener.family != socket.AF_INET else f'127.0.0.1:{CONTROL_PORT}'}")
+    print("| Please run file getInput.py to enter files you'd like to download.")
+    print("| Press Ctrl + C to exit")
+    control.serve(listener)
 
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="UDP file client. Without file names it runs as a daemon: it takes download jobs from getInput.py over the control socket, and at startup queues whatever input.txt holds once, then empties it")
+    parser.add_argument("files", nargs="*", help="download these files and exit instead")
+    parser.add_argument("--host", default=SERVER_HOST)
+    parser.add_argument("--port", type=int, default=SERVER_PORT)
+    parser.add_argument("--output", default=DOWNLOAD_DIR, help="directory to download into")
+    parser.add_argument("--metrics", default=METRICS_FILE, help="where to write the JSON metrics dump")
+    parser.add_argument("--fec", type=int, default=FEC_GROUP, help="ask for one XOR parity packet per this many data packets (0 = off)")
+    parser.add_argument("--compress", choices=sorted(COMPRESS_MODES), default="off", help="ask the server to compress what compresses (fast = zlib level 1)")
+    parser.add_argument("--compress-level", type=int, choices=range(1, 10), metavar="1-9", help="zlib level, overrides the one of --compress")
+    parser.add_argument("--parallel", type=int, default=MAX_FILES, help="files downloaded at the same time")
+    parser.add_argument("--bandwidth", type=int, default=MAX_BANDWIDTH, help="total receive rate in bytes per second, 0 for no limit")
+    parser.add_argument("--no-delta", dest="delta", action="store_false", help="download changed files completely instead of only the parts that differ from the old copy")
+    parser.add_argument("--payload", type=int, default=PAYLOAD_SIZE, help="data bytes per packet to ask for; by default the path is probed, 0 for the original fixed-size packets")
+    args = parser.parse_args()
+    SERVER_HOST, SERVER_PORT, DOWNLOAD_DIR = args.host, args.port, os.path.abspath(args.output)
+    METRICS_FILE = os.path.abspath(args.metrics)
+    FEC_GROUP = args.fec
+    COMPRESS_LEVEL = args.compress_level or COMPRESS_MODES[args.compress]
+    MAX_FILES = args.parallel
+    PAYLOAD_SIZE = args.payload
+    DELTA_SYNC = args.delta
+    bandwidth = RateLimiter(args.bandwidth)
+
+    os.makedirs(DOWNLOAD_DIR, exist_ok=True)
+    if args.files:
+        sys.exit(run_headless(args.files))
     main()
@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import timeit
+import zlib
+import hashlib
+
+PAYLOAD_SIZE = 1007  # Data bytes per UDP packet (CHUNK_SIZE in the UDP server)
+PACKETS = 20000  # Packets checked per measurement
+REPEAT = 5  # Measurements per check, the best one is reported
+
+
+def sum8(data):
+    """The original check: byte sum modulo 256."""
+    return sum(data) % 256
+
+
+def measure(check, payloads):
+    """Best CPU time per packet (in microseconds) for running `check` over every payload."""
+    timer = timeit.Timer(lambda: [check(p) for p in payloads], timer=time.process_time)
+    best = min(timer.repeat(repeat=REPEAT, number=1))
+    return best / len(payloads) * 1e6
+
+
+def main():
+    payloads = [os.urandom(PAYLOAD_SIZE) for _ in range(PACKETS)]
+    print(f"[BENCH] Per-packet integrity check, {PAYLOAD_SIZE}-byte payloads, {PACKETS} packets, best of {REPEAT}")
+    print(f"[BENCH] Python {sys.version.split()[0]}")
+
+    before = measure(sum8, payloads)
+    after = measure(zlib.crc32, payloads)
+    print(f"  sum(data) % 256   {before:8.3f} us/packet")
+    print(f"  zlib.crc32        {after:8.3f} us/packet   ({before / after:.1f}x faster)")
+
+    # The end-to-end digest is paid once per byte rather than once per packet
+    digest = measure(lambda p: hashlib.sha256().update(p), payloads)
+    print(f"  sha256 (per file) {digest:8.3f} us/packet-equivalent")
+
+    # Detection: swapping two bytes leaves the byte sum unchanged
+    data = bytearray(payloads[0])
+    swapped = bytes(data[1:2] + data[0:1] + data[2:])
+    print(f"[BENCH] Two swapped bytes detected: sum8={sum8(data) != sum8(swapped)} crc32={zlib.crc32(data) != zlib.crc32(swapped)}")
+
+
+if __name__ == "__main__":
+    main()
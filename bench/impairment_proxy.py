@@ -0,0 +1,175 @@
+import argparse
+import heapq
+import queue
+import random
+import select
+import socket
+import threading
+import time
+
+HOST = "127.0.0.1"
+RECV_SIZE = 65536
+
+
+class Impairment:
+    """Decides the fate of each datagram or stream chunk passing through the proxy."""
+
+    def __init__(self, loss=0.0, reorder=0.0, duplicate=0.0, delay=0.0, jitter=0.0, reorder_delay=0.002, seed=None):
+        self.loss = loss
+        self.reorder = reorder
+        self.duplicate = duplicate
+        self.delay = delay
+        self.jitter = jitter
+        self.reorder_delay = reorder_delay
+        self.random = random.Random(seed)
+
+    def schedule(self, now):
+        """Delivery times for one datagram: none if it is lost, two if it is duplicated.
+
+        A reordered datagram is held back for reorder_delay seconds, so the ones sent after it overtake it.
+        """
+        if self.random.random() < self.loss:
+            return []
+        copies = 2 if self.random.random() < self.duplicate else 1
+        times = []
+        for _ in range(copies):
+            when = now + self.delay + self.random.uniform(0, self.jitter)
+            if self.random.random() < self.reorder:
+                when += self.reorder_delay
+            times.append(when)
+        return times
+
+    def latency(self):
+        """One-way delay of a stream chunk (TCP delivers in order, so only delay and jitter apply)."""
+        return self.delay + self.random.uniform(0, self.jitter)
+
+
+def run_udp(listen_port, target, impairment):
+    """Forward datagrams between clients on listen_port and the server at target, in both directions.
+
+    Each client gets its own socket towards the server, so the server sees one address per client.
+    """
+    front = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    front.bind((HOST, listen_port))
+    backs = {}  # client address -> socket towards the server
+    clients = {}  # socket towards the server -> client address
+    pending = []  # heap of (deliver_at, sequence, socket, datagram, address)
+    sequence = 0
+
+    while True:
+        timeout = max(pending[0][0] - time.monotonic(), 0) if pending else None
+        readable, _, _ = select.select([front, *clients], [], [], timeout)
+        now = time.monotonic()
+        for sock in readable:
+            try:
+                data, addr = sock.recvfrom(RECV_SIZE)
+            except OSError:
+                continue  # ICMP port unreachable from a previous datagram
+            if sock is front:
+                back = backs.get(addr)
+                if back is None:
+                    back = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+                    back.bind((HOST, 0))
+                    backs[addr], clients[back] = back, addr
+                out, destination = back, target
+            else:
+                out, destination = front, clients[sock]
+            for when in impairment.schedule(now):
+                heapq.heappush(pending, (when, sequence, out, data, destination))
+                sequence += 1
+
+        now = time.monotonic()
+        while pending and pending[0][0] <= now:
+            _, _, out, data, destination = heapq.heappop(pending)
+            try:
+                out.sendto(data, destination)
+            except OSError:
+                pass
+
+
+def pump(source, destination, impairment):
+    """Copy one direction of a TCP connection, holding every chunk back by the configured latency."""
+    chunks = queue.Queue()
+
+    def deliver():
+        while True:
+            item = chunks.get()
+            if item is None:
+                break
+            deliver_at, data = item
+            time.sleep(max(deliver_at - time.monotonic(), 0))
+            try:
+                destination.sendall(data)
+            except OSError:
+                break
+        try:
+            destination.shutdown(socket.SHUT_WR)
+        except OSError:
+            pass
+
+    writer = threading.Thread(target=deliver, daemon=True)
+    writer.start()
+    last = 0.0
+    while True:
+        try:
+            data = source.recv(RECV_SIZE)
+        except OSError:
+            data = b""
+        if not data:
+            break
+        # Jitter must not reorder a byte stream: a chunk is never delivered before the one ahead of it
+        last = max(last, time.monotonic() + impairment.latency())
+        chunks.put((last, data))
+    chunks.put(None)
+    writer.join()
+
+
+def run_tcp(listen_port, target, impairment):
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((HOST, listen_port))
+    listener.listen(128)
+
+    def serve(client):
+        with client, socket.create_connection(target) as server:
+            upstream = threading.Thread(target=pump, args=(client, server, impairment), daemon=True)
+            upstream.start()
+            pump(server, client, impairment)
+            upstream.join()
+
+    while True:
+        client, _ = listener.accept()
+        threading.Thread(target=serve, args=(client,), daemon=True).start()
+
+
+def parse_address(value):
+    host, _, port = value.rpartition(":")
+    return host or HOST, int(port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Loopback proxy that adds loss, reordering, duplication and delay")
+    parser.add_argument("protocol", choices=["udp", "tcp"])
+    parser.add_argument("--listen", type=int, required=True, help="port the clients connect to")
+    parser.add_argument("--target", type=parse_address, required=True, help="server address, host:port")
+    parser.add_argument("--loss", type=float, default=0.0, help="probability a datagram is dropped (UDP only)")
+    parser.add_argument("--reorder", type=float, default=0.0, help="probability a datagram is held back (UDP only)")
+    parser.add_argument("--reorder-delay", type=float, default=0.002, help="how long a reordered datagram is held back (s)")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="probability a datagram is delivered twice (UDP only)")
+    parser.add_argument("--delay", type=float, default=0.0, help="one-way delay (s)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random one-way delay, up to this much (s)")
+    parser.add_argument("--seed", type=int, default=None, help="seed for reproducible impairments")
+    args = parser.parse_args()
+
+    impairment = Impairment(args.loss, args.reorder, args.duplicate, args.delay, args.jitter, args.reorder_delay, args.seed)
+    if args.protocol == "tcp" and (args.loss or args.reorder or args.duplicate):
+        print("[PROXY] TCP delivers a reliable, ordered stream: only --delay and --jitter apply")
+    print(f"[PROXY] {args.protocol} :{args.listen} -> {args.target[0]}:{args.target[1]}")
+    try:
+        (run_udp if args.protocol == "udp" else run_tcp)(args.listen, args.target, impairment)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "TCP", "SocketPy", "Server", "Server.py")
+HOST = "127.0.0.1"
+PORT = 65500
+FILE_NAME = "load.bin"
+FILE_SIZE = 4 * 1024 * 1024
+FORMAT = "utf-8"
+
+
+def make_server_dir(directory):
+    """Create the file served during the run and the file_list.txt that publishes it."""
+    with open(os.path.join(directory, FILE_NAME), "wb") as f:
+        f.write(os.urandom(FILE_SIZE))
+    with open(os.path.join(directory, "file_list.txt"), "w") as f:
+        f.write(f"{FILE_NAME} {FILE_SIZE}\n")
+
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection((HOST, port), timeout=0.2).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"server did not start listening on port {port}")
+
+
+def proc_status(pid):
+    """Resident memory (kB) and thread count of a process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["VmRSS"].split()[0]), int(fields["Threads"])
+    except (OSError, KeyError):
+        return None, None
+
+
+async def client(requests, range_size, latencies, start):
+    await start.wait()
+    reader, writer = await asyncio.open_connection(HOST, PORT)
+    try:
+        for i in range(requests):
+            offset = (i * range_size) % (FILE_SIZE - range_size)
+            began = time.perf_counter()
+            writer.write(f"DOWNLOAD {FILE_NAME} {offset} {range_size}".encode(FORMAT))
+            await writer.drain()
+            await reader.readexactly(range_size)
+            latencies.append(time.perf_counter() - began)
+    finally:
+        writer.close()
+
+
+async def sample(pid, peaks, done):
+    while not done.is_set():
+        rss, threads = proc_status(pid)
+        if rss is not None:
+            peaks["rss"] = max(peaks["rss"], rss)
+            peaks["threads"] = max(peaks["threads"], threads)
+        await asyncio.sleep(0.05)
+
+
+async def run_load(pid, connections, requests, range_size):
+    latencies, peaks = [], {"rss": 0, "threads": 0}
+    start, done = asyncio.Event(), asyncio.Event()
+    clients = [asyncio.create_task(client(requests, range_size, latencies, start)) for _ in range(connections)]
+    sampler = asyncio.create_task(sample(pid, peaks, done))
+    began = time.perf_counter()
+    start.set()
+    results = await asyncio.gather(*clients, return_exceptions=True)
+    elapsed = time.perf_counter() - began
+    done.set()
+    await sampler
+    errors = sum(isinstance(r, Exception) for r in results)
+    return latencies, elapsed, peaks, errors
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float("nan")
+
+
+def bench_mode(mode, directory, connections, requests, range_size):
+    command = [sys.executable, SERVER, "--port", str(PORT), "--dir", directory]
+    if mode == "async":
+        command.append("--async")
+    server = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        wait_for_port(PORT)
+        latencies, elapsed, peaks, errors = asyncio.run(run_load(server.pid, connections, requests, range_size))
+    finally:
+        server.terminate()
+        server.wait()
+
+    done = len(latencies)
+    print(f"  {mode:9} {done / elapsed:9.0f} req/s {done * range_size / elapsed / 1e6:9.1f} MB/s "
+          f"p50 {percentile(latencies, 50) * 1000:7.2f} ms  p99 {percentile(latencies, 99) * 1000:7.2f} ms  "
+          f"peak RSS {peaks['rss'] / 1024:6.1f} MB  peak threads {peaks['threads']:5}  failed clients {errors}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compare the threaded and asyncio TCP servers under concurrent load")
+    parser.add_argument("--connections", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--requests", type=int, default=20, help="DOWNLOAD requests per connection")
+    parser.add_argument("--range-size", type=int, default=64 * 1024, help="bytes per DOWNLOAD request")
+    args = parser.parse_args()
+
+    if resource is not None:
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+    with tempfile.TemporaryDirectory() as directory:
+        make_server_dir(directory)
+        for connections in args.connections:
+            print(f"[BENCH] {connections} connections x {args.requests} requests of {args.range_size} bytes")
+            for mode in ("threaded", "async"):
+                bench_mode(mode, directory, connections, args.requests, args.range_size)
+
+
+if __name__ == "__main__":
+    main()
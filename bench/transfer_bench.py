@@ -0,0 +1,237 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(BENCH_DIR, "..")
+PROXY = os.path.join(BENCH_DIR, "impairment_proxy.py")
+SERVERS = {
+    "tcp": os.path.join(ROOT, "TCP", "SocketPy", "Server", "Server.py"),
+    "udp": os.path.join(ROOT, "TCP", "SocketPy", "UDP", "Server", "Server.py"),
+}
+CLIENTS = {
+    "tcp": os.path.join(ROOT, "TCP", "SocketPy", "Client", "Client.py"),
+    "udp": os.path.join(ROOT, "TCP", "SocketPy", "UDP", "Client", "Client.py"),
+}
+HOST = "127.0.0.1"
+SERVER_PORT = 65510
+PROXY_PORT = 65511
+WRITE_BLOCK = 1024 * 1024
+UNITS = {"K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+
+
+def parse_size(value):
+    """'1M', '512K', '1G' or a plain byte count."""
+    value = value.strip().upper().removesuffix("B")
+    if value and value[-1] in UNITS:
+        return int(float(value[:-1]) * UNITS[value[-1]])
+    return int(value)
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if size < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if size == int(size) else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def make_files(directory, sizes):
+    """Random (incompressible) test files, one per size; returns name -> (size, sha256)."""
+    files = {}
+    for size in sizes:
+        name = f"bench_{format_size(size).replace(' ', '')}.bin"
+        digest = hashlib.sha256()
+        with open(os.path.join(directory, name), "wb") as f:
+            remaining = size
+            while remaining > 0:
+                block = os.urandom(min(WRITE_BLOCK, remaining))
+                f.write(block)
+                digest.update(block)
+                remaining -= len(block)
+        files[name] = (size, digest.hexdigest())
+    return files
+
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while block := f.read(WRITE_BLOCK):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def wait_for_server(protocol, port, timeout=10):
+    """Wait until the server answers: a TCP connect, or a reply to a UDP LIST."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            if protocol == "tcp":
+                socket.create_connection((HOST, port), timeout=0.2).close()
+                return
+            with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+                probe.settimeout(0.2)
+                probe.sendto(b"LIST\nPAGE:0\n", (HOST, port))
+                probe.recvfrom(2048)
+                return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"{protocol} server did not answer on port {port}")
+
+
+def process_cpu(pid):
+    """User + system CPU seconds of a process, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def process_peak_rss(pid):
+    """Peak resident memory of a process in MB, from /proc (Linux only)."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            fields = dict(line.split(":", 1) for line in f)
+        return int(fields["VmHWM"].split()[0]) / 1024
+    except (OSError, KeyError, ValueError):
+        return None
+
+
+def run_client(command, timeout):
+    """Run one headless client; returns (exit code, wall seconds, CPU seconds, peak RSS in MB)."""
+    began = time.perf_counter()
+    proc = subprocess.Popen(command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    killer = threading.Timer(timeout, proc.kill)
+    killer.start()
+    try:
+        if hasattr(os, "wait4"):
+            _, status, usage = os.wait4(proc.pid, 0)
+            proc.returncode = os.waitstatus_to_exitcode(status)
+            # ru_maxrss is in kilobytes on Linux but in bytes on macOS
+            rss = usage.ru_maxrss / (1024 * 1024 if sys.platform == "darwin" else 1024)
+            cpu = usage.ru_utime + usage.ru_stime
+        else:
+            proc.wait()
+            cpu = rss = None
+    finally:
+        killer.cancel()
+    return proc.returncode, time.perf_counter() - began, cpu, rss
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))] if values else float("nan")
+
+
+def bench_protocol(protocol, args, work_dir, files):
+    """Start the server and the impairment proxy, then download every file args.runs times."""
+    server_dir = os.path.join(work_dir, "server")
+    output_dir = os.path.join(work_dir, f"{protocol}-downloads")
+    server_command = [sys.executable, SERVERS[protocol], "--port", str(SERVER_PORT), "--dir", server_dir, "--metrics-port", "0"]
+    if protocol == "tcp" and args.tcp_async:
+        server_command.append("--async")
+    proxy_command = [sys.executable, PROXY, protocol, "--listen", str(PROXY_PORT), "--target", f"{HOST}:{SERVER_PORT}",
+                     "--loss", str(args.loss), "--reorder", str(args.reorder), "--duplicate", str(args.duplicate),
+                     "--delay", str(args.delay), "--jitter", str(args.jitter), "--seed", str(args.seed)]
+    client_command = [sys.executable, CLIENTS[protocol], "--port", str(PROXY_PORT), "--output", output_dir,
+                      "--metrics", os.path.join(work_dir, f"{protocol}-metrics.json")]
+
+    server = subprocess.Popen(server_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    proxy = subprocess.Popen(proxy_command, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    results = []
+    try:
+        wait_for_server(protocol, SERVER_PORT)
+        wait_for_server(protocol, PROXY_PORT)
+        for name, (size, digest) in files.items():
+            runs = []
+            for _ in range(args.runs):
+                shutil.rmtree(output_dir, ignore_errors=True)
+                server_cpu = process_cpu(server.pid)
+                code, wall, cpu, rss = run_client(client_command + [name], args.timeout)
+                if server_cpu is not None:
+                    server_cpu = process_cpu(server.pid) - server_cpu
+                path = os.path.join(output_dir, name)
+                ok = code == 0 and os.path.exists(path) and file_digest(path) == digest
+                runs.append({"ok": ok, "seconds": wall, "client_cpu": cpu, "client_rss_mb": rss, "server_cpu": server_cpu})
+            result = summarize(protocol, name, size, runs)
+            result["server_peak_rss_mb"] = process_peak_rss(server.pid)
+            results.append(result)
+            report(result)
+    finally:
+        for proc in (proxy, server):
+            proc.terminate()
+            proc.wait()
+        shutil.rmtree(output_dir, ignore_errors=True)
+    return results
+
+
+def summarize(protocol, name, size, runs):
+    good = [run for run in runs if run["ok"]]
+    times = [run["seconds"] for run in good]
+
+    def mean(key):
+        values = [run[key] for run in good if run[key] is not None]
+        return statistics.mean(values) if values else None
+
+    return {
+        "protocol": protocol, "file": name, "size": size, "runs": len(runs), "ok": len(good),
+        "throughput_mb_s": size / statistics.median(times) / 1e6 if times else None,
+        "p50_s": percentile(times, 50) if times else None, "p99_s": percentile(times, 99) if times else None,
+        "client_cpu_s": mean("client_cpu"), "client_rss_mb": max((run["client_rss_mb"] or 0 for run in good), default=None),
+        "server_cpu_s": mean("server_cpu"), "samples": runs,
+    }
+
+
+def report(result):
+    def show(value, spec):
+        return "-" if value is None else format(value, spec)
+
+    print(f"  {result['protocol']:3} {format_size(result['size']):>8}  ok {result['ok']}/{result['runs']}  "
+          f"{show(result['throughput_mb_s'], '8.1f')} MB/s  p50 {show(result['p50_s'], '7.3f')} s  p99 {show(result['p99_s'], '7.3f')} s  "
+          f"client CPU {show(result['client_cpu_s'], '6.2f')} s  RSS {show(result['client_rss_mb'], '6.1f')} MB  "
+          f"server CPU {show(result['server_cpu_s'], '6.2f')} s  RSS {show(result['server_peak_rss_mb'], '6.1f')} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Download test files through an impairment proxy with the TCP and UDP clients")
+    parser.add_argument("--sizes", nargs="+", type=parse_size, default=[parse_size(size) for size in ("1M", "16M", "64M")],
+                        help="test file sizes, e.g. 1M 100M 1G")
+    parser.add_argument("--protocols", nargs="+", choices=sorted(SERVERS), default=sorted(SERVERS))
+    parser.add_argument("--runs", type=int, default=5, help="downloads per file")
+    parser.add_argument("--loss", type=float, default=0.0, help="UDP datagram loss probability")
+    parser.add_argument("--reorder", type=float, default=0.0, help="UDP datagram reordering probability")
+    parser.add_argument("--duplicate", type=float, default=0.0, help="UDP datagram duplication probability")
+    parser.add_argument("--delay", type=float, default=0.0, help="one-way delay in seconds (TCP and UDP)")
+    parser.add_argument("--jitter", type=float, default=0.0, help="extra random one-way delay in seconds (TCP and UDP)")
+    parser.add_argument("--seed", type=int, default=1, help="seed of the proxy's random impairments")
+    parser.add_argument("--tcp-async", action="store_true", help="run the TCP server in asyncio mode")
+    parser.add_argument("--timeout", type=float, default=600, help="give up on a download after this many seconds")
+    parser.add_argument("--json", help="also write the results, every run included, to this file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.makedirs(os.path.join(work_dir, "server"))
+        files = make_files(os.path.join(work_dir, "server"), args.sizes)
+        print(f"[BENCH] {args.runs} runs per file, loss {args.loss} reorder {args.reorder} duplicate {args.duplicate} "
+              f"delay {args.delay * 1000:.1f} ms jitter {args.jitter * 1000:.1f} ms, Python {sys.version.split()[0]}")
+        results = []
+        for protocol in args.protocols:
+            results += bench_protocol(protocol, args, work_dir, files)
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": results}, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()